@@ -15,7 +15,7 @@ from .errors import ErrorFolderNotFound, ErrorAccessDenied
 from .ewsdatetime import EWSTimeZone
 from .fields import FieldPath
 from .folders import Root, Calendar, DeletedItems, Drafts, Inbox, Outbox, SentItems, JunkEmail, Tasks, Contacts, \
-    RecoverableItemsRoot, RecoverableItemsDeletions, Folder, SHALLOW, DEEP
+    RecoverableItemsRoot, RecoverableItemsDeletions, Folder, FolderTree
 from .items import Item, BulkCreateResult, HARD_DELETE, \
     AUTO_RESOLVE, SEND_TO_NONE, SAVE_ONLY, SEND_AND_SAVE_COPY, SEND_ONLY, SPECIFIED_OCCURRENCE_ONLY, \
     DELETE_TYPE_CHOICES, MESSAGE_DISPOSITION_CHOICES, CONFLICT_RESOLUTION_CHOICES, AFFECTED_TASK_OCCURRENCES_CHOICES, \
@@ -23,8 +23,12 @@ from .items import Item, BulkCreateResult, HARD_DELETE, \
     SEND_MEETING_CANCELLATIONS_CHOICES
 from .protocol import Protocol
 from .queryset import QuerySet
-from .services import ExportItems, UploadItems, GetItem, CreateItem, UpdateItem, DeleteItem, MoveItem, SendItem
-from .util import get_domain, peek
+from .notifications import EVENT_TYPES, events_from_xml
+from .services import ExportItems, UploadItems, GetItem, CreateItem, UpdateItem, DeleteItem, MoveItem, SendItem, \
+    Subscribe, GetEvents, Unsubscribe
+from .tracing import start_span, trace_iter, BULK_CALL
+from .transport import TNS
+from .util import get_domain, peek, get_xml_attr
 
 log = getLogger(__name__)
 
@@ -75,25 +79,39 @@ class Account(object):
         # server version up-front but delegate account requests to an older backend server.
         self.version = self.protocol.version
         self.root = Root.get_distinguished(account=self)
+        self._folders_cache = None  # (folder tree, tree generation, folders), see the 'folders' property
 
         assert isinstance(self.protocol, Protocol)
         log.debug('Added account: %s', self)
 
     @threaded_cached_property
+    def folder_tree(self):
+        # A cache of all folders in the account. Call account.folder_tree.refresh() to get changes since the last
+        # refresh. To reuse a tree saved with FolderTree.save(), assign FolderTree.load(...) to this attribute.
+        return FolderTree(account=self, root=self.root).refresh()
+
+    @property
     def folders(self):
+        # The folders are grouped again only if the folder tree was replaced or has changed since the last access
+        tree = self.folder_tree
+        cached = self._folders_cache
+        if cached is not None and cached[0] is tree and cached[1] == tree.generation:
+            return cached[2]
+        generation = tree.generation
         # 'Top of Information Store' is a folder available in some Exchange accounts. It only contains folders
         # owned by the account.
-        folders = self.root.get_folders(depth=SHALLOW)  # Start by searching top-level folders.
+        folders = tree.get_children(self.root)  # Start by searching top-level folders.
         for folder in folders:
             if folder.name == 'Top of Information Store':
-                folders = folder.get_folders(depth=SHALLOW)
+                folders = tree.get_children(folder)
                 break
         else:
             # We need to dig deeper. Get everything.
-            folders = self.root.get_folders(depth=DEEP)
+            folders = tree
         mapped_folders = defaultdict(list)
         for f in folders:
             mapped_folders[f.__class__].append(f)
+        self._folders_cache = tree, generation, mapped_folders
         return mapped_folders
 
     def _get_default_folder(self, fld_class):
@@ -250,16 +268,17 @@ class Account(object):
             # We accept generators, so it's not always convenient for caller to know up-front if 'items' is empty. Allow
             # empty 'items' and return early.
             return []
-        return list(
-            i if isinstance(i, Exception)
-            else BulkCreateResult.from_xml(elem=i, account=self)
-            for i in CreateItem(account=self).call(
-                items=items,
-                folder=folder,
-                message_disposition=message_disposition,
-                send_meeting_invitations=send_meeting_invitations,
+        with start_span(BULK_CALL % 'bulk_create', protocol=self.protocol, account=self.primary_smtp_address):
+            return list(
+                i if isinstance(i, Exception)
+                else BulkCreateResult.from_xml(elem=i, account=self)
+                for i in CreateItem(account=self).call(
+                    items=items,
+                    folder=folder,
+                    message_disposition=message_disposition,
+                    send_meeting_invitations=send_meeting_invitations,
+                )
             )
-        )
 
     def bulk_update(self, items, conflict_resolution=AUTO_RESOLVE, message_disposition=SAVE_ONLY,
                     send_meeting_invitations_or_cancellations=SEND_TO_NONE, suppress_read_receipts=True):
@@ -302,16 +321,17 @@ class Account(object):
             # We accept generators, so it's not always convenient for caller to know up-front if 'items' is empty. Allow
             # empty 'items' and return early.
             return []
-        return list(
-            i if isinstance(i, Exception) else Item.id_from_xml(i)
-            for i in UpdateItem(account=self).call(
-                items=items,
-                conflict_resolution=conflict_resolution,
-                message_disposition=message_disposition,
-                send_meeting_invitations_or_cancellations=send_meeting_invitations_or_cancellations,
-                suppress_read_receipts=suppress_read_receipts,
+        with start_span(BULK_CALL % 'bulk_update', protocol=self.protocol, account=self.primary_smtp_address):
+            return list(
+                i if isinstance(i, Exception) else Item.id_from_xml(i)
+                for i in UpdateItem(account=self).call(
+                    items=items,
+                    conflict_resolution=conflict_resolution,
+                    message_disposition=message_disposition,
+                    send_meeting_invitations_or_cancellations=send_meeting_invitations_or_cancellations,
+                    suppress_read_receipts=suppress_read_receipts,
+                )
             )
-        )
 
     def bulk_delete(self, ids, delete_type=HARD_DELETE, send_meeting_cancellations=SEND_TO_NONE,
                     affected_task_occurrences=SPECIFIED_OCCURRENCE_ONLY, suppress_read_receipts=True):
@@ -348,13 +368,14 @@ class Account(object):
             # We accept generators, so it's not always convenient for caller to know up-front if 'ids' is empty. Allow
             # empty 'ids' and return early.
             return []
-        return list(DeleteItem(account=self).call(
-            items=ids,
-            delete_type=delete_type,
-            send_meeting_cancellations=send_meeting_cancellations,
-            affected_task_occurrences=affected_task_occurrences,
-            suppress_read_receipts=suppress_read_receipts,
-        ))
+        with start_span(BULK_CALL % 'bulk_delete', protocol=self.protocol, account=self.primary_smtp_address):
+            return list(DeleteItem(account=self).call(
+                items=ids,
+                delete_type=delete_type,
+                send_meeting_cancellations=send_meeting_cancellations,
+                affected_task_occurrences=affected_task_occurrences,
+                suppress_read_receipts=suppress_read_receipts,
+            ))
 
     def bulk_send(self, ids, save_copy=True, copy_to_folder=None):
         # Send existing draft messages. If requested, save a copy in 'copy_to_folder'
@@ -372,7 +393,8 @@ class Account(object):
             # We accept generators, so it's not always convenient for caller to know up-front if 'ids' is empty. Allow
             # empty 'ids' and return early.
             return []
-        return list(SendItem(account=self).call(items=ids, saved_item_folder=copy_to_folder))
+        with start_span(BULK_CALL % 'bulk_send', protocol=self.protocol, account=self.primary_smtp_address):
+            return list(SendItem(account=self).call(items=ids, saved_item_folder=copy_to_folder))
 
     def bulk_move(self, ids, to_folder):
         # Move items to another folder. Returns new IDs for the items that were moved
@@ -387,14 +409,16 @@ class Account(object):
             # We accept generators, so it's not always convenient for caller to know up-front if 'ids' is empty. Allow
             # empty 'ids' and return early.
             return []
-        return list(
-            i if isinstance(i, Exception) else Item.id_from_xml(i)
-            for i in MoveItem(account=self).call(items=ids, to_folder=to_folder)
-        )
+        with start_span(BULK_CALL % 'bulk_move', protocol=self.protocol, account=self.primary_smtp_address):
+            return list(
+                i if isinstance(i, Exception) else Item.id_from_xml(i)
+                for i in MoveItem(account=self).call(items=ids, to_folder=to_folder)
+            )
 
-    def fetch(self, ids, folder=None, only_fields=None):
+    def fetch(self, ids, folder=None, only_fields=None, lazy=None):
         # 'folder' is used for validating only_fields
         # 'only_fields' specifies which fields to fetch, instead of all possible fields, as strings or FieldPaths.
+        # 'lazy' is one of LAZY_CHOICES to only decode item fields when they are accessed. See Item.from_xml()
         validation_folder = folder or Folder(account=self)  # Default to a folder type that supports all item types
         # 'ids' could be an unevaluated QuerySet, e.g. if we ended up here via `fetch(ids=some_folder.filter(...))`. In
         # that case, we want to use its iterator. Otherwise, peek() will start a count() which is wasteful because we
@@ -418,14 +442,70 @@ class Account(object):
                 assert field_path.field in allowed_fields
         else:
             only_fields = {FieldPath(field=f) for f in validation_folder.allowed_fields()}
-        for i in GetItem(account=self).call(items=ids, additional_fields=only_fields):
+
+        def get_items():
+            return GetItem(account=self).call(items=ids, additional_fields=only_fields)
+        for i in trace_iter(BULK_CALL % 'fetch', get_items, protocol=self.protocol, account=self.primary_smtp_address):
             if isinstance(i, Exception):
                 yield i
             else:
-                item = validation_folder.item_model_from_tag(i.tag).from_xml(elem=i, account=self)
+                item = validation_folder.item_model_from_tag(i.tag).from_xml(elem=i, account=self, lazy=lazy)
                 item.folder = folder
                 yield item
 
+    def subscribe_to_pull(self, folders, event_types=EVENT_TYPES, watermark=None, timeout=60):
+        """
+        Creates a pull subscription for events in 'folders'. Poll for events with get_events(). The subscription expires
+        if get_events() isn't called within 'timeout' minutes.
+
+        :return: a (subscription_id, watermark) tuple
+        """
+        res = list(Subscribe(account=self).call(folders=folders, event_types=event_types, watermark=watermark,
+                                                timeout=timeout, streaming=False))
+        assert len(res) == 1
+        if isinstance(res[0], Exception):
+            raise res[0]
+        return res[0]
+
+    def subscribe_to_streaming(self, folders, event_types=EVENT_TYPES):
+        """
+        Creates a streaming subscription for events in 'folders'. Use a StreamingDispatcher to receive the events.
+
+        :return: the subscription ID
+        """
+        res = list(Subscribe(account=self).call(folders=folders, event_types=event_types, watermark=None,
+                                                timeout=None, streaming=True))
+        assert len(res) == 1
+        if isinstance(res[0], Exception):
+            raise res[0]
+        subscription_id, _ = res[0]
+        return subscription_id
+
+    def get_events(self, subscription_id, watermark):
+        """
+        Returns the events of a pull subscription since 'watermark'. Each event has a 'watermark' attribute. Continue
+        polling from the watermark of the last event returned.
+        """
+        while True:
+            res = list(GetEvents(account=self).call(subscription_id=subscription_id, watermark=watermark))
+            assert len(res) == 1
+            if isinstance(res[0], Exception):
+                raise res[0]
+            notification = res[0]
+            more_events = get_xml_attr(notification, '{%s}MoreEvents' % TNS) == 'true'
+            for event in events_from_xml(notification, account=self):
+                watermark = event.watermark
+                yield event
+            if not more_events:
+                break
+
+    def unsubscribe(self, subscription_id):
+        # Cancels a pull or streaming subscription
+        res = list(Unsubscribe(account=self).call(subscription_id=subscription_id))
+        assert len(res) == 1
+        if isinstance(res[0], Exception):
+            raise res[0]
+
     def __str__(self):
         txt = '%s' % self.primary_smtp_address
         if self.fullname:
@@ -21,7 +21,6 @@ import tempfile
 from threading import Lock
 
 import dns.resolver
-from future.moves.queue import LifoQueue
 import requests.exceptions
 from future.utils import raise_from, PY2, python_2_unicode_compatible
 from six import text_type
@@ -483,9 +482,7 @@ class AutodiscoverProtocol(BaseProtocol):
 
     def __init__(self, *args, **kwargs):
         super(AutodiscoverProtocol, self).__init__(*args, **kwargs)
-        self._session_pool = LifoQueue(maxsize=self.SESSION_POOLSIZE)
-        for _ in range(self.SESSION_POOLSIZE):
-            self._session_pool.put(self.create_session(), block=False)
+        self._session_pool = self._create_session_pool()
 
     def __str__(self):
         return '''\
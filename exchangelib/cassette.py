@@ -0,0 +1,242 @@
+# coding=utf-8
+"""
+Record the HTTP traffic of a Protocol to a cassette file, and replay it later without a server. This makes it possible
+to reproduce a performance problem with the exact sequence of responses the server sent, and to benchmark parsing,
+paging and bulk pooling offline and repeatably.
+
+Recording and replaying both work by replacing the sessions in the session pool of a protocol:
+
+    from exchangelib.cassette import Cassette, Recorder, Replayer
+
+    cassette = Cassette()
+    account.protocol.set_session_factory(Recorder(cassette))
+    # Your code using exchangelib goes here
+    account.protocol.set_session_factory(None)
+    cassette.save('traffic.json')
+
+    # Later, maybe on another machine. Supply 'version' and 'auth_type' so the protocol does not contact the server.
+    protocol.set_session_factory(Replayer(Cassette.load('traffic.json'), realtime=False))
+    # Run the same code again
+
+Authentication headers, cookies and the impersonated user are redacted before they are recorded. Compressed request
+bodies are recorded uncompressed, so they can be redacted. Responses to streaming requests (GetStreamingEvents) are not
+recorded, because they are read as they arrive.
+"""
+from __future__ import unicode_literals
+
+import base64
+from collections import deque
+import datetime
+import io
+import json
+import logging
+import random
+import re
+from threading import Lock
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from future.moves.urllib.parse import urlparse
+from six import text_type
+
+from .protocol import EWSSession
+from .util import time_func, gzip_decompress
+from .wirelog import redact_headers, redact_body
+
+log = logging.getLogger(__name__)
+
+# The name of the service in a SOAP request, e.g. 'GetItem'
+_service_RE = re.compile(br'<s:Body>\s*<m:(\w+)')
+
+
+def _get_service(data):
+    match = _service_RE.search(data or b'')
+    return match.group(1).decode('ascii') if match else None
+
+
+def _path(url):
+    # Recorded requests are matched on the path of the URL, so the server name and port may change between recordings
+    return urlparse(url).path
+
+
+def _to_bytes(data):
+    if data is None:
+        return b''
+    if isinstance(data, bytes):
+        return data
+    return data.encode('utf-8')
+
+
+def _request_body(headers, data):
+    # Returns the request body as bytes. Compressed bodies are decompressed, so they can be redacted and matched.
+    data = _to_bytes(data)
+    if CaseInsensitiveDict(headers or {}).get('Content-Encoding') == 'gzip':
+        data = gzip_decompress(data)
+    return data
+
+
+def _encode_body(body):
+    # Store bodies as text when possible, to keep cassettes readable
+    try:
+        return {'body': body.decode('utf-8')}
+    except UnicodeDecodeError:
+        return {'body_base64': base64.b64encode(body).decode('ascii')}
+
+
+def _decode_body(d):
+    if 'body_base64' in d:
+        return base64.b64decode(d['body_base64'])
+    return d['body'].encode('utf-8')
+
+
+class Cassette(object):
+    """
+    A recorded sequence of HTTP requests and responses. Thread-safe.
+    """
+    FORMAT_VERSION = 1
+
+    def __init__(self, interactions=None):
+        self.interactions = interactions or []
+        self._lock = Lock()
+
+    def add(self, url, request_headers, request_data, response, elapsed):
+        request_data = redact_body(_request_body(request_headers, request_data))
+        # The body is recorded uncompressed
+        request_headers = {k: v for k, v in (request_headers or {}).items() if k.lower() != 'content-encoding'}
+        request = dict(url=url, headers=redact_headers(request_headers))
+        request.update(_encode_body(request_data))
+        recorded_response = dict(status_code=response.status_code, reason=response.reason,
+                                 headers=redact_headers(response.headers))
+        recorded_response.update(_encode_body(response.content))
+        interaction = dict(service=_get_service(request_data), elapsed=elapsed, request=request,
+                           response=recorded_response)
+        with self._lock:
+            self.interactions.append(interaction)
+
+    def __len__(self):
+        return len(self.interactions)
+
+    def save(self, filename):
+        with self._lock:
+            data = dict(version=self.FORMAT_VERSION, interactions=self.interactions)
+            with io.open(filename, 'w', encoding='utf-8') as f:
+                f.write(text_type(json.dumps(data, indent=1, sort_keys=True)))
+
+    @classmethod
+    def load(cls, filename):
+        with io.open(filename, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != cls.FORMAT_VERSION:
+            raise ValueError('Unsupported cassette version %s in %s' % (data.get('version'), filename))
+        return cls(interactions=data['interactions'])
+
+
+class RecordingSession(EWSSession):
+    """
+    A normal HTTP session that also adds each request and response to a cassette
+    """
+    cassette = None
+
+    def post(self, url, data=None, json=None, **kwargs):
+        t1 = time_func()
+        r = super(RecordingSession, self).post(url, data=data, json=json, **kwargs)
+        if not kwargs.get('stream'):
+            self.cassette.add(url=url, request_headers=kwargs.get('headers'), request_data=data, response=r,
+                              elapsed=time_func() - t1)
+        return r
+
+
+class Recorder(object):
+    """
+    A session factory for Protocol.set_session_factory() that records all requests and responses to 'cassette'
+    """
+    def __init__(self, cassette):
+        self.cassette = cassette
+
+    def __call__(self, protocol):
+        session = protocol.create_http_session(session_cls=RecordingSession)
+        session.cassette = self.cassette
+        return session
+
+
+class ReplaySession(object):
+    """
+    Stands in for an EWSSession. Returns recorded responses instead of sending requests.
+    """
+    def __init__(self, protocol, replayer):
+        self.session_id = random.randint(1, 32767)  # Used for debugging messages in services
+        self.protocol = protocol
+        self.replayer = replayer
+        self.auth = None
+        self.headers = {}
+
+    def post(self, url, data=None, headers=None, **kwargs):
+        return self.replayer.get_response(url=url, headers=headers, data=data)
+
+    def close_socket(self, url):
+        pass
+
+    def close(self):
+        pass
+
+
+class Replayer(object):
+    """
+    A session factory for Protocol.set_session_factory() that serves the responses in 'cassette'.
+
+    Each recorded response is served once. A request is matched with the first unused recording of a request with the
+    same URL path and body. If there is none, e.g. because the body contains a timestamp, it's matched with the first
+    unused recording of a request to the same service. If 'realtime' is True, each response takes as long as it did
+    when it was recorded. Otherwise, responses are served as fast as possible.
+    """
+    def __init__(self, cassette, realtime=False):
+        self.realtime = realtime
+        self._lock = Lock()
+        self._used = set()
+        self._by_body = {}
+        self._by_service = {}
+        for i, interaction in enumerate(cassette.interactions):
+            path = _path(interaction['request']['url'])
+            body = _decode_body(interaction['request'])
+            self._by_body.setdefault((path, body), deque()).append((i, interaction))
+            self._by_service.setdefault((path, interaction['service']), deque()).append((i, interaction))
+        self.remaining = len(cassette.interactions)
+
+    def __call__(self, protocol):
+        return ReplaySession(protocol=protocol, replayer=self)
+
+    def _pop(self, candidates):
+        while candidates:
+            i, interaction = candidates.popleft()
+            if i not in self._used:
+                self._used.add(i)
+                self.remaining -= 1
+                return interaction
+        return None
+
+    def get_interaction(self, url, data, headers=None):
+        path, data = _path(url), redact_body(_request_body(headers, data))
+        with self._lock:
+            interaction = self._pop(self._by_body.get((path, data), ()))
+            if interaction is None:
+                interaction = self._pop(self._by_service.get((path, _get_service(data)), ()))
+        if interaction is None:
+            raise ValueError('No unused recording of a %s request to %s' % (_get_service(data), url))
+        return interaction
+
+    def get_response(self, url, headers, data):
+        interaction = self.get_interaction(url=url, data=data, headers=headers)
+        if self.realtime:
+            time.sleep(interaction['elapsed'])
+        recorded = interaction['response']
+        r = requests.Response()
+        r.status_code = recorded['status_code']
+        r.reason = recorded['reason']
+        r.headers = CaseInsensitiveDict(recorded['headers'])
+        r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+        r.raw = io.BytesIO(_decode_body(recorded))
+        r.url = url
+        r.elapsed = datetime.timedelta(seconds=interaction['elapsed'])
+        r.request = requests.Request('POST', url, headers=headers, data=data).prepare()
+        return r
@@ -0,0 +1,193 @@
+# coding=utf-8
+"""
+Run the same operation for many accounts, e.g. a nightly sweep over thousands of impersonated mailboxes, with a global
+limit on the number of concurrent operations, a limit per mailbox and round-robin scheduling between mailboxes:
+
+    from exchangelib.fanout import map_accounts
+
+    def count_unread(account):
+        return account.inbox.filter(is_read=False).count()
+
+    for account, result in map_accounts(accounts, count_unread, max_workers=8):
+        if isinstance(result, Exception):
+            print('Failed for %s: %s' % (account, result))
+        else:
+            print('%s has %s unread messages' % (account, result))
+
+Results are returned as soon as they are ready, not in the order of 'accounts'. Exceptions are returned in place of
+results, like the bulk methods on Account do.
+
+The work runs in threads owned by the executor, not in the thread pool of the protocol, so the work may use methods
+that use the thread pool, like the bulk methods and Calendar.view(). All accounts that share a protocol also share its
+session pool, so 'max_workers' higher than Protocol.SESSION_POOLSIZE mostly adds threads that wait for a session.
+"""
+from __future__ import unicode_literals
+
+from collections import deque
+import logging
+from threading import Thread, Condition
+
+from future.moves.queue import Queue
+
+from .protocol import BaseProtocol
+from .tracing import propagate_context
+
+log = logging.getLogger(__name__)
+
+
+class FanOut(object):
+    """
+    Runs tasks for many accounts in a fixed number of threads. Each account has its own queue of tasks. Threads take
+    tasks from the accounts in turn, so an account with many tasks doesn't delay the tasks of other accounts, and never
+    run more than 'max_per_account' tasks for the same account at a time. Accounts are identified by their primary SMTP
+    address.
+
+    Example:
+        fan_out = FanOut(max_workers=8)
+        for account in accounts:
+            for folder in account.root.get_folders():
+                fan_out.submit(account, folder.all().count)
+        for _ in range(fan_out.pending):
+            account, result = fan_out.get_result()
+        fan_out.close()
+    """
+    def __init__(self, max_workers=None, max_per_account=1):
+        """
+        :param max_workers: the maximum number of tasks that run at the same time. Defaults to
+               BaseProtocol.SESSION_POOLSIZE.
+        :param max_per_account: the maximum number of tasks that run at the same time for the same account
+        """
+        self.max_workers = max_workers or BaseProtocol.SESSION_POOLSIZE
+        assert self.max_workers >= 1
+        assert max_per_account >= 1
+        self.max_per_account = max_per_account
+        self._cond = Condition()
+        self._tasks = {}  # Account key -> deque of tasks that are not started yet
+        self._running = {}  # Account key -> number of running tasks
+        self._ready = deque()  # Keys of accounts that may start a task now, in turn
+        self._ready_keys = set()
+        self._results = Queue()
+        self._threads = []
+        self._closed = False
+        # The number of submitted tasks whose result has not been returned by get_result() yet
+        self.pending = 0
+
+    @staticmethod
+    def _get_key(account):
+        return account.primary_smtp_address.lower()
+
+    def _mark_ready(self, key):
+        # Must be called with the lock held. Puts the account at the end of the line if it has tasks and may start one.
+        if key in self._ready_keys or not self._tasks.get(key) or self._running.get(key, 0) >= self.max_per_account:
+            return
+        self._ready.append(key)
+        self._ready_keys.add(key)
+        self._cond.notify()
+
+    def submit(self, account, fn, *args, **kwargs):
+        # Schedules fn(*args, **kwargs) to run for 'account'. The result is returned by get_result().
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('This %s is closed' % self.__class__.__name__)
+            key = self._get_key(account)
+            self._tasks.setdefault(key, deque()).append((account, propagate_context(fn), args, kwargs))
+            self.pending += 1
+            self._mark_ready(key)
+            if len(self._threads) < self.max_workers:
+                t = Thread(target=self._work, name='fanout-%s' % len(self._threads))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def _next_task(self):
+        # Returns the next task, or None when the executor is closed
+        with self._cond:
+            while not self._ready:
+                if self._closed:
+                    return None
+                self._cond.wait()
+            key = self._ready.popleft()
+            self._ready_keys.discard(key)
+            task = self._tasks[key].popleft()
+            self._running[key] = self._running.get(key, 0) + 1
+            # Let the other accounts have a go before this account gets another task
+            self._mark_ready(key)
+            return key, task
+
+    def _task_done(self, key):
+        with self._cond:
+            self._running[key] -= 1
+            if self._tasks.get(key):
+                self._mark_ready(key)
+            elif not self._running[key]:
+                # Don't keep empty entries around for all the accounts we have seen
+                self._tasks.pop(key, None)
+                del self._running[key]
+
+    def _work(self):
+        while True:
+            next_task = self._next_task()
+            if next_task is None:
+                return
+            key, (account, fn, args, kwargs) = next_task
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                log.debug('Task for account %s failed: %s', account, e)
+                result = e
+            self._task_done(key)
+            self._results.put((account, result))
+
+    def get_result(self, timeout=None):
+        """
+        Waits for a task to finish and returns an (account, result) tuple. If the task raised an exception, the
+        exception is returned as the result.
+        """
+        res = self._results.get(timeout=timeout)
+        with self._cond:
+            self.pending -= 1
+        return res
+
+    def close(self):
+        # Stops the threads when they have run all tasks that are already started. Tasks that are not started yet are
+        # dropped.
+        with self._cond:
+            self._closed = True
+            self._tasks.clear()
+            self._ready.clear()
+            self._ready_keys.clear()
+            self._cond.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def map_accounts(accounts, fn, max_workers=None, max_per_account=1):
+    """
+    Calls fn(account) for each account in 'accounts' in a FanOut executor and yields (account, result) tuples as the
+    calls finish. If a call raises an exception, the exception is returned as the result.
+
+    'accounts' may be a generator. It is consumed as work is needed, so a long list of accounts can be created lazily.
+    """
+    fan_out = FanOut(max_workers=max_workers, max_per_account=max_per_account)
+    # Keep a few accounts waiting so threads don't idle, but don't consume all of 'accounts' up front
+    max_queued = 2 * fan_out.max_workers
+    accounts = iter(accounts)
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and fan_out.pending < max_queued:
+                try:
+                    account = next(accounts)
+                except StopIteration:
+                    exhausted = True
+                    break
+                fan_out.submit(account, fn, account)
+            if not fan_out.pending:
+                break
+            yield fan_out.get_result()
+    finally:
+        fan_out.close()
@@ -112,16 +112,19 @@ class FieldPath(object):
         return cls(field=field, label=label, subfield=subfield)
 
     def get_value(self, item):
-        # For indexed properties, get either the full property set, the property with matching label, or a particular
-        # subfield.
+        return self.get_field_value(getattr(item, self.field.name))
+
+    def get_field_value(self, value):
+        # Returns the part of 'value', the value of the full field, that this path points to. For indexed properties,
+        # get either the full property set, the property with matching label, or a particular subfield.
         if self.label:
-            for subitem in getattr(item, self.field.name):
+            for subitem in value or ():
                 if subitem.label == self.label:
                     if self.subfield:
                         return getattr(subitem, self.subfield.name)
                     return subitem
             return None  # No item with this label
-        return getattr(item, self.field.name)
+        return value
 
     def to_xml(self):
         if isinstance(self.field, IndexedField):
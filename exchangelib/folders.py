@@ -1,20 +1,23 @@
 # coding=utf-8
 from __future__ import unicode_literals
 
+from collections import defaultdict
+import json
 import logging
+from threading import Lock
 
 from future.utils import python_2_unicode_compatible
 from six import string_types
 
 from .ewsdatetime import EWSDateTime, UTC
-from .fields import IntegerField, TextField, DateTimeField, FieldPath
+from .fields import IntegerField, TextField, DateTimeField, EWSElementField, FieldPath
 from .items import Item, CalendarItem, Contact, Message, Task, MeetingRequest, MeetingResponse, MeetingCancellation, \
-    DistributionList, ITEM_CLASSES, ITEM_TRAVERSAL_CHOICES, SHAPE_CHOICES, IdOnly
+    DistributionList, ITEM_CLASSES, ITEM_TRAVERSAL_CHOICES, SHAPE_CHOICES, SYNC_SCOPE_CHOICES, IdOnly
 from .properties import ItemId, EWSElement
 from .queryset import QuerySet
 from .restriction import Restriction
-from .services import FindFolder, GetFolder, FindItem
-from .transport import MNS
+from .services import FindFolder, GetFolder, FindItem, SyncFolderItems, SyncFolderHierarchy
+from .transport import MNS, TNS
 from .util import create_element, value_to_xml_text
 
 string_type = string_types[0]
@@ -34,6 +37,13 @@ class FolderId(ItemId):
     __slots__ = ItemId.__slots__
 
 
+class ParentFolderId(ItemId):
+    # MSDN: https://msdn.microsoft.com/en-us/library/office/aa494327(v=exchg.150).aspx
+    ELEMENT_NAME = 'ParentFolderId'
+
+    __slots__ = ItemId.__slots__
+
+
 class DistinguishedFolderId(ItemId):
     # MSDN: https://msdn.microsoft.com/en-us/library/office/aa580808(v=exchg.150).aspx
     ELEMENT_NAME = 'DistinguishedFolderId'
@@ -99,6 +109,8 @@ class Folder(EWSElement):
     FIELDS = [
         TextField('folder_id', field_uri='folder:FolderId', is_searchable=False),
         TextField('changekey', field_uri='folder:Changekey', is_searchable=False),
+        EWSElementField('parent_folder_id', field_uri='folder:ParentFolderId', value_cls=ParentFolderId,
+                        is_read_only=True, is_searchable=False),
         TextField('name', field_uri='folder:DisplayName'),
         TextField('folder_class', field_uri='folder:FolderClass'),
         IntegerField('total_count', field_uri='folder:TotalCount', is_read_only=True),
@@ -106,11 +118,12 @@ class Folder(EWSElement):
         IntegerField('child_folder_count', field_uri='folder:ChildFolderCount', is_read_only=True),
     ]
 
-    __slots__ = ('account', 'folder_id', 'changekey', 'name', 'folder_class', 'total_count', 'unread_count',
-                 'child_folder_count')
+    __slots__ = ('account', 'folder_id', 'changekey', 'parent_folder_id', 'name', 'folder_class', 'total_count',
+                 'unread_count', 'child_folder_count', 'item_sync_state')
 
     def __init__(self, **kwargs):
         self.account = kwargs.pop('account', None)
+        self.item_sync_state = kwargs.pop('item_sync_state', None)
         super(Folder, self).__init__(**kwargs)
         # pylint: disable=access-member-before-definition
         if self.name is None:
@@ -222,7 +235,7 @@ class Folder(EWSElement):
         return QuerySet(self).get(*args, **kwargs)
 
     def find_items(self, q, shape=IdOnly, depth=SHALLOW, additional_fields=tuple(), order_fields=None,
-                   calendar_view=None, page_size=None):
+                   calendar_view=None, page_size=None, offset=0, max_items=None, lazy=None):
         """
         Private method to call the FindItem service
 
@@ -234,8 +247,55 @@ class Folder(EWSElement):
         :param order_fields: the SortOrder fields, if any
         :param calendar_view: a CalendarView instance, if any
         :param page_size: the requested number of items per page
+        :param offset: the number of items to skip on the server. Not supported for calendar views.
+        :param max_items: the maximum number of items to return. Not supported for calendar views. Use
+                          CalendarView.max_items instead.
+        :param lazy: one of LAZY_CHOICES to only decode item fields when they are accessed. See Item.from_xml()
         :return: a generator for the returned item IDs or items
         """
+        items = self._find_item_elems(q=q, shape=shape, depth=depth, additional_fields=additional_fields,
+                                      order_fields=order_fields, calendar_view=calendar_view, page_size=page_size,
+                                      offset=offset, max_items=max_items)
+        if shape == IdOnly and additional_fields is None:
+            for i in items:
+                yield i if isinstance(i, Exception) else Item.id_from_xml(i)
+        else:
+            for i in items:
+                if isinstance(i, Exception):
+                    yield i
+                else:
+                    item = self.item_model_from_tag(i.tag).from_xml(elem=i, account=self.account, lazy=lazy)
+                    item.folder = self
+                    yield item
+
+    def find_item_rows(self, q, field_paths, depth=SHALLOW, order_fields=None, calendar_view=None, page_size=None,
+                       offset=0, max_items=None):
+        """
+        Like find_items(), but returns a tuple of values for each item instead of an Item object. The values are in the
+        order of 'field_paths', a list of FieldPath objects that may include the 'item_id' and 'changekey' fields. Only
+        the requested fields are decoded from the XML, so this is much faster than creating items for large results.
+
+        :return: a generator for the returned rows
+        """
+        additional_fields = {f for f in field_paths if f.field.name not in ('item_id', 'changekey')}
+        # Decode each field once per item, even if several field paths point to the same indexed field
+        fields = list({f.field for f in additional_fields})
+        items = self._find_item_elems(q=q, shape=IdOnly, depth=depth, additional_fields=additional_fields or None,
+                                      order_fields=order_fields, calendar_view=calendar_view, page_size=page_size,
+                                      offset=offset, max_items=max_items)
+        for i in items:
+            if isinstance(i, Exception):
+                yield i
+                continue
+            values = dict(zip(('item_id', 'changekey'), Item.id_from_xml(i)))
+            for f in fields:
+                values[f.name] = f.from_xml(elem=i, account=self.account)
+            i.clear()
+            yield tuple(f.get_field_value(values[f.field.name]) for f in field_paths)
+
+    def _find_item_elems(self, q, shape, depth, additional_fields, order_fields, calendar_view, page_size, offset,
+                         max_items):
+        # Calls the FindItem service and returns a generator for the XML elements of the returned items
         assert shape in SHAPE_CHOICES
         assert depth in ITEM_TRAVERSAL_CHOICES
         if additional_fields:
@@ -248,6 +308,7 @@ class Folder(EWSElement):
                     raise ValueError("find_items() does not support field '%s'. Use fetch() instead" % f)
         if calendar_view is not None:
             assert isinstance(calendar_view, CalendarView)
+            assert offset == 0 and max_items is None
         if page_size is None:
             # Set a sane default
             page_size = FindItem.CHUNKSIZE
@@ -272,7 +333,7 @@ class Folder(EWSElement):
             additional_fields,
             restriction.q if restriction else None,
         )
-        items = FindItem(folder=self).call(
+        return FindItem(folder=self).call(
             additional_fields=additional_fields,
             restriction=restriction,
             order_fields=order_fields,
@@ -281,18 +342,70 @@ class Folder(EWSElement):
             depth=depth,
             calendar_view=calendar_view,
             page_size=page_size,
+            offset=offset,
+            max_items=max_items,
         )
-        if shape == IdOnly and additional_fields is None:
-            for i in items:
-                yield i if isinstance(i, Exception) else Item.id_from_xml(i)
-        else:
-            for i in items:
-                if isinstance(i, Exception):
-                    yield i
-                else:
-                    item = self.item_model_from_tag(i.tag).from_xml(elem=i, account=self.account)
+
+    def sync_items(self, sync_state=None, only_fields=None, ignore=None, max_changes_returned=None,
+                   sync_scope=None):
+        """
+        Get the changes to items in this folder since 'sync_state', using the SyncFolderItems service. This is much
+        cheaper than a full FindItem scan when only a few items have changed. With sync_state=None, all items in the
+        folder are returned as CREATE changes.
+
+        The new sync state is available in self.item_sync_state. It is updated every time a page of changes has been
+        consumed, so it's safe to persist it at any point while iterating, and pass it to the next sync_items() call.
+
+        :param sync_state: the sync state from a previous sync, or None to start a full sync
+        :param only_fields: the names of the fields to return on created and updated items. Default is only the ID
+        :param ignore: a list of (id, changekey) tuples or Item objects to ignore changes for
+        :param max_changes_returned: the maximum number of changes to get per request
+        :param sync_scope: one of SYNC_SCOPE_CHOICES. Requires Exchange 2010 or later
+        :return: a generator of (change_type, value) tuples. For CREATE and UPDATE changes, value is an Item, or an
+                 (id, changekey) tuple if no only_fields were requested. For DELETE changes, value is an (id, changekey)
+                 tuple. For READ_FLAG_CHANGE changes, value is an ((id, changekey), is_read) tuple.
+        """
+        if sync_scope is not None:
+            assert sync_scope in SYNC_SCOPE_CHOICES
+        if max_changes_returned is None:
+            max_changes_returned = SyncFolderItems.CHUNKSIZE
+        assert isinstance(max_changes_returned, int)
+        additional_fields = None
+        if only_fields:
+            additional_fields = []
+            complex_fields = self.complex_fields()
+            for field_path in only_fields:
+                f = FieldPath.from_string(field_path, folder=self)
+                if f.field.name in ('item_id', 'changekey'):
+                    continue
+                if f.field in complex_fields:
+                    raise ValueError("sync_items() does not support field '%s'. Use fetch() instead" % f)
+                additional_fields.append(f)
+        svc = SyncFolderItems(folder=self)
+        log.debug('Syncing items in %s for %s (sync_state: %s)', self, self.account, sync_state)
+        self.item_sync_state = sync_state
+        for change_type, elem in svc.call(
+                additional_fields=additional_fields,
+                sync_state=sync_state,
+                ignore=ignore,
+                max_changes_returned=max_changes_returned,
+                sync_scope=sync_scope,
+        ):
+            # svc.sync_state covers all the changes we have already handed out
+            self.item_sync_state = svc.sync_state
+            if change_type in (svc.CREATE, svc.UPDATE):
+                if additional_fields:
+                    item = self.item_model_from_tag(elem.tag).from_xml(elem=elem, account=self.account)
                     item.folder = self
-                    yield item
+                    yield change_type, item
+                else:
+                    yield change_type, Item.id_from_xml(elem)
+            elif change_type == svc.DELETE:
+                yield change_type, Item.id_from_xml(elem)
+            else:
+                is_read = elem.find('{%s}IsRead' % TNS).text.lower() in ('true', '1')
+                yield change_type, (Item.id_from_xml(elem), is_read)
+        self.item_sync_state = svc.sync_state
 
     def bulk_create(self, items, *args, **kwargs):
         return self.account.bulk_create(folder=self, items=items, *args, **kwargs)
@@ -352,39 +465,53 @@ class Folder(EWSElement):
                 page_size=100,
         ):
             # TODO: Support the Restriction class for folders, too
-            # The "FolderClass" element value is the only indication we have in the FindFolder response of which
-            # folder class we should create the folder with.
-            #
-            # We should be able to just use the name, but apparently default folder names can be renamed to a set of
-            # localized names using a PowerShell command:
-            #     https://technet.microsoft.com/da-dk/library/dd351103(v=exchg.160).aspx
-            #
-            # Instead, search for a folder class using the localized name. If none are found, fall back to getting the
-            # folder class by the "FolderClass" value.
-            #
-            # TODO: fld_class.LOCALIZED_NAMES is most definitely neither complete nor authoritative
             if isinstance(elem, Exception):
                 yield elem
                 continue
-            dummy_fld = Folder.from_xml(elem=elem, account=self.account)  # We use from_xml() only to parse elem
-            try:
-                folder_cls = self.folder_cls_from_folder_name(folder_name=dummy_fld.name, locale=self.account.locale)
-                log.debug('Folder class %s matches localized folder name %s', folder_cls, dummy_fld.name)
-            except KeyError:
-                folder_cls = self.folder_cls_from_container_class(dummy_fld.folder_class)
-                log.debug('Folder class %s matches container class %s (%s)', folder_cls, dummy_fld.folder_class,
-                          dummy_fld.name)
-            yield folder_cls(account=self.account, **{f.name: getattr(dummy_fld, f.name) for f in folder_cls.FIELDS})
+            yield self.folder_from_xml(elem=elem, account=self.account)
+
+    @staticmethod
+    def folder_from_xml(elem, account):
+        # The "FolderClass" element value is the only indication we have in the FindFolder and SyncFolderHierarchy
+        # responses of which folder class we should create the folder with.
+        #
+        # We should be able to just use the name, but apparently default folder names can be renamed to a set of
+        # localized names using a PowerShell command:
+        #     https://technet.microsoft.com/da-dk/library/dd351103(v=exchg.160).aspx
+        #
+        # Instead, search for a folder class using the localized name. If none are found, fall back to getting the
+        # folder class by the "FolderClass" value.
+        #
+        # TODO: fld_class.LOCALIZED_NAMES is most definitely neither complete nor authoritative
+        dummy_fld = Folder.from_xml(elem=elem, account=account)  # We use from_xml() only to parse elem
+        try:
+            folder_cls = Folder.folder_cls_from_folder_name(folder_name=dummy_fld.name, locale=account.locale)
+            log.debug('Folder class %s matches localized folder name %s', folder_cls, dummy_fld.name)
+        except KeyError:
+            folder_cls = Folder.folder_cls_from_container_class(dummy_fld.folder_class)
+            log.debug('Folder class %s matches container class %s (%s)', folder_cls, dummy_fld.folder_class,
+                      dummy_fld.name)
+        return folder_cls(account=account, **{f.name: getattr(dummy_fld, f.name) for f in folder_cls.FIELDS})
 
     def get_folder_by_name(self, name):
         """Takes a case-sensitive folder name and returns an instance of that folder, if a folder with that name exists
         as a direct or indirect subfolder of this folder.
         """
         assert isinstance(name, string_types)
-        matching_folders = []
-        for f in self.get_folders(depth=DEEP):
-            if f.name == name:
-                matching_folders.append(f)
+        if not self.account:
+            raise ValueError('Folder must have an account')
+        # Only use the folder tree if it has already been built. Building it just for this lookup would fetch all
+        # folders of the account, and the folder may not even be in the tree.
+        tree = vars(self.account).get('folder_tree')
+        if tree is not None and self.folder_id in tree:
+            # Use the cached folder tree instead of scanning all subfolders
+            matching_folders = tree.get_subfolders_by_name(folder=self, name=name)
+            if not matching_folders:
+                # The folder may have been created since the tree was last refreshed
+                tree.refresh()
+                matching_folders = tree.get_subfolders_by_name(folder=self, name=name)
+        else:
+            matching_folders = [f for f in self.get_folders(depth=DEEP) if f.name == name]
         if not matching_folders:
             raise ValueError('No subfolders found with name %s' % name)
         if len(matching_folders) > 1:
@@ -480,6 +607,11 @@ class Calendar(Folder):
         EWS does not allow combining CalendarView with search restrictions (filter and exclude).
 
         'max_items' defines the maximum number of items returned in this view. Optional.
+
+        EWS does not page calendar views and refuses to return views with too many items. Views longer than
+        FindItem.CALENDAR_VIEW_WINDOW are therefore fetched as a series of shorter windows, in parallel, unless
+        'max_items' is set. Windows with too many items are split again. Occurrences overlapping more than one window
+        are only returned once.
         """
         qs = QuerySet(self).filter(*args, **kwargs)
         qs.calendar_view = CalendarView(start=start, end=end, max_items=max_items)
@@ -701,3 +833,178 @@ WELLKNOWN_FOLDERS = dict([
     ('ToDoSearch', WellknownFolder),
     ('', GenericFolder),
 ])
+
+
+class FolderTree(object):
+    """
+    A cache of the folder hierarchy below a folder (usually the root folder of an account), kept up to date with the
+    SyncFolderHierarchy service. The first refresh() fetches all folders. Later calls only fetch the changes since the
+    last refresh.
+
+    Folders are indexed by ID, parent folder ID, name and path, so lookups don't need to traverse the tree. A path is a
+    tuple of folder names starting below the root folder, e.g. ('Top of Information Store', 'Inbox'), or the same names
+    joined with '/'.
+
+    The tree can be saved to a file with save() and loaded again with load(), so the next process only needs to fetch
+    the changes since the tree was saved. The file contains no credentials.
+    """
+    def __init__(self, account, root=None):
+        self.account = account
+        self.root = root or account.root
+        if not self.root.folder_id:
+            raise ValueError('Root folder must have an ID')
+        self.sync_state = None
+        self._folders = {self.root.folder_id: self.root}  # Maps folder ID to folder
+        self._children = defaultdict(set)  # Maps folder ID to the set of IDs of its child folders
+        self._ids_by_name = defaultdict(set)  # Maps folder name to a set of folder IDs
+        self._ids_by_path = {tuple(): self.root.folder_id}  # Maps path tuples to folder ID
+        self._paths = {self.root.folder_id: tuple()}  # Maps folder ID to path tuple
+        self._lock = Lock()
+        self.generation = 0  # Increased on every change to the tree, so users of the tree can tell that it changed
+
+    def refresh(self):
+        # Fetch the changes since the last refresh and apply them to the tree
+        additional_fields = [FieldPath(field=f) for f in Folder.supported_fields(version=self.account.version)]
+        with self._lock:
+            svc = SyncFolderHierarchy(folder=self.root)
+            for change_type, elem in svc.call(
+                    additional_fields=additional_fields,
+                    shape=IdOnly,
+                    sync_state=self.sync_state,
+            ):
+                if change_type in (svc.CREATE, svc.UPDATE):
+                    self._add(Folder.folder_from_xml(elem=elem, account=self.account))
+                elif change_type == svc.DELETE:
+                    self._remove(elem.find(FolderId.response_tag()).get(FolderId.ID_ATTR))
+                # Changes on a page are only handed out after the previous page was fully consumed
+                self.sync_state = svc.sync_state
+            self.sync_state = svc.sync_state
+        return self
+
+    def _add(self, folder):
+        # Adds a new folder or replaces an existing folder with the same ID
+        if folder.folder_id == self.root.folder_id:
+            return
+        if folder.folder_id in self._folders:
+            self._remove(folder.folder_id, remove_children=False)
+        self._folders[folder.folder_id] = folder
+        self.generation += 1
+        self._children[self._parent_id(folder)].add(folder.folder_id)
+        if self._parent_id(folder) in self._paths:
+            self._index(folder.folder_id)
+        # Else, the parent folder hasn't arrived yet. We will index this folder when the parent folder is added
+
+    def _parent_id(self, folder):
+        # The server should always tell us the parent folder. Fall back to the root folder, just in case.
+        if folder.parent_folder_id is None:
+            return self.root.folder_id
+        return folder.parent_folder_id.id
+
+    def _remove(self, folder_id, remove_children=True):
+        folder = self._folders.get(folder_id)
+        if folder is None:
+            return
+        self._unindex(folder_id)
+        self._children[self._parent_id(folder)].discard(folder_id)
+        del self._folders[folder_id]
+        self.generation += 1
+        if remove_children:
+            for child_id in list(self._children.get(folder_id, ())):
+                self._remove(child_id)
+            self._children.pop(folder_id, None)
+
+    def _index(self, folder_id):
+        # Indexes a folder and all its subfolders by name and path. The parent folder must already be indexed.
+        folder = self._folders[folder_id]
+        path = self._paths[self._parent_id(folder)] + (folder.name,)
+        self._paths[folder_id] = path
+        self._ids_by_path[path] = folder_id
+        self._ids_by_name[folder.name].add(folder_id)
+        for child_id in self._children.get(folder_id, ()):
+            self._index(child_id)
+
+    def _unindex(self, folder_id):
+        # Removes a folder and all its subfolders from the name and path indexes
+        path = self._paths.pop(folder_id, None)
+        if path is None:
+            return
+        if self._ids_by_path.get(path) == folder_id:
+            del self._ids_by_path[path]
+        self._ids_by_name[self._folders[folder_id].name].discard(folder_id)
+        for child_id in self._children.get(folder_id, ()):
+            self._unindex(child_id)
+
+    def get(self, folder_id):
+        return self._folders[folder_id]
+
+    def get_folder_by_path(self, path):
+        if isinstance(path, string_types):
+            path = tuple(p for p in path.split('/') if p)
+        return self._folders[self._ids_by_path[tuple(path)]]
+
+    def get_folders_by_name(self, name):
+        return [self._folders[folder_id] for folder_id in self._ids_by_name.get(name, ())]
+
+    def get_subfolders_by_name(self, folder, name):
+        # Returns the folders with this name that are direct or indirect subfolders of 'folder'
+        path = self._paths[folder.folder_id]
+        return [f for f in self.get_folders_by_name(name) if self._paths[f.folder_id][:len(path)] == path
+                and f.folder_id != folder.folder_id]
+
+    def get_path(self, folder):
+        return '/'.join(self._paths[folder.folder_id])
+
+    def get_children(self, folder):
+        return [self._folders[folder_id] for folder_id in self._children.get(folder.folder_id, ())]
+
+    def walk(self, folder=None):
+        # Returns all subfolders of 'folder', or of the root folder, depth-first
+        for child in self.get_children(folder or self.root):
+            yield child
+            for f in self.walk(child):
+                yield f
+
+    def __contains__(self, folder_id):
+        return folder_id in self._folders
+
+    def __iter__(self):
+        # Iterate over all folders except the root folder, in no particular order
+        return (f for f in self._folders.values() if f is not self.root)
+
+    def __len__(self):
+        return len(self._folders) - 1
+
+    def save(self, filename):
+        # Saves the tree and the sync state to a JSON file. We only save the info needed to recreate the folders.
+        fields = [f for f in Folder.FIELDS if f.name not in ('folder_id', 'changekey', 'parent_folder_id')]
+        with self._lock:
+            data = dict(
+                sync_state=self.sync_state,
+                root=[self.root.__class__.__name__, self.root.folder_id, self.root.changekey],
+                folders=[
+                    [f.__class__.__name__, f.folder_id, f.changekey, self._parent_id(f),
+                     f.parent_folder_id.changekey if f.parent_folder_id else None,
+                     {field.name: getattr(f, field.name) for field in fields}]
+                    for f in self._folders.values() if f is not self.root
+                ],
+            )
+        with open(filename, 'w') as f:
+            json.dump(data, f)
+
+    @classmethod
+    def load(cls, account, filename):
+        # Loads a tree saved with save(). Call refresh() to get any changes since the tree was saved.
+        with open(filename) as f:
+            data = json.load(f)
+        folder_classes = {c.__name__: c for c in set(WELLKNOWN_FOLDERS.values()) | {Folder, Messages}}
+        root_cls, root_id, root_changekey = data['root']
+        tree = cls(account=account, root=folder_classes[root_cls](
+            account=account, folder_id=root_id, changekey=root_changekey
+        ))
+        for cls_name, folder_id, changekey, parent_id, parent_changekey, kwargs in data['folders']:
+            tree._add(folder_classes[cls_name](
+                account=account, folder_id=folder_id, changekey=changekey,
+                parent_folder_id=ParentFolderId(parent_id, parent_changekey), **kwargs
+            ))
+        tree.sync_state = data['sync_state']
+        return tree
@@ -3,7 +3,7 @@ from __future__ import unicode_literals
 import logging
 from decimal import Decimal
 
-from future.utils import python_2_unicode_compatible
+from future.utils import python_2_unicode_compatible, with_metaclass
 from six import string_types
 
 from .ewsdatetime import UTC_NOW
@@ -63,6 +63,11 @@ SOFT_DELETED = 'SoftDeleted'
 ASSOCIATED = 'Associated'
 ITEM_TRAVERSAL_CHOICES = (SHALLOW, SOFT_DELETED, ASSOCIATED)
 
+# Sync scope enums
+NORMAL_ITEMS = 'NormalItems'
+NORMAL_AND_ASSOCIATED_ITEMS = 'NormalAndAssociatedItems'
+SYNC_SCOPE_CHOICES = (NORMAL_ITEMS, NORMAL_AND_ASSOCIATED_ITEMS)
+
 # Shape enums
 IdOnly = 'IdOnly'
 # AllProperties doesn't actually get all properties in FindItem, just the "first-class" ones. See
@@ -70,8 +75,82 @@ IdOnly = 'IdOnly'
 AllProperties = 'AllProperties'
 SHAPE_CHOICES = (IdOnly, AllProperties)
 
+# Lazy decoding modes for Item.from_xml(). LAZY_PER_FIELD decodes each field when it is first accessed. LAZY_PER_ITEM
+# decodes all fields of an item when any field is first accessed.
+LAZY_PER_FIELD = 'PerField'
+LAZY_PER_ITEM = 'PerItem'
+LAZY_CHOICES = (LAZY_PER_FIELD, LAZY_PER_ITEM)
+
+
+class ExtendedPropertyDescriptor(object):
+    """
+    Exposes an extended property of an item as a normal attribute. Values are kept in a small dict on the item that is
+    only created when an extended property has a value, so the many items without extended properties don't pay for
+    them. The dict is replaced instead of changed, so shallow copies of an item don't share changes.
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        extended_properties = getattr(instance, '_extended_properties', None)
+        if extended_properties is not None and self.name in extended_properties:
+            return extended_properties[self.name]
+        if instance._is_pending(self.name):
+            instance._decode_pending(self.name)
+            return self.__get__(instance, owner)
+        return None
+
+    def __set__(self, instance, value):
+        if instance._is_pending(self.name):
+            instance._discard_pending(self.name)
+        extended_properties = getattr(instance, '_extended_properties', None)
+        if value is None:
+            if extended_properties and self.name in extended_properties:
+                extended_properties = {k: v for k, v in extended_properties.items() if k != self.name}
+                instance._extended_properties = extended_properties or None
+            return
+        extended_properties = dict(extended_properties or ())
+        extended_properties[self.name] = value
+        instance._extended_properties = extended_properties
+
+    def __delete__(self, instance):
+        self.__set__(instance, None)
+
+
+class ItemMeta(type(EWSElement)):
+    """
+    Generates __slots__ for the fields that each item class adds to FIELDS, so items don't need a __dict__. Extended
+    properties are stored by ExtendedPropertyDescriptor instead, because they can be registered after the class is
+    created.
 
-class Item(EWSElement):
+    Subclasses outside this package that define neither FIELDS nor __slots__ keep their __dict__, so they can still
+    store arbitrary attributes on their items.
+    """
+    def __new__(mcs, name, bases, kwargs):
+        for f in kwargs.get('FIELDS', ()):
+            if isinstance(f, ExtendedPropertyField):
+                kwargs[f.name] = ExtendedPropertyDescriptor(f.name)
+        if '__slots__' not in kwargs and 'FIELDS' not in kwargs \
+                and kwargs.get('__module__', '').split('.')[0] != __name__.split('.')[0]:
+            return super(ItemMeta, mcs).__new__(mcs, name, bases, kwargs)
+        inherited = set()
+        for base in bases:
+            for c in base.__mro__:
+                inherited.update(c.__dict__.get('__slots__', ()))
+        slots = []
+        for slot in tuple(kwargs.get('__slots__', ())) + tuple(
+                f.name for f in kwargs.get('FIELDS', ()) if not isinstance(f, ExtendedPropertyField)):
+            if slot not in inherited and slot not in slots:
+                slots.append(slot)
+        kwargs['__slots__'] = tuple(slots)
+        return super(ItemMeta, mcs).__new__(mcs, name, bases, kwargs)
+
+
+class Item(with_metaclass(ItemMeta, EWSElement)):
     ELEMENT_NAME = 'Item'
 
     # FIELDS is an ordered list of attributes supported by this item class. Not all possible attributes are
@@ -114,7 +193,8 @@ class Item(EWSElement):
                         is_read_only=True),
     ]
 
-    # We can't use __slots__ because we need to add extended properties dynamically
+    # Slots for the fields are added by ItemMeta
+    __slots__ = ('account', 'folder', '_extended_properties', '_lazy')
 
     def __init__(self, **kwargs):
         # 'account' is optional but allows calling 'send()' and 'delete()'
@@ -122,6 +202,8 @@ class Item(EWSElement):
         # we use folder.account.
         from .folders import Folder
         from .account import Account
+        self._extended_properties = None
+        self._lazy = None
         self.account = kwargs.pop('account', None)
         if self.account is not None:
             assert isinstance(self.account, Account)
@@ -325,13 +407,124 @@ class Item(EWSElement):
         return id_elem.get(ItemId.ID_ATTR), id_elem.get(ItemId.CHANGEKEY_ATTR)
 
     @classmethod
-    def from_xml(cls, elem, account):
+    def from_xml(cls, elem, account, lazy=None):
+        """
+        Creates an item from its XML element. If 'lazy' is one of LAZY_CHOICES, the item keeps the element and only
+        decodes fields when they are first accessed, so callers don't pay for decoding fields they never read, like
+        bodies, MIME content and attendee lists. The element is released when all fields have been decoded.
+        """
         assert elem.tag == cls.response_tag(), (cls, elem.tag, cls.response_tag())
         item_id, changekey = cls.id_from_xml(elem=elem)
+        if lazy is not None:
+            assert lazy in LAZY_CHOICES
+            # Field slots stay empty until the field is decoded by __getattr__() or ExtendedPropertyDescriptor
+            item = cls.__new__(cls)
+            item.account = account
+            item.folder = None
+            item._extended_properties = None
+            item._lazy = (elem, lazy, cls._lazy_fieldnames())
+            item.item_id = item_id
+            item.changekey = changekey
+            return item
         kwargs = {f.name: f.from_xml(elem=elem, account=account) for f in cls.supported_fields()}
         elem.clear()
         return cls(account=account, item_id=item_id, changekey=changekey, **kwargs)
 
+    @classmethod
+    def _lazy_fieldnames(cls):
+        # The names of the fields that a lazy item starts out with pending. Computed once per class and shared by all
+        # lazy items of the class. register() and deregister() invalidate it.
+        fieldnames = cls.__dict__.get('_lazy_fieldnames_cache')
+        if fieldnames is None:
+            fieldnames = frozenset(f.name for f in cls.supported_fields())
+            cls._lazy_fieldnames_cache = fieldnames
+        return fieldnames
+
+    @classmethod
+    def _invalidate_lazy_fieldnames(cls):
+        # Subclasses that don't define their own FIELDS share the FIELDS list of this class
+        classes = [cls]
+        while classes:
+            c = classes.pop()
+            if '_lazy_fieldnames_cache' in c.__dict__:
+                delattr(c, '_lazy_fieldnames_cache')
+            classes.extend(c.__subclasses__())
+
+    def __copy__(self):
+        # The default copy reads every slot, which would decode all pending fields of a lazy item. Only copy the slots
+        # that have values. '_lazy' is an immutable tuple, so the copy can share it.
+        cls = self.__class__
+        new_item = cls.__new__(cls)
+        for name in cls._slot_names():
+            try:
+                value = object.__getattribute__(self, name)
+            except AttributeError:
+                continue
+            object.__setattr__(new_item, name, value)
+        if hasattr(self, '__dict__'):
+            new_item.__dict__.update(self.__dict__)
+        return new_item
+
+    @classmethod
+    def _slot_names(cls):
+        # The names of all slots of the class, including inherited slots. Slots never change after class creation.
+        slot_names = cls.__dict__.get('_slot_names_cache')
+        if slot_names is None:
+            slot_names = tuple(
+                name for c in cls.__mro__ for name in c.__dict__.get('__slots__', ())
+                if name not in ('__dict__', '__weakref__')
+            )
+            cls._slot_names_cache = slot_names
+        return slot_names
+
+    def __getattr__(self, name):
+        # Only called when normal attribute lookup fails, e.g. for the empty slot of a field that is not decoded yet
+        if self._is_pending(name):
+            self._decode_pending(name)
+            return getattr(self, name)
+        raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
+
+    def _is_pending(self, name):
+        # Returns True if 'name' is a field that is waiting to be decoded lazily
+        if name == '_lazy':
+            return False
+        lazy = getattr(self, '_lazy', None)
+        return lazy is not None and name in lazy[2]
+
+    def _has_value(self, name):
+        # Returns True if the field has been given a value, without decoding it
+        attr = getattr(self.__class__, name)
+        if isinstance(attr, ExtendedPropertyDescriptor):
+            return name in (self._extended_properties or ())
+        try:
+            attr.__get__(self, self.__class__)
+        except AttributeError:
+            return False
+        return True
+
+    def _discard_pending(self, *names):
+        elem, lazy, pending = self._lazy
+        pending = pending.difference(names)
+        # The element may be shared with shallow copies of this item, so don't clear it. Just let go of it.
+        self._lazy = (elem, lazy, pending) if pending else None
+
+    def _decode_pending(self, name):
+        # Decodes 'name', or all pending fields in LAZY_PER_ITEM mode, from the element kept by from_xml()
+        elem, lazy, pending = self._lazy
+        names = pending if lazy == LAZY_PER_ITEM else (name,)
+        self._discard_pending(*names)
+        for n in names:
+            if self._has_value(n):
+                # Set by the user before it was decoded
+                continue
+            value = self.get_field_by_fieldname(n).from_xml(elem=elem, account=self.account)
+            if n == 'attachments':
+                # Like __init__() does
+                value = value or []
+                for a in value:
+                    a.parent_item = self
+            setattr(self, n, value)
+
     @classmethod
     def register(cls, attr_name, attr_cls):
         """
@@ -353,6 +546,8 @@ class Item(EWSElement):
         idx = tuple(f.name for f in cls.FIELDS).index('reminder_minutes_before_start') + 1
         field = ExtendedPropertyField(attr_name, value_cls=attr_cls)
         cls.add_field(field, idx=idx)
+        cls._invalidate_lazy_fieldnames()
+        setattr(cls, attr_name, ExtendedPropertyDescriptor(attr_name))
 
     @classmethod
     def deregister(cls, attr_name):
@@ -366,6 +561,9 @@ class Item(EWSElement):
         if not isinstance(field, ExtendedPropertyField):
             raise ValueError("'%s' is not registered as an ExtendedProperty" % attr_name)
         cls.remove_field(field)
+        cls._invalidate_lazy_fieldnames()
+        if isinstance(cls.__dict__.get(attr_name), ExtendedPropertyDescriptor):
+            delattr(cls, attr_name)
 
     def __eq__(self, other):
         if isinstance(other, tuple):
@@ -398,8 +596,6 @@ class BulkCreateResult(Item):
         AttachmentField('attachments', field_uri='item:Attachments'),  # ItemAttachment or FileAttachment
     ]
 
-    __slots__ = ('item_id', 'changekey', 'attachments')
-
     @classmethod
     def from_xml(cls, elem, account):
         item_id, changekey = cls.id_from_xml(elem)
@@ -444,6 +640,26 @@ class CalendarItem(Item):
         if self.start and self.end and self.end < self.start:
             raise ValueError("'end' must be greater than 'start' (%s -> %s)", self.start, self.end)
 
+    def expand(self, start, end, tz=None):
+        """
+        Lazily yields the occurrences of this item that overlap the window from 'start' to 'end', as Occurrence
+        objects, without contacting the server. Recurring master items are expanded locally, honoring the
+        modified and deleted occurrences of the item. Other items return themselves if they overlap the window.
+
+        'tz' is the timezone that the recurrence is defined in. Defaults to the timezone of the account.
+        """
+        if self.recurrence is None:
+            if self.start < end and (self.end > start or self.start >= start):
+                yield Occurrence(item_id=self.item_id, changekey=self.changekey, start=self.start, end=self.end,
+                                 original_start=self.start)
+            return
+        if tz is None:
+            tz = self.account.default_timezone if self.account else self.start.tzinfo
+        for o in self.recurrence.expand(first_start=self.start, first_end=self.end, start=start, end=end, tz=tz,
+                                        modified_occurrences=self.modified_occurrences,
+                                        deleted_occurrences=self.deleted_occurrences):
+            yield o
+
     def to_xml(self, version):
         # WARNING: The order of addition of XML elements is VERY important. Exchange expects XML elements in a
         # specific, non-documented order and will fail with meaningless errors if the order is wrong.
@@ -0,0 +1,128 @@
+# coding=utf-8
+"""
+Hooks for collecting metrics about the requests we send to the server: how long threads wait for a session, how many
+times requests are retried, the size of requests and responses, and the latency of each service call.
+
+By default, metrics are discarded. To collect them, register a Metrics instance globally or on a single Protocol:
+
+    from exchangelib.metrics import InMemoryMetrics, set_global_metrics
+    metrics = InMemoryMetrics()
+    set_global_metrics(metrics)  # Or: account.protocol.metrics = metrics
+    ...
+    print(metrics.get_counter(SERVICE_REQUESTS, service='GetItem', outcome=SUCCESS))
+
+To send metrics to your own monitoring system, subclass Metrics and implement increment() and observe().
+"""
+from __future__ import unicode_literals
+
+from collections import defaultdict
+import logging
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+# Metric names. Counters:
+SERVICE_REQUESTS = 'service_requests'  # Labels: service, endpoint, outcome
+REQUEST_RETRIES = 'request_retries'  # Labels: endpoint, reason
+PROTOCOL_CACHE = 'protocol_cache_lookups'  # Labels: endpoint, result. Always sent to the global metrics.
+RESULT_CACHE = 'result_cache_lookups'  # Labels: endpoint, result
+# Histograms:
+SESSION_WAIT = 'session_wait_seconds'  # Labels: endpoint
+SESSION_WARMUP = 'session_warmup_seconds'  # Labels: endpoint, outcome
+SERVICE_LATENCY = 'service_latency_seconds'  # Labels: service, endpoint, outcome
+REQUEST_BYTES = 'request_bytes'  # Labels: endpoint
+RESPONSE_BYTES = 'response_bytes'  # Labels: endpoint, status_code
+PROTOCOL_CACHE_WAIT = 'protocol_cache_wait_seconds'  # Labels: endpoint. Always sent to the global metrics.
+
+# The 'outcome' label of successful requests. Failed requests are labelled with the name of the exception class.
+SUCCESS = 'success'
+# The 'result' label of PROTOCOL_CACHE lookups. NEGATIVE_HIT means a recent failure to create the protocol was
+# raised again.
+HIT = 'hit'
+MISS = 'miss'
+NEGATIVE_HIT = 'negative_hit'
+# The 'result' label of RESULT_CACHE lookups that were answered with an IdOnly request instead of the full query
+REVALIDATED = 'revalidated'
+
+
+class Metrics(object):
+    """
+    The default metrics collector, which discards everything. Subclasses must be thread-safe.
+    """
+    def increment(self, name, value=1, **labels):
+        # Increment the counter 'name'
+        pass
+
+    def observe(self, name, value, **labels):
+        # Add an observation to the histogram 'name'
+        pass
+
+
+class InMemoryMetrics(Metrics):
+    """
+    Keeps all counters and observations in memory. Useful for tests and benchmarks.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = defaultdict(int)
+        self._histograms = defaultdict(list)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    @staticmethod
+    def _matches(key, name, labels):
+        key_name, key_labels = key
+        if key_name != name:
+            return False
+        key_labels = dict(key_labels)
+        return all(key_labels.get(k) == v for k, v in labels.items())
+
+    def increment(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._histograms[key].append(value)
+
+    def get_counter(self, name, **labels):
+        # Returns the sum of all counters with this name whose labels match the given labels
+        with self._lock:
+            return sum(v for k, v in self._counters.items() if self._matches(k, name, labels))
+
+    def get_observations(self, name, **labels):
+        # Returns all observations of histograms with this name whose labels match the given labels
+        with self._lock:
+            return [v for k, values in self._histograms.items() if self._matches(k, name, labels) for v in values]
+
+    def get_labels(self, name):
+        # Returns the distinct label sets that have been used with this counter or histogram name
+        with self._lock:
+            return [dict(k[1]) for k in list(self._counters) + list(self._histograms) if k[0] == name]
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+_global_metrics = Metrics()
+
+
+def set_global_metrics(metrics):
+    # Registers a metrics collector for all protocols that don't have their own. Pass None to disable metrics again.
+    global _global_metrics
+    assert metrics is None or isinstance(metrics, Metrics)
+    _global_metrics = metrics or Metrics()
+
+
+def get_metrics(protocol=None):
+    # Returns the metrics collector registered on the protocol, or the global collector
+    metrics = getattr(protocol, 'metrics', None)
+    if metrics is None:
+        return _global_metrics
+    return metrics
@@ -0,0 +1,178 @@
+# coding=utf-8
+"""
+A local SQLite mirror of the items in one or more folders. The mirror is kept up to date with SyncFolderItems, so only
+the changes since the last sync are fetched from the server.
+"""
+from __future__ import unicode_literals
+
+from collections import Counter
+from decimal import Decimal
+import logging
+import re
+import sqlite3
+
+from six import text_type, string_types
+
+from .ewsdatetime import EWSDateTime, EWSDate, UTC
+from .services import SyncFolderItems
+
+log = logging.getLogger(__name__)
+
+# Item IDs and changekeys are always stored. These are also the names of the columns in the 'items' table.
+ID_COLUMNS = ('item_id', 'folder_id', 'changekey')
+
+
+def _to_db_value(value):
+    # SQLite only supports a few types natively. Store dates in EWS format and everything else as text.
+    if value is None or isinstance(value, (bool, int, float) + string_types):
+        return value
+    if isinstance(value, EWSDateTime):
+        return value.astimezone(UTC).ewsformat()
+    if isinstance(value, EWSDate):
+        return value.ewsformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return text_type(value)
+
+
+class ItemMirror(object):
+    """
+    Keeps a local SQLite copy of the item IDs, changekeys and the values of selected fields of one or more folders. The
+    sync state of each folder is stored in the same database, in the same transaction as the changes it covers, so an
+    interrupted sync can always be resumed without losing changes.
+
+    Example:
+        mirror = ItemMirror('/var/lib/myapp/mirror.sqlite', fields=('subject', 'datetime_received', 'is_read'))
+        mirror.sync(account.inbox)
+        for row in mirror.items(account.inbox):
+            print(row['item_id'], row['subject'])
+
+    The SQLite connection is not shared between threads, so create one ItemMirror per thread.
+    """
+    def __init__(self, filename, fields=tuple()):
+        """
+        :param filename: the path to the SQLite database. Use ':memory:' for a database that is not persisted
+        :param fields: the names of the item fields to store, in addition to the item ID and changekey. If you change
+                       this list for an existing database, call reset() to get values for the new fields on all items.
+        """
+        for name in fields:
+            if not re.match(r'^[A-Za-z0-9_]+$', name) or name in ID_COLUMNS:
+                raise ValueError("'%s' is not a valid field name" % name)
+        self.filename = filename
+        self.fields = tuple(fields)
+        self._conn = sqlite3.connect(filename)
+        self._conn.row_factory = sqlite3.Row
+        self._create_tables()
+
+    def _create_tables(self):
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS sync_states (folder_id TEXT PRIMARY KEY, sync_state TEXT)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS items (item_id TEXT PRIMARY KEY, folder_id TEXT NOT NULL, changekey TEXT)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS items_folder_id ON items (folder_id)')
+            existing_columns = {row[1] for row in self._conn.execute('PRAGMA table_info(items)')}
+            for name in self.fields:
+                if name not in existing_columns:
+                    log.debug('Adding column %s to mirror %s', name, self.filename)
+                    self._conn.execute('ALTER TABLE items ADD COLUMN "%s"' % name)
+
+    @staticmethod
+    def _folder_key(folder):
+        if not folder.folder_id:
+            raise ValueError('Folder must have an ID')
+        return folder.folder_id
+
+    def get_sync_state(self, folder):
+        row = self._conn.execute(
+            'SELECT sync_state FROM sync_states WHERE folder_id = ?', (self._folder_key(folder),)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set_sync_state(self, folder, sync_state):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO sync_states (folder_id, sync_state) VALUES (?, ?)',
+            (self._folder_key(folder), sync_state)
+        )
+
+    def sync(self, folder, max_changes_returned=None):
+        """
+        Fetches the changes to 'folder' since the last sync and applies them to the mirror. Changes are committed
+        together with the sync state, one page at a time.
+
+        :return: a Counter with the number of changes of each change type
+        """
+        folder_id = self._folder_key(folder)
+        sync_state = self.get_sync_state(folder)
+        counts = Counter()
+        log.debug('Syncing mirror %s for folder %s (sync_state: %s)', self.filename, folder, sync_state)
+        try:
+            for change_type, value in folder.sync_items(
+                    sync_state=sync_state,
+                    only_fields=self.fields or None,
+                    max_changes_returned=max_changes_returned,
+            ):
+                if folder.item_sync_state != sync_state:
+                    # We finished a page. Commit the changes on that page together with the new sync state
+                    sync_state = folder.item_sync_state
+                    self._set_sync_state(folder, sync_state)
+                    self._conn.commit()
+                self._apply_change(folder_id, change_type, value)
+                counts[change_type] += 1
+            self._set_sync_state(folder, folder.item_sync_state)
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+        return counts
+
+    def _apply_change(self, folder_id, change_type, value):
+        if change_type in (SyncFolderItems.CREATE, SyncFolderItems.UPDATE):
+            if isinstance(value, tuple):
+                item_id, changekey = value
+                values = {}
+            else:
+                item_id, changekey = value.item_id, value.changekey
+                values = {name: _to_db_value(getattr(value, name, None)) for name in self.fields}
+            columns = ID_COLUMNS + tuple(values.keys())
+            self._conn.execute(
+                'INSERT OR REPLACE INTO items (%s) VALUES (%s)' % (
+                    ', '.join('"%s"' % c for c in columns), ', '.join('?' for _ in columns)
+                ),
+                (item_id, folder_id, changekey) + tuple(values.values())
+            )
+        elif change_type == SyncFolderItems.DELETE:
+            item_id, _ = value
+            self._conn.execute('DELETE FROM items WHERE item_id = ?', (item_id,))
+        elif change_type == SyncFolderItems.READ_FLAG_CHANGE:
+            (item_id, _), is_read = value
+            if 'is_read' in self.fields:
+                self._conn.execute('UPDATE items SET is_read = ? WHERE item_id = ?', (is_read, item_id))
+        else:
+            raise ValueError("Unknown change type '%s'" % change_type)
+
+    def items(self, folder):
+        # Returns the mirrored items of the folder as dicts
+        for row in self._conn.execute('SELECT * FROM items WHERE folder_id = ?', (self._folder_key(folder),)):
+            yield {k: row[k] for k in ID_COLUMNS + self.fields}
+
+    def get(self, item_id):
+        row = self._conn.execute('SELECT * FROM items WHERE item_id = ?', (item_id,)).fetchone()
+        if row is None:
+            raise KeyError(item_id)
+        return {k: row[k] for k in ID_COLUMNS + self.fields}
+
+    def count(self, folder):
+        return self._conn.execute(
+            'SELECT COUNT(*) FROM items WHERE folder_id = ?', (self._folder_key(folder),)
+        ).fetchone()[0]
+
+    def reset(self, folder):
+        # Deletes all mirrored items and the sync state of the folder. The next sync() will be a full sync.
+        folder_id = self._folder_key(folder)
+        with self._conn:
+            self._conn.execute('DELETE FROM items WHERE folder_id = ?', (folder_id,))
+            self._conn.execute('DELETE FROM sync_states WHERE folder_id = ?', (folder_id,))
+
+    def close(self):
+        self._conn.close()
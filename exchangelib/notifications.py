@@ -0,0 +1,374 @@
+# coding=utf-8
+"""
+Notifications about changes to items and folders in a mailbox. Pull subscriptions are polled with GetEvents. Streaming
+subscriptions deliver events over long-running GetStreamingEvents connections, which StreamingDispatcher multiplexes
+over a small number of connections per server.
+"""
+from __future__ import unicode_literals
+
+from collections import defaultdict
+import logging
+from threading import Thread, Lock, Event as ThreadingEvent
+
+from future.utils import python_2_unicode_compatible
+
+from .fields import TextField, IntegerField, DateTimeField, EWSElementField
+from .folders import FolderId, ParentFolderId
+from .properties import EWSElement, ItemId
+from .services import GetStreamingEvents, TNS
+from .util import time_func
+
+log = logging.getLogger(__name__)
+
+# Event types. See https://msdn.microsoft.com/en-us/library/office/aa565108(v=exchg.150).aspx
+COPIED = 'CopiedEvent'
+CREATED = 'CreatedEvent'
+DELETED = 'DeletedEvent'
+MODIFIED = 'ModifiedEvent'
+MOVED = 'MovedEvent'
+NEW_MAIL = 'NewMailEvent'
+FREE_BUSY_CHANGED = 'FreeBusyChangedEvent'  # Exchange 2010 SP1 and later
+EVENT_TYPES = (COPIED, CREATED, DELETED, MODIFIED, MOVED, NEW_MAIL)
+EVENT_TYPE_CHOICES = EVENT_TYPES + (FREE_BUSY_CHANGED,)
+
+
+class OldItemId(ItemId):
+    # MSDN: https://msdn.microsoft.com/en-us/library/office/aa565130(v=exchg.150).aspx
+    ELEMENT_NAME = 'OldItemId'
+
+    __slots__ = ItemId.__slots__
+
+
+class OldFolderId(ItemId):
+    # MSDN: https://msdn.microsoft.com/en-us/library/office/aa579287(v=exchg.150).aspx
+    ELEMENT_NAME = 'OldFolderId'
+
+    __slots__ = ItemId.__slots__
+
+
+class OldParentFolderId(ItemId):
+    # MSDN: https://msdn.microsoft.com/en-us/library/office/aa566217(v=exchg.150).aspx
+    ELEMENT_NAME = 'OldParentFolderId'
+
+    __slots__ = ItemId.__slots__
+
+
+class Event(EWSElement):
+    # Base class for all event types
+    FIELDS = [
+        TextField('watermark', field_uri='Watermark', max_length=None),
+    ]
+
+    __slots__ = ('watermark',)
+
+
+class StatusEvent(Event):
+    # Sent by the server when there are no other events, to keep the subscription alive
+    # MSDN: https://msdn.microsoft.com/en-us/library/office/aa580678(v=exchg.150).aspx
+    ELEMENT_NAME = 'StatusEvent'
+
+    __slots__ = Event.__slots__
+
+
+class TimestampEvent(Event):
+    FIELDS = Event.FIELDS + [
+        DateTimeField('timestamp', field_uri='TimeStamp'),
+    ]
+
+    __slots__ = Event.__slots__ + ('timestamp',)
+
+
+class BaseObjectChangedEvent(TimestampEvent):
+    # Either 'item_id' or 'folder_id' is set, depending on the type of object that changed
+    FIELDS = TimestampEvent.FIELDS + [
+        EWSElementField('item_id', value_cls=ItemId),
+        EWSElementField('folder_id', value_cls=FolderId),
+        EWSElementField('parent_folder_id', value_cls=ParentFolderId),
+    ]
+
+    __slots__ = TimestampEvent.__slots__ + ('item_id', 'folder_id', 'parent_folder_id')
+
+
+class OldBaseObjectChangedEvent(BaseObjectChangedEvent):
+    FIELDS = BaseObjectChangedEvent.FIELDS + [
+        EWSElementField('old_item_id', value_cls=OldItemId),
+        EWSElementField('old_folder_id', value_cls=OldFolderId),
+        EWSElementField('old_parent_folder_id', value_cls=OldParentFolderId),
+    ]
+
+    __slots__ = BaseObjectChangedEvent.__slots__ + ('old_item_id', 'old_folder_id', 'old_parent_folder_id')
+
+
+class CopiedEvent(OldBaseObjectChangedEvent):
+    # MSDN: https://msdn.microsoft.com/en-us/library/office/aa564829(v=exchg.150).aspx
+    ELEMENT_NAME = COPIED
+
+    __slots__ = OldBaseObjectChangedEvent.__slots__
+
+
+class MovedEvent(OldBaseObjectChangedEvent):
+    # MSDN: https://msdn.microsoft.com/en-us/library/office/aa565100(v=exchg.150).aspx
+    ELEMENT_NAME = MOVED
+
+    __slots__ = OldBaseObjectChangedEvent.__slots__
+
+
+class CreatedEvent(BaseObjectChangedEvent):
+    # MSDN: https://msdn.microsoft.com/en-us/library/office/aa565133(v=exchg.150).aspx
+    ELEMENT_NAME = CREATED
+
+    __slots__ = BaseObjectChangedEvent.__slots__
+
+
+class DeletedEvent(BaseObjectChangedEvent):
+    # MSDN: https://msdn.microsoft.com/en-us/library/office/aa580281(v=exchg.150).aspx
+    ELEMENT_NAME = DELETED
+
+    __slots__ = BaseObjectChangedEvent.__slots__
+
+
+class NewMailEvent(BaseObjectChangedEvent):
+    # MSDN: https://msdn.microsoft.com/en-us/library/office/aa565015(v=exchg.150).aspx
+    ELEMENT_NAME = NEW_MAIL
+
+    __slots__ = BaseObjectChangedEvent.__slots__
+
+
+class FreeBusyChangedEvent(BaseObjectChangedEvent):
+    # MSDN: https://msdn.microsoft.com/en-us/library/office/ff406173(v=exchg.150).aspx
+    ELEMENT_NAME = FREE_BUSY_CHANGED
+
+    __slots__ = BaseObjectChangedEvent.__slots__
+
+
+class ModifiedEvent(BaseObjectChangedEvent):
+    # MSDN: https://msdn.microsoft.com/en-us/library/office/aa580673(v=exchg.150).aspx
+    ELEMENT_NAME = MODIFIED
+
+    FIELDS = BaseObjectChangedEvent.FIELDS + [
+        IntegerField('unread_count', field_uri='UnreadCount'),
+    ]
+
+    __slots__ = BaseObjectChangedEvent.__slots__ + ('unread_count',)
+
+
+EVENT_CLASS_MAP = {cls.response_tag(): cls for cls in (
+    CopiedEvent, CreatedEvent, DeletedEvent, ModifiedEvent, MovedEvent, NewMailEvent, FreeBusyChangedEvent, StatusEvent,
+)}
+
+
+def events_from_xml(notification, account):
+    # Returns the events in a Notification element as Event objects. Unknown event types are logged and ignored.
+    for elem in notification:
+        if elem.tag in ('{%s}SubscriptionId' % TNS, '{%s}PreviousWatermark' % TNS, '{%s}MoreEvents' % TNS):
+            continue
+        try:
+            event_cls = EVENT_CLASS_MAP[elem.tag]
+        except KeyError:
+            log.warning('Ignoring unknown event type %s', elem.tag)
+            continue
+        yield event_cls.from_xml(elem=elem, account=account)
+
+
+@python_2_unicode_compatible
+class Subscription(object):
+    """
+    A streaming subscription managed by a StreamingDispatcher.
+    """
+    def __init__(self, account, folders, event_types, subscription_id):
+        self.account = account
+        self.folders = folders
+        self.event_types = event_types
+        self.subscription_id = subscription_id
+
+    def __str__(self):
+        return '%s (%s)' % (self.subscription_id, self.account)
+
+
+class _Connection(object):
+    # The set of subscriptions that are streamed over the same GetStreamingEvents connection
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.subscriptions = {}  # subscription_id -> Subscription
+        self.changed = ThreadingEvent()  # Set when the subscription set changes and we need to reconnect
+        self.service = None  # The active GetStreamingEvents service, if any
+        self.thread = None
+
+
+class StreamingDispatcher(object):
+    """
+    Multiplexes streaming subscriptions for any number of accounts over a small number of long-running
+    GetStreamingEvents connections per server, and delivers events as they arrive.
+
+    Events are delivered by calling 'callback(subscription, event)' and/or by putting '(subscription, event)' tuples on
+    'queue'. Callbacks are called from the connection threads, so they should return quickly. If a subscription fails,
+    e.g. because it expired on the server, the exception is delivered in place of an event.
+
+    Example:
+        dispatcher = StreamingDispatcher(queue=Queue())
+        dispatcher.subscribe(account, folders=[account.inbox], event_types=[NEW_MAIL])
+        dispatcher.start()
+        while True:
+            subscription, event = dispatcher.queue.get()
+
+    Exchange allows a limited number of concurrent GetStreamingEvents connections per user (10 by default), and all
+    subscriptions on a connection must be accessible by the account that opened the connection, so use impersonation
+    or delegate access to the subscribed accounts.
+    """
+    # Exchange allows at most 200 subscriptions per connection
+    MAX_SUBSCRIPTIONS_PER_CONNECTION = 200
+    # Seconds to wait before reconnecting after a connection error, or after a connection that the server closed right
+    # away
+    RECONNECT_WAIT = 10
+
+    def __init__(self, callback=None, queue=None, max_connections=2, connection_timeout=30):
+        """
+        :param callback: a callable called with (subscription, event) for each event
+        :param queue: a queue.Queue instance that receives (subscription, event) tuples
+        :param max_connections: the maximum number of concurrent connections per server
+        :param connection_timeout: the number of minutes before a connection is closed and reopened by the server (1-30)
+        """
+        if callback is None and queue is None:
+            raise ValueError("Either 'callback' or 'queue' must be set")
+        self.callback = callback
+        self.queue = queue
+        self.max_connections = max_connections
+        self.connection_timeout = connection_timeout
+        self._connections = defaultdict(list)  # Protocol -> list of _Connection
+        self._lock = Lock()
+        self._stopped = ThreadingEvent()
+        self._started = False
+
+    def subscribe(self, account, folders, event_types=EVENT_TYPES):
+        """
+        Creates a streaming subscription for events in 'folders' of 'account' and assigns it to a connection.
+
+        :return: a Subscription instance
+        """
+        subscription_id = account.subscribe_to_streaming(folders=folders, event_types=event_types)
+        subscription = Subscription(account=account, folders=folders, event_types=event_types,
+                                    subscription_id=subscription_id)
+        with self._lock:
+            connection = self._get_connection(account.protocol)
+            connection.subscriptions[subscription_id] = subscription
+            connection.changed.set()
+            if connection.service:
+                # Reconnect with the new subscription set
+                connection.service.close()
+            if self._started and connection.thread is None:
+                self._start_connection(connection)
+        log.debug('Added subscription %s', subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Removes the subscription from its connection and cancels it on the server.
+        """
+        with self._lock:
+            for connection in self._connections[subscription.account.protocol]:
+                if connection.subscriptions.pop(subscription.subscription_id, None) is not None:
+                    connection.changed.set()
+                    if connection.service:
+                        connection.service.close()
+                    break
+        subscription.account.unsubscribe(subscription.subscription_id)
+        log.debug('Removed subscription %s', subscription)
+
+    def _get_connection(self, protocol):
+        # Returns the least-loaded connection for the protocol. Only opens a new connection when all are full.
+        connections = self._connections[protocol]
+        open_connections = [c for c in connections if len(c.subscriptions) < self.MAX_SUBSCRIPTIONS_PER_CONNECTION]
+        if open_connections:
+            return min(open_connections, key=lambda c: len(c.subscriptions))
+        if len(connections) >= self.max_connections:
+            raise ValueError('All %s connections to %s have %s subscriptions' % (
+                len(connections), protocol.service_endpoint, self.MAX_SUBSCRIPTIONS_PER_CONNECTION))
+        connection = _Connection(protocol=protocol)
+        connections.append(connection)
+        return connection
+
+    def start(self):
+        # Starts one thread per connection. Subscriptions added later are picked up automatically.
+        with self._lock:
+            self._stopped.clear()
+            self._started = True
+            for connections in self._connections.values():
+                for connection in connections:
+                    if connection.thread is None:
+                        self._start_connection(connection)
+
+    def stop(self):
+        # Closes all connections and waits for the threads to finish. Subscriptions are not removed from the server.
+        with self._lock:
+            self._started = False
+            self._stopped.set()
+            threads = []
+            for connections in self._connections.values():
+                for connection in connections:
+                    if connection.service:
+                        connection.service.close()
+                    if connection.thread:
+                        threads.append(connection.thread)
+                    connection.thread = None
+        for thread in threads:
+            thread.join()
+
+    def _start_connection(self, connection):
+        connection.thread = Thread(target=self._run_connection, args=(connection,))
+        connection.thread.daemon = True
+        connection.thread.start()
+
+    def _run_connection(self, connection):
+        while not self._stopped.is_set():
+            with self._lock:
+                connection.changed.clear()
+                subscriptions = dict(connection.subscriptions)
+                if not subscriptions:
+                    connection.service = None
+                else:
+                    # The connection must be opened by an account that has access to all subscriptions
+                    connection.service = GetStreamingEvents(account=next(iter(subscriptions.values())).account)
+                service = connection.service
+            if service is None:
+                # Wait for a subscription to be added
+                connection.changed.wait(1)
+                continue
+            t1 = time_func()
+            try:
+                for subscription_id, notification in service.call(subscription_ids=list(subscriptions.keys()),
+                                                                   connection_timeout=self.connection_timeout):
+                    subscription = subscriptions.get(subscription_id)
+                    if subscription is None:
+                        log.debug('Ignoring event for unknown subscription %s', subscription_id)
+                        continue
+                    if isinstance(notification, Exception):
+                        # The subscription failed, e.g. because it expired. Don't reconnect with it again.
+                        del subscriptions[subscription_id]
+                        with self._lock:
+                            connection.subscriptions.pop(subscription_id, None)
+                        self._deliver(subscription, notification)
+                        continue
+                    for event in events_from_xml(notification, account=subscription.account):
+                        self._deliver(subscription, event)
+            except Exception as e:
+                if self._stopped.is_set() or connection.changed.is_set():
+                    # We closed the connection ourselves
+                    continue
+                log.warning('Streaming connection to %s failed (%s). Reconnecting in %s seconds',
+                            connection.protocol.service_endpoint, e, self.RECONNECT_WAIT)
+                self._stopped.wait(self.RECONNECT_WAIT)
+                continue
+            if time_func() - t1 < self.RECONNECT_WAIT and not connection.changed.is_set():
+                # Don't hammer a server that keeps closing the connection right away
+                log.warning('Streaming connection to %s was closed after %.1f seconds. Reconnecting in %s seconds',
+                            connection.protocol.service_endpoint, time_func() - t1, self.RECONNECT_WAIT)
+                self._stopped.wait(self.RECONNECT_WAIT)
+
+    def _deliver(self, subscription, event):
+        if self.callback is not None:
+            try:
+                self.callback(subscription, event)
+            except Exception:
+                log.exception('Error in callback for subscription %s', subscription)
+        if self.queue is not None:
+            self.queue.put((subscription, event))
@@ -8,10 +8,11 @@ when creating an Account.
 from __future__ import unicode_literals
 
 import logging
+import os
 import random
 import socket
 from multiprocessing.pool import ThreadPool
-from threading import Lock
+from threading import Lock, Thread, Event
 
 import requests.adapters
 import requests.sessions
@@ -21,9 +22,11 @@ from six import text_type
 
 from .credentials import Credentials
 from .errors import TransportError
-from .services import GetServerTimeZones, GetRoomLists, GetRooms
-from .transport import get_auth_instance, get_service_authtype, get_docs_authtype, AUTH_TYPE_MAP, DEFAULT_HEADERS
-from .util import split_url
+from .metrics import get_metrics, SESSION_WAIT, SESSION_WARMUP, PROTOCOL_CACHE, PROTOCOL_CACHE_WAIT, HIT, MISS, \
+    NEGATIVE_HIT, SUCCESS
+from .services import GetServerTimeZones, GetRoomLists, GetRooms, ResolveNames
+from .transport import get_auth_instance, get_service_authtype, get_docs_authtype, wrap, AUTH_TYPE_MAP, DEFAULT_HEADERS
+from .util import split_url, time_func, CONNECTION_ERRORS
 from .version import Version, API_VERSIONS
 
 log = logging.getLogger(__name__)
@@ -33,6 +36,38 @@ def close_connections():
     CachingProtocol.clear_cache()
 
 
+class CompressionStats(object):
+    # Counts the effect of request compression on a protocol
+    def __init__(self):
+        self._lock = Lock()
+        self.compressed_requests = 0
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+        self.fallbacks = 0
+
+    def add(self, uncompressed_size, compressed_size):
+        with self._lock:
+            self.compressed_requests += 1
+            self.uncompressed_bytes += uncompressed_size
+            self.compressed_bytes += compressed_size
+
+    def add_fallback(self):
+        with self._lock:
+            self.fallbacks += 1
+
+    @property
+    def ratio(self):
+        # The compressed size relative to the uncompressed size of all compressed requests, e.g. 0.25
+        if not self.uncompressed_bytes:
+            return None
+        return float(self.compressed_bytes) / self.uncompressed_bytes
+
+    def __repr__(self):
+        return '%s(compressed_requests=%s, uncompressed_bytes=%s, compressed_bytes=%s, ratio=%s, fallbacks=%s)' % (
+            self.__class__.__name__, self.compressed_requests, self.uncompressed_bytes, self.compressed_bytes,
+            self.ratio, self.fallbacks)
+
+
 class BaseProtocol(object):
     # Base class for Protocol which implements the bare essentials
 
@@ -47,6 +82,14 @@ class BaseProtocol(object):
     CONNECTIONS_PER_SESSION = 1
     # Timeout for HTTP requests
     TIMEOUT = 120
+    # If True, all sessions in the pool are connected and authenticated in parallel when the protocol is created,
+    # instead of paying for the TCP, TLS and NTLM handshakes in the first request on each session. Retired sessions are
+    # then replaced by warm sessions in the background. Only applies to normal HTTP sessions, not sessions created by a
+    # session factory.
+    PREWARM_SESSIONS = False
+    # If set, sessions that have been idle for this number of seconds are kept alive with a cheap request, so the server
+    # doesn't close the connection and we don't have to authenticate again.
+    KEEPALIVE_INTERVAL = None
 
     def __init__(self, service_endpoint, credentials, auth_type, verify_ssl):
         assert isinstance(credentials, Credentials)
@@ -57,7 +100,22 @@ class BaseProtocol(object):
         self.service_endpoint = service_endpoint
         self.auth_type = auth_type
         self.verify_ssl = verify_ssl
-        self._session_pool = None  # Consumers need to fill the session pool themselves
+        self.metrics = None  # A Metrics instance for this protocol only. If None, the global Metrics instance is used
+        self.span_exporter = None  # A SpanExporter for this protocol only. If None, the global exporter is used
+        self.wire_log = None  # A WireLog for this protocol only. If None, the global wire log is used
+        self.result_cache = None  # A ResultCache for this protocol only. If None, the global result cache is used
+        # Gzip-compress request bodies larger than this number of bytes. None disables request compression. Not all
+        # servers accept compressed requests. If the server rejects a compressed request, we resend it uncompressed and
+        # disable compression for this protocol.
+        self.compress_requests_over = None
+        self.compression_stats = CompressionStats()
+        # A callable that takes this protocol and returns a new session. If None, we create normal HTTP sessions. See
+        # set_session_factory().
+        self.session_factory = None
+        self._session_pool = None  # Consumers need to fill the session pool themselves, see _create_session_pool()
+        self._keepalive_stopped = Event()
+        self._pid = os.getpid()  # Used to detect that os.fork() copied this protocol to a child process
+        self._fork_lock = Lock()  # Held while a forked protocol creates its new sessions and threads
 
     def __del__(self):
         # pylint: disable=bare-except
@@ -69,19 +127,66 @@ class BaseProtocol(object):
 
     def close(self):
         log.debug('Server %s: Closing sessions', self.server)
+        if self._pid != os.getpid():
+            # We were forked and never used in this process. The sockets of the inherited sessions are still in use by
+            # the parent process, so don't shut them down.
+            return
+        self._keepalive_stopped.set()
         while True:
             try:
                 self._session_pool.get(block=False).close_socket(self.service_endpoint)
             except (Empty, ReferenceError, AttributeError):
                 break
 
+    def _create_session_pool(self):
+        # Try to behave nicely with the Exchange server. We want to keep the connection open between requests.
+        # We also want to re-use sessions, to avoid the NTLM auth handshake on every request.
+        session_pool = LifoQueue(maxsize=self.SESSION_POOLSIZE)
+        for _ in range(self.SESSION_POOLSIZE):
+            session_pool.put(self.create_session(), block=False)
+        return session_pool
+
+    def _check_fork(self):
+        # Sockets, threads and locks are not usable after os.fork(), e.g. in the workers of a prefork server. If this
+        # protocol was inherited from a parent process, create new ones. The auth type, version and other settings are
+        # kept, so the child process doesn't have to ask the server again.
+        if self._pid == os.getpid():
+            return
+        with self._fork_lock:
+            # Another thread may have got ahead of us while we waited for the lock
+            if self._pid == os.getpid():
+                return
+            self._reinit_after_fork()
+            # Only mark the protocol as ours when everything has been replaced. Until then, other threads wait for us
+            # instead of using the inherited session pool and thread pool.
+            self._pid = os.getpid()
+        if self._session_pool is None:
+            return
+        if self._warms_sessions:
+            self.prewarm()
+        if self.KEEPALIVE_INTERVAL:
+            self.start_keepalive()
+
+    def _reinit_after_fork(self):
+        # Replaces everything that was inherited from the parent process. Called by _check_fork(), with _fork_lock held
+        log.debug('Server %s: Process was forked. Creating new sessions', self.server)
+        self.compression_stats = CompressionStats()
+        self._keepalive_stopped = Event()
+        if self._session_pool is None:
+            return
+        # Don't close the inherited sessions. Their sockets are still in use by the parent process.
+        self._session_pool = self._create_session_pool()
+
     def get_session(self):
+        self._check_fork()
         _timeout = 60  # Rate-limit messages about session starvation
+        t1 = time_func()
         while True:
             try:
                 log.debug('Server %s: Waiting for session', self.server)
                 session = self._session_pool.get(timeout=_timeout)
                 log.debug('Server %s: Got session %s', self.server, session.session_id)
+                get_metrics(self).observe(SESSION_WAIT, time_func() - t1, endpoint=self.service_endpoint)
                 return session
             except Empty:
                 # This is normal when we have many worker threads starving for available sessions
@@ -90,6 +195,7 @@ class BaseProtocol(object):
     def release_session(self, session):
         # This should never fail, as we don't have more sessions than the queue contains
         log.debug('Server %s: Releasing session %s', self.server, session.session_id)
+        session.last_used = time_func()
         try:
             self._session_pool.put(session, block=False)
         except Full:
@@ -100,17 +206,124 @@ class BaseProtocol(object):
         log.debug('Server %s: Retiring session %s', self.server, session.session_id)
         session.close_socket(self.service_endpoint)
         del session
+        if self._warms_sessions:
+            # Don't make the caller wait for the handshakes of the new session
+            self._start_thread(target=self._replace_session, name='warmup')
+            return
         self.release_session(self.create_session())
 
     def renew_session(self, session):
         # The session is useless. Close it completely and place a fresh session in the pool
         log.debug('Server %s: Renewing session %s', self.server, session.session_id)
+        if self._warms_sessions:
+            # The replacement is warmed up in the background. Meanwhile, continue with a warm session from the pool.
+            self.retire_session(session)
+            return self.get_session()
         session.close_socket(self.service_endpoint)
         del session
         return self.create_session()
 
+    @property
+    def _warms_sessions(self):
+        return self.PREWARM_SESSIONS and self.session_factory is None
+
+    def _start_thread(self, target, name):
+        t = Thread(target=target, name='%s-%s' % (name, self.server))
+        t.daemon = True
+        t.start()
+        return t
+
+    def warm_session(self, session):
+        # Opens the connection of a session and completes the authentication handshake by sending a cheap request.
+        # Subclasses that know a cheap request override this.
+        pass
+
+    def _warm_session(self, session):
+        # Like warm_session(), but logs errors instead of raising them. A cold session still works. It just has to
+        # connect and authenticate in the first request.
+        t1 = time_func()
+        outcome = SUCCESS
+        try:
+            self.warm_session(session)
+        except (TransportError,) + CONNECTION_ERRORS as e:
+            outcome = e.__class__.__name__
+            log.warning('Server %s: Could not warm up session %s: %s', self.server, session.session_id, e)
+        get_metrics(self).observe(SESSION_WARMUP, time_func() - t1, endpoint=self.service_endpoint, outcome=outcome)
+
+    def _replace_session(self):
+        session = self.create_session()
+        self._warm_session(session)
+        self.release_session(session)
+
+    def prewarm(self):
+        """
+        Connects and authenticates all sessions in the session pool in parallel. Waits for sessions that are currently
+        in use to be released.
+        """
+        sessions = [self.get_session() for _ in range(self.SESSION_POOLSIZE)]
+        threads = [self._start_thread(target=lambda s=s: self._warm_session(s), name='warmup') for s in sessions]
+        for t in threads:
+            t.join()
+        for session in reversed(sessions):
+            self.release_session(session)
+
+    def start_keepalive(self):
+        # Starts a thread that keeps idle sessions alive until the protocol is closed
+        self._keepalive_stopped.clear()
+        self._start_thread(target=self._keepalive, name='keepalive')
+
+    def _keepalive(self):
+        while not self._keepalive_stopped.wait(self.KEEPALIVE_INTERVAL):
+            if self.session_factory is not None:
+                # Sessions from a session factory, e.g. a cassette, must not send requests of their own
+                continue
+            # Keep idle sessions alive one at a time, so the pool is never drained and threads that need a session
+            # don't have to wait for us.
+            while not self._keepalive_stopped.is_set():
+                session = self._get_idle_session()
+                if session is None:
+                    break
+                log.debug('Server %s: Keeping session %s alive', self.server, session.session_id)
+                self._warm_session(session)
+                if self._keepalive_stopped.is_set():
+                    # close() was called meanwhile and has already closed the sessions in the pool
+                    session.close_socket(self.service_endpoint)
+                    break
+                self.release_session(session)
+
+    def _get_idle_session(self):
+        # Takes the least recently used session from the pool, if it has been idle for KEEPALIVE_INTERVAL. The pool is
+        # a LIFO queue, so that session is at the bottom. Released sessions go on top, so each call finds a new one.
+        pool = self._session_pool
+        with pool.mutex:
+            if not pool.queue:
+                return None
+            session = pool.queue[0]
+            if time_func() - getattr(session, 'last_used', 0) < self.KEEPALIVE_INTERVAL:
+                return None
+            del pool.queue[0]
+            pool.not_full.notify()
+        return session
+
+    def set_session_factory(self, session_factory):
+        """
+        Replaces all sessions in the session pool with sessions created by 'session_factory', a callable that takes this
+        protocol and returns a session. This is how e.g. exchangelib.cassette records and replays traffic. Pass None to
+        go back to normal HTTP sessions. Waits for sessions that are currently in use to be released.
+        """
+        old_sessions = [self.get_session() for _ in range(self.SESSION_POOLSIZE)]
+        self.session_factory = session_factory
+        for session in old_sessions:
+            session.close_socket(self.service_endpoint)
+            self.release_session(self.create_session())
+
     def create_session(self):
-        session = EWSSession(self)
+        if self.session_factory is not None:
+            return self.session_factory(self)
+        return self.create_http_session()
+
+    def create_http_session(self, session_cls=None):
+        session = (session_cls or EWSSession)(self)
         session.auth = get_auth_instance(credentials=self.credentials, auth_type=self.auth_type)
         # Leave this inside the loop because headers are mutable
         session.headers.update(DEFAULT_HEADERS.copy())
@@ -132,7 +345,19 @@ class BaseProtocol(object):
 
 class CachingProtocol(type):
     _protocol_cache = {}
+    # Failures to create a protocol, as (exception, expiry time) tuples
+    _protocol_cache_errors = {}
+    # Per-key locks held while a protocol is being created. Creating a protocol may contact the server, so we don't want
+    # a slow server to block the creation of protocols for other servers.
+    _protocol_cache_key_locks = {}
+    # Guards the dicts above. Never held while creating a protocol.
     _protocol_cache_lock = Lock()
+    # The number of seconds to remember that creating a protocol failed, before trying again. The actual time is
+    # randomized by NEGATIVE_CACHE_JITTER, so many processes don't retry a failing server at the same time.
+    NEGATIVE_CACHE_TTL = 60
+    NEGATIVE_CACHE_JITTER = 0.2
+    # Used to detect that os.fork() copied the cache to a child process
+    _protocol_cache_pid = os.getpid()
 
     def __call__(cls, *args, **kwargs):
         # Cache Protocol instances that point to the same endpoint and use the same credentials. This ensures that we
@@ -145,44 +370,84 @@ class CachingProtocol(type):
         # We may be using multiple different credentials and changing our minds on SSL verification. This key
         # combination should be safe.
         _protocol_cache_key = kwargs['service_endpoint'], kwargs['credentials'], kwargs['verify_ssl']
+        endpoint = kwargs['service_endpoint']
+        metrics = get_metrics()
+        if cls._protocol_cache_pid != os.getpid():
+            cls._reinit_cache_after_fork()
 
-        protocol = cls._protocol_cache.get(_protocol_cache_key)
-        if isinstance(protocol, Exception):
-            # The input data leads to a TransportError. Re-throw
-            raise protocol
+        protocol = cls._get_cached(_protocol_cache_key, metrics)
         if protocol is not None:
             return protocol
 
-        # Acquire lock to guard against multiple threads competing to cache information. Having a per-server lock is
-        # probably overkill although it would reduce lock contention.
-        log.debug('Waiting for _protocol_cache_lock')
+        # Only one thread creates the protocol for a key. Other threads wait for it, but threads asking for other keys
+        # don't.
         with cls._protocol_cache_lock:
-            protocol = cls._protocol_cache.get(_protocol_cache_key)
-            if isinstance(protocol, Exception):
-                # Someone got ahead of us while holding the lock, but the input data leads to a TransportError. Re-throw
-                raise protocol
+            key_lock = cls._protocol_cache_key_locks.setdefault(_protocol_cache_key, Lock())
+        log.debug("Waiting for lock on protocol cache key '%s'", str(_protocol_cache_key))
+        t1 = time_func()
+        with key_lock:
+            metrics.observe(PROTOCOL_CACHE_WAIT, time_func() - t1, endpoint=endpoint)
+            # Someone may have got ahead of us while we waited for the lock
+            protocol = cls._get_cached(_protocol_cache_key, metrics)
             if protocol is not None:
-                # Someone got ahead of us while holding the lock
                 return protocol
             log.debug("Protocol __call__ cache miss. Adding key '%s'", str(_protocol_cache_key))
+            metrics.increment(PROTOCOL_CACHE, endpoint=endpoint, result=MISS)
             try:
                 protocol = super(CachingProtocol, cls).__call__(*args, **kwargs)
             except TransportError as e:
                 # This can happen if, for example, autodiscover supplies us with a bogus EWS endpoint
-                log.warning('Failed to create cached protocol with key %s: %s', _protocol_cache_key, e)
-                cls._protocol_cache[_protocol_cache_key] = e
+                ttl = cls.NEGATIVE_CACHE_TTL * random.uniform(1 - cls.NEGATIVE_CACHE_JITTER,
+                                                              1 + cls.NEGATIVE_CACHE_JITTER)
+                log.warning('Failed to create cached protocol with key %s: %s. Retrying in %.0f seconds',
+                            _protocol_cache_key, e, ttl)
+                with cls._protocol_cache_lock:
+                    cls._protocol_cache_errors[_protocol_cache_key] = e, time_func() + ttl
+                    # Threads that arrive from now on find the cached error. Threads that are already waiting for the
+                    # key lock still hold a reference to it.
+                    cls._protocol_cache_key_locks.pop(_protocol_cache_key, None)
                 raise e
-            cls._protocol_cache[_protocol_cache_key] = protocol
+            with cls._protocol_cache_lock:
+                cls._protocol_cache[_protocol_cache_key] = protocol
+                cls._protocol_cache_errors.pop(_protocol_cache_key, None)
+                cls._protocol_cache_key_locks.pop(_protocol_cache_key, None)
         return protocol
 
+    def _get_cached(cls, key, metrics):
+        # Returns the cached protocol, raises the cached error if it hasn't expired yet, or returns None
+        with cls._protocol_cache_lock:
+            protocol = cls._protocol_cache.get(key)
+            error = cls._protocol_cache_errors.get(key)
+        if protocol is not None:
+            metrics.increment(PROTOCOL_CACHE, endpoint=key[0], result=HIT)
+            return protocol
+        if error is not None:
+            e, expires = error
+            if time_func() < expires:
+                # The input data leads to a TransportError. Re-throw
+                metrics.increment(PROTOCOL_CACHE, endpoint=key[0], result=NEGATIVE_HIT)
+                raise e
+        return None
+
+    @classmethod
+    def _reinit_cache_after_fork(mcs):
+        # The locks may have been held by threads of the parent process that don't exist in this process. Cached
+        # protocols are kept. They create their own sessions and threads when they are first used in this process.
+        mcs._protocol_cache_lock = Lock()
+        mcs._protocol_cache_key_locks = {}
+        mcs._protocol_cache_pid = os.getpid()
+
     @classmethod
     def clear_cache(mcs):
-        for key, protocol in mcs._protocol_cache.items():
+        with mcs._protocol_cache_lock:
+            protocols = list(mcs._protocol_cache.items())
+            mcs._protocol_cache.clear()
+            mcs._protocol_cache_errors.clear()
+            mcs._protocol_cache_key_locks.clear()
+        for key, protocol in protocols:
             service_endpoint = key[0]
             log.debug("Service endpoint '%s': Closing sessions", service_endpoint)
             protocol.close()
-            del protocol
-        mcs._protocol_cache.clear()
 
 
 @python_2_unicode_compatible
@@ -191,7 +456,7 @@ class Protocol(with_metaclass(CachingProtocol, BaseProtocol)):
         version = kwargs.pop('version', None)
         super(Protocol, self).__init__(*args, **kwargs)
 
-        scheme = 'https' if self.has_ssl else 'https'
+        scheme = 'https' if self.has_ssl else 'http'
         self.wsdl_url = '%s://%s/EWS/Services.wsdl' % (scheme, self.server)
         self.messages_url = '%s://%s/EWS/messages.xsd' % (scheme, self.server)
         self.types_url = '%s://%s/EWS/types.xsd' % (scheme, self.server)
@@ -204,11 +469,7 @@ class Protocol(with_metaclass(CachingProtocol, BaseProtocol)):
         # Default to the auth type used by the service. We only need this if 'version' is None
         self.docs_auth_type = self.auth_type
 
-        # Try to behave nicely with the Exchange server. We want to keep the connection open between requests.
-        # We also want to re-use sessions, to avoid the NTLM auth handshake on every request.
-        self._session_pool = LifoQueue(maxsize=self.SESSION_POOLSIZE)
-        for _ in range(self.SESSION_POOLSIZE):
-            self._session_pool.put(self.create_session(), block=False)
+        self._session_pool = self._create_session_pool()
 
         if version:
             isinstance(version, Version)
@@ -226,8 +487,38 @@ class Protocol(with_metaclass(CachingProtocol, BaseProtocol)):
         # larger than the connection pool so we have time to process data without idling the connection.
         # Create the pool as the last thing here, since we may fail in the version or auth type guessing, which would
         # leave open threads around to be garbage collected.
+        self._thread_pool = self._create_thread_pool()
+
+        if self._warms_sessions:
+            self.prewarm()
+        if self.KEEPALIVE_INTERVAL:
+            self.start_keepalive()
+
+    def _create_thread_pool(self):
         thread_poolsize = 4 * self.SESSION_POOLSIZE
-        self.thread_pool = ThreadPool(processes=thread_poolsize)
+        return ThreadPool(processes=thread_poolsize)
+
+    @property
+    def thread_pool(self):
+        self._check_fork()
+        return self._thread_pool
+
+    def _reinit_after_fork(self):
+        super(Protocol, self)._reinit_after_fork()
+        # The worker threads of the inherited thread pool only exist in the parent process
+        self._thread_pool = self._create_thread_pool()
+
+    def warm_session(self, session):
+        # ResolveNames is the cheapest request that works on all server versions. We don't care about the result, so
+        # don't use post_ratelimited(), which would retry, or retire the session on errors.
+        payload = ResolveNames(protocol=self).get_payload(unresolved_entries=[self.credentials.username],
+                                                          return_full_contact_data=False)
+        r = session.post(url=self.service_endpoint, headers=None, allow_redirects=False, timeout=self.TIMEOUT,
+                         verify=self.verify_ssl, data=wrap(content=payload, version=self.version.api_version))
+        # The server responds to invalid requests with a SOAP fault and status 500, which still means we're
+        # authenticated
+        if r.status_code not in (200, 500):
+            raise TransportError('Unexpected HTTP status %s when warming up session' % r.status_code)
 
     def get_timezones(self):
         return GetServerTimeZones(protocol=self).call()
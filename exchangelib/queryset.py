@@ -1,14 +1,19 @@
 # coding=utf-8
 from __future__ import unicode_literals
 
-from copy import deepcopy
-from itertools import islice
+from collections import deque
+from copy import copy, deepcopy
+import heapq
+from itertools import islice, chain
 import logging
 
 from future.utils import python_2_unicode_compatible
 
 from .fields import FieldPath, FieldOrder
+from .metrics import get_metrics, RESULT_CACHE, HIT, MISS, REVALIDATED
 from .restriction import Q
+from .resultcache import get_result_cache
+from .tracing import trace_iter, propagate_context, QUERYSET
 
 log = logging.getLogger(__name__)
 
@@ -21,6 +26,40 @@ class DoesNotExist(Exception):
     pass
 
 
+class ReverseOrder(object):
+    # Wraps a value to reverse its sort order. This allows sorting on fields in different directions with one key
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def order_key(order_fields):
+    # Returns a composite sort key for the FieldOrder objects in 'order_fields'. None values are sorted first.
+    def key(item):
+        values = []
+        for f in order_fields:
+            value = f.field_path.get_value(item)
+            value = (value is not None, value)
+            values.append(ReverseOrder(value) if f.reverse else value)
+        return tuple(values)
+    return key
+
+
+def _merge_sorted(iterables, key):
+    # Merges sorted iterables into one sorted iterator. Like heapq.merge() with a 'key' argument, which Python 2 lacks.
+    # Items never need to be compared, because the iterable index and the position break ties.
+    decorated = [((key(i), n, pos, i) for pos, i in enumerate(iterable)) for n, iterable in enumerate(iterables)]
+    for _, _, _, i in heapq.merge(*decorated):
+        yield i
+
+
 @python_2_unicode_compatible
 class QuerySet(object):
     """
@@ -34,6 +73,11 @@ class QuerySet(object):
     FLAT = 'flat'
     NONE = 'none'
     RETURN_TYPES = (VALUES, VALUES_LIST, FLAT, NONE)
+    # Lists of values in '__in' lookups that are longer than this are split into several FindItem requests. Exchange
+    # rejects, or is very slow with, restrictions with many values.
+    MAX_IN_VALUES = 250
+    # The maximum number of these FindItem requests that run at the same time
+    SPLIT_QUERY_CONCURRENCY = 4
 
     def __init__(self, folder):
         self.folder = folder
@@ -43,8 +87,16 @@ class QuerySet(object):
         self.return_format = self.NONE
         self.calendar_view = None
         self.page_size = None
+        self.lazy_mode = None  # One of LAZY_CHOICES to decode item fields when they are accessed. See lazy()
 
         self._cache = None
+        # Set on copies of this QuerySet when slicing. The number of items to skip, and the maximum number of items to
+        # return. For calendar views, we can't skip items server-side, and '_limit' is used to only sort the top-N
+        # items.
+        self._offset = 0
+        self._limit = None
+        # A (q, simplified q) tuple. See _get_simplified_q()
+        self._simplified_q = None
 
     def copy(self):
         # When we copy a queryset where the cache has already been filled, we don't copy the cache. Thus, a copied
@@ -67,9 +119,23 @@ class QuerySet(object):
         new_qs.order_fields = None if self.order_fields is None else deepcopy(self.order_fields)
         new_qs.return_format = self.return_format
         new_qs.calendar_view = self.calendar_view
+        new_qs.lazy_mode = self.lazy_mode
+        if self._simplified_q is not None and self._simplified_q[0] is self.q:
+            new_qs._simplified_q = new_qs.q, self._simplified_q[1]
         return new_qs
 
+    def _get_simplified_q(self):
+        # Returns a simplified version of 'q', or None if the query can't match anything. The result is cached for as
+        # long as 'q' is the same object.
+        if self._simplified_q is None or self._simplified_q[0] is not self.q:
+            self._simplified_q = self.q, None if self.q is None else self.q.simplify()
+        return self._simplified_q[1]
+
     def _query(self):
+        q = self._get_simplified_q()
+        if q is None:
+            # The restriction contradicts itself. Don't bother the server.
+            return []
         if self.only_fields is None:
             # The list of field paths was not restricted. Get all field paths we support, as a set, but remove item_id
             # and changekey. We get them unconditionally.
@@ -96,6 +162,10 @@ class QuerySet(object):
             calendar_view=self.calendar_view,
             page_size=self.page_size,
         )
+        if not self.calendar_view:
+            find_item_kwargs.update(offset=self._offset, max_items=self._limit)
+        if self.lazy_mode:
+            find_item_kwargs['lazy'] = self.lazy_mode
 
         if must_sort_clientside:
             # Also fetch order_by fields that we only need for client-side sorting.
@@ -105,26 +175,24 @@ class QuerySet(object):
         else:
             extra_order_fields = set()
 
-        if complex_fields_requested:
-            # The FindItems service does not support complex field types. Fallback to getting ids and calling GetItems
-            items = self.folder.fetch(
-                ids=self.folder.find_items(self.q, **find_item_kwargs),
-                only_fields=additional_fields
-            )
-        else:
-            # If we requested no additional fields, we can take a shortcut by setting additional_fields=None. This tells
-            # find_items() to do less work.
-            if additional_fields:
-                find_item_kwargs['additional_fields'] = additional_fields
-            items = self.folder.find_items(self.q, **find_item_kwargs)
+        result_cache = None if must_sort_clientside else get_result_cache(self.folder.account.protocol)
+        if result_cache is not None:
+            return self._cached_query(result_cache, q, additional_fields, complex_fields_requested, find_item_kwargs)
+        items = self._get_items(q, additional_fields, complex_fields_requested, find_item_kwargs)
         if not must_sort_clientside:
             return items
 
-        # Resort to client-side sorting of the order_by fields. This is greedy. Sorting in Python is stable, so when
-        # sorting on multiple fields, we can just do a sort on each of the requested fields in reverse order. Reverse
-        # each sort operation if the field was marked as such.
-        for f in reversed(self.order_fields):
-            items = sorted(items, key=f.field_path.get_value, reverse=f.reverse)
+        # Resort to client-side sorting of the order_by fields, with one composite key for all the fields.
+        key = order_key(self.order_fields)
+        first_field = self.order_fields[0]
+        if first_field.field_path.path == 'start' and not first_field.reverse and self.calendar_view.max_items is None:
+            # Long calendar views are fetched in windows that arrive in order. Sort and return one window at a time.
+            items = self._sort_windows(items, key)
+        elif self._limit is not None:
+            # Only keep the items we need in memory
+            items = heapq.nsmallest(self._limit, items, key=key)
+        else:
+            items = sorted(items, key=key)
         if not extra_order_fields:
             return items
 
@@ -135,6 +203,204 @@ class QuerySet(object):
             return i
         return (clean_item(i) for i in items)
 
+    def _query_rows(self):
+        # Returns the query result as tuples of the values of 'only_fields', decoded directly from the XML without
+        # creating Item objects. Returns None if the query needs items, e.g. because complex fields are requested or
+        # the result must be sorted, merged or cached.
+        assert self.only_fields is not None
+        q = self._get_simplified_q()
+        if q is None:
+            return []
+        if self.calendar_view and self.order_fields:
+            return None
+        if {f.field for f in self.only_fields} & self.folder.complex_fields():
+            return None
+        if get_result_cache(self.folder.account.protocol) is not None:
+            return None
+        if not self.calendar_view and len(q.split(max_values=self.MAX_IN_VALUES)) > 1:
+            return None
+        find_item_kwargs = dict(
+            field_paths=self.only_fields,
+            order_fields=None if self.calendar_view else self.order_fields,
+            calendar_view=self.calendar_view,
+            page_size=self.page_size,
+        )
+        if not self.calendar_view:
+            find_item_kwargs.update(offset=self._offset, max_items=self._limit)
+        return self.folder.find_item_rows(q, **find_item_kwargs)
+
+    def _get_items(self, q, additional_fields, complex_fields_requested, find_item_kwargs):
+        if complex_fields_requested:
+            # The FindItems service does not support complex field types. Fallback to getting ids and calling GetItems
+            return self.folder.fetch(
+                ids=self._find_items(q, **find_item_kwargs),
+                only_fields=additional_fields,
+                lazy=self.lazy_mode,
+            )
+        # If we requested no additional fields, we can take a shortcut by setting additional_fields=None. This tells
+        # find_items() to do less work.
+        if additional_fields:
+            find_item_kwargs['additional_fields'] = additional_fields
+        return self._find_items(q, **find_item_kwargs)
+
+    def _result_cache_key(self, q, additional_fields):
+        view = self.calendar_view
+        return (
+            self.folder.account.primary_smtp_address.lower(),
+            self.folder.folder_id or self.folder.name,
+            q.expr(),
+            tuple(sorted(f.path for f in additional_fields)),
+            None if self.order_fields is None else tuple((f.field_path.path, f.reverse) for f in self.order_fields),
+            None if view is None else (view.start, view.end, view.max_items),
+            self._offset,
+            self._limit,
+            # Lazy items keep their XML element until all fields are decoded. Don't serve them to eager queries.
+            self.lazy_mode,
+        )
+
+    def _cached_query(self, result_cache, q, additional_fields, complex_fields_requested, find_item_kwargs):
+        # Returns the query result using the shared result cache. A cached result is revalidated with an IdOnly
+        # FindItem request, and only the items that are new or have a new changekey are fetched.
+        key = self._result_cache_key(q, additional_fields)
+        endpoint = self.folder.account.protocol.service_endpoint
+        metrics = get_metrics(self.folder.account.protocol)
+        entry = result_cache.get(key)
+        if entry is None:
+            metrics.increment(RESULT_CACHE, endpoint=endpoint, result=MISS)
+            return self._fill_result_cache(
+                result_cache, key, self._get_items(q, additional_fields, complex_fields_requested, find_item_kwargs)
+            )
+        if result_cache.is_fresh(entry):
+            metrics.increment(RESULT_CACHE, endpoint=endpoint, result=HIT)
+            return result_cache.get_items(entry)
+        metrics.increment(RESULT_CACHE, endpoint=endpoint, result=REVALIDATED)
+        ids = list(self._find_items(q, **find_item_kwargs))
+        if not additional_fields:
+            # The IDs and changekeys are the full result
+            items = ids
+        else:
+            changed_ids = [i for i in ids if not isinstance(i, Exception) and not entry.is_current(*i)]
+            log.debug('Fetching %s of %s items not in the result cache', len(changed_ids), len(ids))
+            fetched = {}
+            if changed_ids:
+                fetched = dict(zip(
+                    (item_id for item_id, _ in changed_ids),
+                    self.folder.fetch(ids=changed_ids, only_fields=additional_fields, lazy=self.lazy_mode)
+                ))
+            items = []
+            for i in ids:
+                if isinstance(i, Exception):
+                    items.append(i)
+                elif i[0] in fetched:
+                    items.append(fetched[i[0]])
+                else:
+                    items.append(copy(entry.items[i[0]]))
+        if any(isinstance(i, Exception) for i in items):
+            result_cache.delete(key)
+        else:
+            result_cache.put(key, items)
+        return items
+
+    @staticmethod
+    def _fill_result_cache(result_cache, key, items):
+        # Caches the result when the consumer has iterated all items. Results with errors are not cached.
+        res = []
+        for i in items:
+            res.append(i)
+            yield i
+        if not any(isinstance(i, Exception) for i in res):
+            result_cache.put(key, res)
+
+    def _find_items(self, q, **find_item_kwargs):
+        # Calls find_items() on the folder. If the restriction contains long '__in' lookups, it is split into several
+        # restrictions, and the results are merged.
+        restrictions = [q] if self.calendar_view else q.split(max_values=self.MAX_IN_VALUES)
+        if len(restrictions) == 1:
+            return self.folder.find_items(q, **find_item_kwargs)
+        log.debug('Splitting restriction into %s restrictions', len(restrictions))
+        # Each restriction may contribute any of the items in the slice, so get the first offset + limit items of each
+        # restriction, and skip the first 'offset' items of the merged result.
+        offset, limit = find_item_kwargs.pop('offset'), find_item_kwargs.pop('max_items')
+        find_item_kwargs['max_items'] = None if limit is None else offset + limit
+        additional_fields = find_item_kwargs['additional_fields']
+        extra_order_fields = set()
+        if self.order_fields:
+            # We need the values of the order_by fields to merge the results in order
+            extra_order_fields = {f.field_path for f in self.order_fields} - set(additional_fields or ())
+            find_item_kwargs['additional_fields'] = set(additional_fields or ()) | extra_order_fields
+        items = self._find_split(restrictions, **find_item_kwargs)
+        if offset or limit is not None:
+            items = islice(items, offset, None if limit is None else offset + limit)
+        if not extra_order_fields:
+            return items
+        if not additional_fields:
+            # The caller expects (item_id, changekey) tuples
+            return ((i.item_id, i.changekey) if not isinstance(i, Exception) else i for i in items)
+
+        # Nullify the fields we only needed for merging
+        def clean_item(i):
+            if not isinstance(i, Exception):
+                for f in extra_order_fields:
+                    setattr(i, f.field.name, None)
+            return i
+        return (clean_item(i) for i in items)
+
+    def _find_split(self, restrictions, **find_item_kwargs):
+        # Runs find_items() for each restriction in the thread pool, SPLIT_QUERY_CONCURRENCY at a time, and returns the
+        # results. Items that match more than one restriction are only returned once. If the query is ordered, the
+        # results of the restrictions are merged in order. Otherwise, they are returned as each restriction finishes.
+        thread_pool = self.folder.account.protocol.thread_pool
+        find_items = propagate_context(lambda q: list(self.folder.find_items(q, **find_item_kwargs)))
+        restrictions = iter(restrictions)
+        pending = deque()
+
+        def results():
+            while True:
+                for q in islice(restrictions, self.SPLIT_QUERY_CONCURRENCY - len(pending)):
+                    pending.append(thread_pool.apply_async(find_items, (q,)))
+                if not pending:
+                    break
+                yield pending.popleft().get()
+
+        if self.order_fields:
+            # We need the results of all restrictions before we can return the first item. Errors are returned first.
+            all_results = list(results())
+            for i in chain.from_iterable(all_results):
+                if isinstance(i, Exception):
+                    yield i
+            items = _merge_sorted([[i for i in r if not isinstance(i, Exception)] for r in all_results],
+                                  key=order_key(self.order_fields))
+        else:
+            items = chain.from_iterable(results())
+        seen = set()
+        for i in items:
+            if isinstance(i, Exception):
+                yield i
+                continue
+            item_id = i[0] if isinstance(i, tuple) else i.item_id
+            if item_id in seen:
+                continue
+            seen.add(item_id)
+            yield i
+
+    def _sort_windows(self, items, key):
+        # FindItem fetches long calendar views as windows of FindItem.CALENDAR_VIEW_WINDOW, and returns the windows in
+        # order. Each item is returned in the window where it starts (or the first window, if it starts before the
+        # view), so the windows can be sorted one by one when sorting on 'start' first. This makes sorting a streaming
+        # operation, and we stop fetching windows when the consumer stops.
+        from .services import FindItem
+        window_size = FindItem.CALENDAR_VIEW_WINDOW.total_seconds()
+        window, window_items = 0, []
+        for i in items:
+            i_window = max(0, int((i.start - self.calendar_view.start).total_seconds() // window_size))
+            if i_window != window:
+                for sorted_item in sorted(window_items, key=key):
+                    yield sorted_item
+                window, window_items = i_window, []
+            window_items.append(i)
+        for sorted_item in sorted(window_items, key=key):
+            yield sorted_item
+
     def __iter__(self):
         # Fill cache if this is the first iteration. Return an iterator over the results. Make this non-greedy by
         # filling the cache while we are iterating.
@@ -152,16 +418,29 @@ class QuerySet(object):
 
         log.debug('Initializing cache')
         _cache = []
-        result_formatter = {
+        for val in trace_iter(QUERYSET, self._formatted_query, protocol=self.folder.account.protocol,
+                              folder=self.folder.name, return_format=self.return_format):
+            _cache.append(val)
+            yield val
+        self._cache = _cache
+
+    def _formatted_query(self):
+        # Returns the query result in the requested return format. values() and values_list() results are decoded
+        # directly into rows of values when possible.
+        if self.return_format != self.NONE:
+            rows = self._query_rows()
+            if rows is not None:
+                return {
+                    self.VALUES: self._rows_as_values,
+                    self.VALUES_LIST: self._rows_as_values_list,
+                    self.FLAT: self._rows_as_flat_values_list,
+                }[self.return_format](rows)
+        return {
             self.VALUES: self._as_values,
             self.VALUES_LIST: self._as_values_list,
             self.FLAT: self._as_flat_values_list,
             self.NONE: self._as_items,
-        }[self.return_format]
-        for val in result_formatter(self._query()):
-            _cache.append(val)
-            yield val
-        self._cache = _cache
+        }[self.return_format](self._query())
 
     def __len__(self):
         if self._cache is not None:
@@ -177,7 +456,6 @@ class QuerySet(object):
         return self._getitem_slice(idx_or_slice)
 
     def _getitem_idx(self, idx):
-        from .services import FindItem
         assert isinstance(idx, int)
         if self._cache is not None:
             return self._cache[idx]
@@ -186,27 +464,45 @@ class QuerySet(object):
             reverse_idx = -(idx+1)
             return self.reverse()._getitem_idx(reverse_idx)
         else:
-            if self._cache is None and idx < FindItem.CHUNKSIZE:
-                # Optimize a bit by setting self.page_size to only get as many items as strictly needed
-                self.page_size = idx + 1
-            # Support non-negative indexes by consuming the iterator up to the index
-            for i, val in enumerate(self.__iter__()):
-                if i == idx:
-                    return val
+            # Support non-negative indexes by getting a slice of one item
+            for val in self._getitem_slice(slice(idx, idx + 1)):
+                return val
             raise IndexError()
 
     def _getitem_slice(self, s):
-        from .services import FindItem
         assert isinstance(s, slice)
         if ((s.start or 0) < 0) or ((s.stop or 0) < 0) or ((s.step or 0) < 0):
             # islice() does not support negative start, stop and step. Make sure cache is full by iterating the full
             # query result, and then slice on the cache.
             list(self.__iter__())
             return self._cache[s]
-        if self._cache is None and s.stop is not None and s.stop < FindItem.CHUNKSIZE:
-            # Optimize a bit by setting self.page_size to only get as many items as strictly needed
-            self.page_size = s.stop
-        return islice(self.__iter__(), s.start, s.stop, s.step)
+        if self._cache is not None or self.q is None:
+            return islice(self.__iter__(), s.start, s.stop, s.step)
+        if self.calendar_view:
+            # CalendarView does not support offsets, so we need to skip items client-side. If we are sorting
+            # client-side, tell the query how many items we need.
+            new_qs = self._sliced_copy(offset=0, limit=s.stop) if self.order_fields else self
+            return islice(new_qs.__iter__(), s.start, s.stop, s.step)
+        # Let the server skip the first items and stop after the last item we need, using the Offset and
+        # MaxEntriesReturned attributes of IndexedPageItemView.
+        start = s.start or 0
+        if s.stop is not None and s.stop <= start:
+            return iter([])
+        new_qs = self._sliced_copy(offset=start, limit=None if s.stop is None else s.stop - start)
+        return islice(new_qs.__iter__(), None, None, s.step)
+
+    def _sliced_copy(self, offset, limit):
+        # Returns a copy of this QuerySet that only returns a slice of the result. We return a copy to not fill the
+        # cache of this QuerySet with a partial result.
+        from .services import FindItem
+        new_qs = self.copy()
+        new_qs.page_size = self.page_size
+        if new_qs.page_size is None and limit is not None and limit < FindItem.CHUNKSIZE:
+            # Optimize a bit by setting page_size to only get as many items as strictly needed
+            new_qs.page_size = limit
+        new_qs._offset = offset
+        new_qs._limit = limit
+        return new_qs
 
     def _as_items(self, iterable):
         from .items import Item
@@ -282,6 +578,21 @@ class QuerySet(object):
         for i in iterable:
             yield flat_field_path.get_value(i)
 
+    def _rows_as_values(self, rows):
+        assert self.only_fields, 'values() requires at least one field name'
+        paths = [f.path for f in self.only_fields]
+        for row in rows:
+            yield row if isinstance(row, Exception) else dict(zip(paths, row))
+
+    def _rows_as_values_list(self, rows):
+        assert self.only_fields, 'values_list() requires at least one field name'
+        return rows
+
+    def _rows_as_flat_values_list(self, rows):
+        assert self.only_fields and len(self.only_fields) == 1, 'flat=True requires exactly one field name'
+        for row in rows:
+            yield row if isinstance(row, Exception) else row[0]
+
     ###############################
     #
     # Methods that support chaining
@@ -379,6 +690,18 @@ class QuerySet(object):
         new_qs.return_format = self.FLAT if flat else self.VALUES_LIST
         return new_qs
 
+    def lazy(self, mode=None):
+        """ Return items that only decode their fields when the fields are accessed. This saves time when fetching many
+        items with many fields, of which only a few are read. 'mode' is LAZY_PER_FIELD (the default) to decode each
+        field on first access, or LAZY_PER_ITEM to decode all fields of an item on the first access to any field """
+        from .items import LAZY_PER_FIELD, LAZY_CHOICES
+        mode = mode or LAZY_PER_FIELD
+        if mode not in LAZY_CHOICES:
+            raise ValueError("'mode' %s must be one of %s" % (mode, LAZY_CHOICES))
+        new_qs = self.copy()
+        new_qs.lazy_mode = mode
+        return new_qs
+
     ###########################
     #
     # Methods that end chaining
@@ -393,7 +716,47 @@ class QuerySet(object):
             return self._cache
         # Return an iterator that doesn't bother with caching
         self.page_size = page_size
-        return self._query()
+        return trace_iter(QUERYSET, self._query, protocol=self.folder.account.protocol, folder=self.folder.name,
+                          return_format=self.return_format)
+
+    def columns(self, *args):
+        """ Return the values of the specified field names as a dict of lists, keyed by field name. The values are
+        decoded directly from the XML when possible, without creating Item objects """
+        for batch in self.column_batches(*args, batch_size=None):
+            return batch
+        return {arg: [] for arg in args}
+
+    def column_batches(self, *args, **kwargs):
+        """ Return the values of the specified field names as a generator of dicts of lists, keyed by field name, with
+        at most 'batch_size' values in each list. The result is never kept in memory in full. Use this to export large
+        results """
+        batch_size = kwargs.pop('batch_size', 10000)
+        if kwargs:
+            raise AttributeError('Unknown kwargs: %s' % kwargs)
+        assert args, 'column_batches() requires at least one field name'
+        assert batch_size is None or batch_size >= 1
+        new_qs = self.values_list(*args)
+        if new_qs.q is None:
+            return
+        new_qs.page_size = self.page_size
+        paths = [f.path for f in new_qs.only_fields]
+
+        def rows():
+            res = new_qs._query_rows()
+            return new_qs._as_values_list(new_qs._query()) if res is None else res
+
+        columns = [[] for _ in paths]
+        for row in trace_iter(QUERYSET, rows, protocol=self.folder.account.protocol, folder=self.folder.name,
+                              return_format='columns'):
+            if isinstance(row, Exception):
+                raise row
+            for column, value in zip(columns, row):
+                column.append(value)
+            if len(columns[0]) == batch_size:
+                yield dict(zip(paths, columns))
+                columns = [[] for _ in paths]
+        if columns[0]:
+            yield dict(zip(paths, columns))
 
     def get(self, *args, **kwargs):
         """ Assume the query will return exactly one item. Return that item """
@@ -1,7 +1,10 @@
+import calendar
+import datetime
 import logging
 
 from six import string_types
 
+from .ewsdatetime import EWSDate, EWSDateTime
 from .fields import IntegerField, TextField, EnumField, EnumListField, DateField, DateTimeField, EWSElementField
 from .properties import EWSElement, ItemId
 
@@ -51,6 +54,45 @@ EXTRA_WEEKDAY_OPTIONS = (DAY, WEEK_DAY, WEEKEND_DAY)
 WEEKDAYS = WEEKDAY_NAMES + EXTRA_WEEKDAY_OPTIONS
 
 
+def _iso_weekdays(weekdays):
+    # Converts a list of DaysOfWeek values to the set of ISO 8601 weekdays they cover
+    res = set()
+    for i in weekdays:
+        day = WEEKDAYS[i - 1]
+        if day == DAY:
+            res.update(range(1, 8))
+        elif day == WEEK_DAY:
+            res.update(range(1, 6))
+        elif day == WEEKEND_DAY:
+            res.update((6, 7))
+        else:
+            res.add(i)
+    return res
+
+
+def _add_months(year, month, months):
+    # Returns the (year, month) tuple 'months' months after 'month' in 'year'
+    year, month = divmod(year * 12 + month - 1 + months, 12)
+    return year, month + 1
+
+
+def _absolute_day(year, month, day_of_month):
+    # If the month has less days than 'day_of_month', the last day in the month is used
+    return EWSDate(year, month, min(day_of_month, calendar.monthrange(year, month)[1]))
+
+
+def _relative_day(year, month, week_number, weekdays):
+    # Returns the n'th day in the month that is one of 'weekdays'. LAST means the last matching day, also in months
+    # where there are five matching days. A list of several weekdays is treated as a set, like DAY, WEEK_DAY and
+    # WEEKEND_DAY.
+    iso_weekdays = _iso_weekdays(weekdays)
+    days = [d for d in range(1, calendar.monthrange(year, month)[1] + 1)
+            if datetime.date(year, month, d).isoweekday() in iso_weekdays]
+    if WEEK_NUMBERS[week_number - 1] == LAST:
+        return EWSDate(year, month, days[-1])
+    return EWSDate(year, month, days[week_number - 1])
+
+
 class ExtraWeekdaysField(EnumListField):
     def __init__(self, *args, **kwargs):
         kwargs['enum'] = WEEKDAYS
@@ -79,8 +121,38 @@ class ExtraWeekdaysField(EnumListField):
 
 
 class Pattern(EWSElement):
+    # Base class for recurrence patterns. Subclasses define the period of the pattern, e.g. a week or a month, by
+    # implementing period_index() and period_dates(). iter_dates() uses them to expand the pattern.
     __slots__ = tuple()
 
+    def period_index(self, start, d):
+        # Abstract. Returns the number of the period of the pattern that contains 'd', counting from the period
+        # containing 'start'.
+        raise NotImplementedError()
+
+    def period_dates(self, start, n):
+        # Abstract. Returns the dates of the pattern in period number 'n', in order. Dates before 'start' are not
+        # filtered out.
+        raise NotImplementedError()
+
+    def iter_dates(self, start, from_date=None):
+        """
+        Lazily yields the dates matching the pattern, in order, starting at 'start'. If 'from_date' is set, starts at
+        the period containing 'from_date' without generating the dates before it, so windows far into the future are
+        as cheap to expand as the first one. Each period is calculated as a whole, not day by day.
+        """
+        n = 0 if from_date is None or from_date <= start else self.period_index(start, from_date)
+        while True:
+            try:
+                dates = self.period_dates(start, n)
+            except (OverflowError, ValueError):
+                # We went past datetime.MAXYEAR
+                return
+            for d in dates:
+                if d >= start:
+                    yield d
+            n += 1
+
 
 class AbsoluteYearlyPattern(Pattern):
     # MSDN: https://msdn.microsoft.com/en-us/library/office/aa564242(v=exchg.150).aspx
@@ -98,6 +170,12 @@ class AbsoluteYearlyPattern(Pattern):
     def __str__(self):
         return 'Occurs on day %s of %s' % (self.day_of_month, MONTHS[self.month-1])
 
+    def period_index(self, start, d):
+        return d.year - start.year
+
+    def period_dates(self, start, n):
+        return [_absolute_day(start.year + n, self.month, self.day_of_month)]
+
 
 class RelativeYearlyPattern(Pattern):
     # MSDN: https://msdn.microsoft.com/en-us/library/office/bb204113(v=exchg.150).aspx
@@ -121,6 +199,12 @@ class RelativeYearlyPattern(Pattern):
             ', '.join(WEEKDAYS[i - 1] for i in self.weekdays), WEEK_NUMBERS[self.week_number-1], MONTHS[self.month-1]
         )
 
+    def period_index(self, start, d):
+        return d.year - start.year
+
+    def period_dates(self, start, n):
+        return [_relative_day(start.year + n, self.month, self.week_number, self.weekdays)]
+
 
 class AbsoluteMonthlyPattern(Pattern):
     # MSDN: https://msdn.microsoft.com/en-us/library/office/aa493844(v=exchg.150).aspx
@@ -138,6 +222,13 @@ class AbsoluteMonthlyPattern(Pattern):
     def __str__(self):
         return 'Occurs on day %s of every %s month(s)' % (self.day_of_month, self.interval)
 
+    def period_index(self, start, d):
+        return ((d.year - start.year) * 12 + d.month - start.month) // self.interval
+
+    def period_dates(self, start, n):
+        year, month = _add_months(start.year, start.month, n * self.interval)
+        return [_absolute_day(year, month, self.day_of_month)]
+
 
 class RelativeMonthlyPattern(Pattern):
     # MSDN: https://msdn.microsoft.com/en-us/library/office/aa564558(v=exchg.150).aspx
@@ -161,6 +252,13 @@ class RelativeMonthlyPattern(Pattern):
             ', '.join(WEEKDAYS[i - 1] for i in self.weekdays), WEEK_NUMBERS[self.week_number-1], self.interval
         )
 
+    def period_index(self, start, d):
+        return ((d.year - start.year) * 12 + d.month - start.month) // self.interval
+
+    def period_dates(self, start, n):
+        year, month = _add_months(start.year, start.month, n * self.interval)
+        return [_relative_day(year, month, self.week_number, self.weekdays)]
+
 
 class WeeklyPattern(Pattern):
     # MSDN: https://msdn.microsoft.com/en-us/library/office/aa563500(v=exchg.150).aspx
@@ -181,6 +279,22 @@ class WeeklyPattern(Pattern):
             ', '.join(WEEKDAYS[i - 1] for i in self.weekdays), self.interval, WEEKDAYS[self.first_day_of_week-1]
         )
 
+    @property
+    def _first_day(self):
+        # The field default is only applied by clean()
+        return self.first_day_of_week or 1
+
+    def _week_start(self, d):
+        return d - datetime.timedelta(days=(d.isoweekday() - self._first_day) % 7)
+
+    def period_index(self, start, d):
+        return (self._week_start(d) - self._week_start(start)).days // (7 * self.interval)
+
+    def period_dates(self, start, n):
+        week_start = self._week_start(start) + datetime.timedelta(weeks=n * self.interval)
+        offsets = sorted((i - self._first_day) % 7 for i in _iso_weekdays(self.weekdays))
+        return [week_start + datetime.timedelta(days=i) for i in offsets]
+
 
 class DailyPattern(Pattern):
     # MSDN: https://msdn.microsoft.com/en-us/library/office/aa563228(v=exchg.150).aspx
@@ -195,6 +309,12 @@ class DailyPattern(Pattern):
     def __str__(self):
         return 'Occurs every %s day(s)' % self.interval
 
+    def period_index(self, start, d):
+        return (d - start).days // self.interval
+
+    def period_dates(self, start, n):
+        return [start + datetime.timedelta(days=n * self.interval)]
+
 
 class Boundary(EWSElement):
     pass
@@ -355,3 +475,71 @@ class Recurrence(EWSElement):
 
     def __str__(self):
         return 'Pattern: %s, Boundary: %s' % (self.pattern, self.boundary)
+
+    def dates(self, start=None, end=None):
+        """
+        Lazily yields the dates of the occurrences of the recurrence, in order, honoring the boundary. Only dates
+        between 'start' and 'end', both inclusive, are returned.
+        """
+        boundary = self.boundary
+        first = EWSDate.from_date(boundary.start)
+        # We need to count the occurrences of a numbered recurrence from the beginning
+        from_date = None if start is None or isinstance(boundary, NumberedPattern) else start
+        for i, d in enumerate(self.pattern.iter_dates(start=first, from_date=from_date)):
+            if isinstance(boundary, EndDatePattern) and d > boundary.end:
+                return
+            if isinstance(boundary, NumberedPattern) and i >= boundary.number:
+                return
+            if end is not None and d > end:
+                return
+            if start is not None and d < start:
+                continue
+            yield d
+
+    def expand(self, first_start, first_end, start, end, tz=None, modified_occurrences=None,
+               deleted_occurrences=None):
+        """
+        Lazily yields the occurrences of a recurring item that overlap the window from 'start' to 'end', as Occurrence
+        objects ordered by start time. This is what a CalendarView request would return, but without contacting the
+        server.
+
+        :param first_start: the start of the recurring master item, as a timezone-aware EWSDateTime
+        :param first_end: the end of the recurring master item, as a timezone-aware EWSDateTime
+        :param tz: the timezone of the recurrence. Occurrences start at the same local time as the master item in this
+               timezone, also across DST changes. Defaults to the timezone of 'first_start'.
+        :param modified_occurrences: Occurrence objects of the master item. These replace the occurrences at their
+               original start, and are returned if their modified start and end overlaps the window.
+        :param deleted_occurrences: DeletedOccurrence objects of the master item. These occurrences are skipped.
+        """
+        tz = tz or first_start.tzinfo
+        local_first = first_start.astimezone(tz)
+        duration = first_end - first_start
+        deleted = {o.start for o in deleted_occurrences or ()}
+        modified = {o.original_start for o in modified_occurrences or ()}
+        moved = sorted((o for o in modified_occurrences or () if _overlaps(o.start, o.end, start, end)),
+                       key=lambda o: o.start)
+        # Occurrences that start before the window may still overlap it
+        from_date = (start.astimezone(tz) - duration).date() - datetime.timedelta(days=1)
+        for d in self.dates(start=from_date):
+            occurrence_start = tz.localize(EWSDateTime(
+                d.year, d.month, d.day, local_first.hour, local_first.minute, local_first.second,
+                local_first.microsecond
+            ))
+            if occurrence_start >= end:
+                break
+            occurrence_end = occurrence_start + duration
+            if occurrence_start in deleted or occurrence_start in modified:
+                continue
+            if not _overlaps(occurrence_start, occurrence_end, start, end):
+                continue
+            while moved and moved[0].start <= occurrence_start:
+                yield moved.pop(0)
+            yield Occurrence(start=occurrence_start, end=occurrence_end, original_start=occurrence_start)
+        for o in moved:
+            yield o
+
+
+def _overlaps(item_start, item_end, start, end):
+    # Same rule as CalendarView: items that end at the start of the window are not included, but items of zero duration
+    # starting at the start of the window are.
+    return item_start < end and (item_end > start or item_start >= start)
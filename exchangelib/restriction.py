@@ -1,11 +1,14 @@
 # coding=utf-8
+from copy import copy
+import datetime
+from decimal import Decimal
 import logging
 
 from future.utils import python_2_unicode_compatible
-from six import string_types
+from six import string_types, integer_types
 
 from .ewsdatetime import EWSDateTime, UTC
-from .util import create_element, xml_to_str, value_to_xml_text, is_iterable
+from .util import create_element, xml_to_str, value_to_xml_text, is_iterable, chunkify
 from .version import EXCHANGE_2010
 
 log = logging.getLogger(__name__)
@@ -35,6 +38,10 @@ class Q(object):
     EXISTS = 'exists'
     OP_TYPES = {EQ, NE, GT, GTE, LT, LTE, EXACT, IEXACT, CONTAINS, ICONTAINS, STARTSWITH, ISTARTSWITH, EXISTS}
     CONTAINS_OPS = {EXACT, IEXACT, CONTAINS, ICONTAINS, STARTSWITH, ISTARTSWITH}
+    # Operators whose expressions on the same field can be merged by simplify()
+    BOUND_OPS = {EQ, NE, GT, GTE, LT, LTE}
+    # Value types that simplify() can compare. Strings are left alone because the server may compare them differently.
+    BOUND_TYPES = integer_types + (float, Decimal, datetime.date)
 
     # Valid lookups
     LOOKUP_RANGE = 'range'
@@ -279,6 +286,219 @@ class Q(object):
     def is_empty(self):
         return self.is_leaf() and self.field_path is None and self.query_string is None
 
+    def split(self, max_values):
+        """
+        Returns a list of Q objects that together match the same items as this Q object, where no OR'ed list of values,
+        e.g. from an '__in' lookup, has more than 'max_values' values. Lists that are combined with the rest of the
+        query with AND are split into chunks, and each chunk gets a copy of the rest of the query. Lists inside OR and
+        NOT expressions can't be split this way, and are left alone. An item may match more than one of the returned Q
+        objects.
+        """
+        path = self._find_large_or(max_values)
+        if path is None:
+            return [self]
+        node = self
+        for i in path:
+            node = node.children[i]
+        res = []
+        for chunk in chunkify(node.children, max_values):
+            q = self._replace(path, self.__class__(*chunk, conn_type=self.OR))
+            # There may be more lists to split
+            res.extend(q.split(max_values))
+        return res
+
+    def simplify(self):
+        """
+        Returns a Q object that matches the same items as this Q object, but may be smaller: nested AND and OR
+        expressions are flattened, duplicate expressions and double negations are removed, and bounds on the same
+        numeric or date field are merged. Returns None if this Q object can never match anything, e.g.
+        Q(size__gt=10, size__lt=5). The returned object may share nodes with this object.
+        """
+        if self.is_leaf() or self.query_string:
+            return self
+        children = [c.simplify() for c in self.children]
+        if self.conn_type == self.OR:
+            return self._simplify_or(children)
+        if self.conn_type == self.NOT:
+            return self._simplify_not(children)
+        return self._simplify_and(children)
+
+    def _simplify_and(self, children):
+        flat_children = []
+        for c in children:
+            if c is None:
+                # Nothing AND'ed with anything is nothing
+                return None
+            if c.is_empty():
+                continue
+            if not c.is_leaf() and c.conn_type == self.AND:
+                flat_children.extend(c.children)
+            else:
+                flat_children.append(c)
+        flat_children = self._merge_bounds(self._unique(flat_children))
+        if flat_children is None:
+            return None
+        return self._combine(flat_children, conn_type=self.AND)
+
+    def _simplify_or(self, children):
+        flat_children = []
+        for c in children:
+            if c is None:
+                continue
+            if c.is_empty():
+                # Everything OR'ed with anything is everything
+                return self.__class__()
+            if not c.is_leaf() and c.conn_type == self.OR:
+                flat_children.extend(c.children)
+            else:
+                flat_children.append(c)
+        if not flat_children:
+            return None
+        return self._combine(self._unique(flat_children), conn_type=self.OR)
+
+    def _simplify_not(self, children):
+        # The children of a NOT expression are AND'ed
+        q = self._simplify_and(children)
+        if q is None:
+            return self.__class__()
+        if q.is_empty():
+            return None
+        if q.conn_type == self.NOT:
+            # Remove the double negation
+            if q.is_leaf():
+                q = copy(q)
+                q.conn_type = self.AND
+                return q
+            return self._simplify_and(q.children)
+        if q.is_leaf():
+            # __invert__() changes the operator if it can, and changes the object in-place
+            return ~copy(q)
+        return self._combine(q.children if q.conn_type == self.AND else [q], conn_type=self.NOT)
+
+    def _combine(self, children, conn_type):
+        if not children:
+            return self.__class__()
+        if len(children) == 1 and conn_type != self.NOT:
+            return children[0]
+        q = self.__class__(conn_type=conn_type)
+        q.children = children
+        return q
+
+    @staticmethod
+    def _unique(children):
+        # Removes duplicate expressions, keeping the order
+        seen = set()
+        res = []
+        for c in children:
+            key = repr(c)
+            if key in seen:
+                continue
+            seen.add(key)
+            res.append(c)
+        return res
+
+    def _merge_bounds(self, children):
+        # Merges the bounds on each field in a list of AND'ed expressions. Returns None if they contradict each other.
+        bounds = {}
+        res = []
+        for c in children:
+            if c.is_leaf() and c.conn_type != self.NOT and c.op in self.BOUND_OPS \
+                    and isinstance(c.value, self.BOUND_TYPES) and not isinstance(c.value, bool):
+                if c.field_path not in bounds:
+                    bounds[c.field_path] = []
+                    # Keep the position of the first expression on the field
+                    res.append(c.field_path)
+                bounds[c.field_path].append(c)
+            else:
+                res.append(c)
+        merged_children = []
+        for c in res:
+            if not isinstance(c, string_types):
+                merged_children.append(c)
+                continue
+            try:
+                merged = self._merge_field_bounds(bounds[c]) if len(bounds[c]) > 1 else bounds[c]
+            except TypeError:
+                # The values can't be compared, e.g. a date and a datetime
+                merged = bounds[c]
+            if merged is None:
+                return None
+            merged_children.extend(merged)
+        return merged_children
+
+    def _merge_field_bounds(self, leaves):
+        # Returns the smallest list of expressions that is equivalent to 'leaves', a list of expressions on the same
+        # field, or None if they can never all be true.
+        field_path = leaves[0].field_path
+        lower = upper = None  # (value, inclusive)
+        equal, not_equal = [], []
+        for c in leaves:
+            if c.op == self.EQ:
+                equal.append(c.value)
+            elif c.op == self.NE:
+                not_equal.append(c.value)
+            elif c.op in (self.GT, self.GTE):
+                if lower is None or c.value > lower[0] or (c.value == lower[0] and c.op == self.GT):
+                    lower = c.value, c.op == self.GTE
+            elif upper is None or c.value < upper[0] or (c.value == upper[0] and c.op == self.LT):
+                upper = c.value, c.op == self.LTE
+
+        def in_range(v):
+            if lower and (v < lower[0] or (v == lower[0] and not lower[1])):
+                return False
+            if upper and (v > upper[0] or (v == upper[0] and not upper[1])):
+                return False
+            return True
+
+        def leaf(op, value):
+            q = self.__class__()
+            q.field_path, q.op, q.value = field_path, op, value
+            return q
+
+        if equal:
+            value = equal[0]
+            if any(v != value for v in equal) or not in_range(value) or value in not_equal:
+                return None
+            return [leaf(self.EQ, value)]
+        if lower and upper and lower[0] >= upper[0]:
+            if lower[0] == upper[0] and lower[1] and upper[1] and lower[0] not in not_equal:
+                return [leaf(self.EQ, lower[0])]
+            return None
+        res = []
+        if lower:
+            res.append(leaf(self.GTE if lower[1] else self.GT, lower[0]))
+        if upper:
+            res.append(leaf(self.LTE if upper[1] else self.LT, upper[0]))
+        for v in not_equal:
+            # Values outside the bounds are already excluded
+            if in_range(v) and v not in [c.value for c in res if c.op == self.NE]:
+                res.append(leaf(self.NE, v))
+        return res
+
+    def _find_large_or(self, max_values):
+        # Returns the path of child indexes to the first OR node with more than 'max_values' children, that is only
+        # AND'ed with the rest of the query. Returns None if there is no such node.
+        if self.is_leaf() or self.query_string:
+            return None
+        if self.conn_type == self.OR:
+            return [] if len(self.children) > max_values else None
+        if self.conn_type == self.AND:
+            for i, c in enumerate(self.children):
+                path = c._find_large_or(max_values)
+                if path is not None:
+                    return [i] + path
+        return None
+
+    def _replace(self, path, q):
+        # Returns a copy of this Q object where the node at 'path' is replaced with 'q'. Only the nodes along the path
+        # are copied. The copy shares all other nodes with this object.
+        if not path:
+            return q
+        new_q = copy(self)
+        new_q.children = list(self.children)
+        new_q.children[path[0]] = self.children[path[0]]._replace(path[1:], q)
+        return new_q
+
     def expr(self):
         if self.is_empty():
             return None
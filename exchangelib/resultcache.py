@@ -0,0 +1,154 @@
+# coding=utf-8
+"""
+A cache of QuerySet results that is shared between QuerySets. The cache of a QuerySet only lives as long as the
+QuerySet, so identical queries from different parts of an application, e.g. the "unread items in the inbox" query that
+a web application sends for every page view, always go to the server. With a shared result cache, such queries are
+answered with a cheap IdOnly FindItem request, and only new and changed items are fetched again.
+
+The result cache is disabled by default. To enable it, register a ResultCache instance globally or on a single
+Protocol:
+
+    from exchangelib.resultcache import ResultCache, set_global_result_cache
+    set_global_result_cache(ResultCache(ttl=300, max_items=100000))
+    # Or: account.protocol.result_cache = ResultCache(fresh_for=10)
+
+Results are cached per account, folder, restriction, requested fields, ordering, slice and calendar view. When a cached
+query is evaluated again, the IDs and changekeys of the matching items are fetched from the server and compared to the
+cached result. Items with an unchanged changekey are served from the cache, and only items that are new or have changed
+are fetched. Entries that were validated less than 'fresh_for' seconds ago are served without contacting the server.
+
+Items are copied when they are cached and when they are served from the cache, but the copies are shallow. Don't change
+list values or other mutable field values of items in place.
+"""
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from copy import copy
+import logging
+from threading import Lock
+
+from .util import time_func
+
+log = logging.getLogger(__name__)
+
+
+def _get_id(item):
+    # Query results are either items or (item_id, changekey) tuples
+    if isinstance(item, tuple):
+        return item
+    return item.item_id, item.changekey
+
+
+class CacheEntry(object):
+    """
+    A cached query result. Entries are never changed after they are created, so they can be read without locking.
+    """
+    __slots__ = ('ids', 'items', 'changekeys', 'validated')
+
+    def __init__(self, items, validated):
+        self.ids = [_get_id(i) for i in items]  # (item_id, changekey) tuples, in the order of the result
+        self.items = {item_id: i for (item_id, _), i in zip(self.ids, items)}  # Maps item ID to the item
+        self.changekeys = dict(self.ids)
+        self.validated = validated  # The time when the result was last known to be up to date
+
+    def __len__(self):
+        return len(self.ids)
+
+    def is_current(self, item_id, changekey):
+        # Returns True if the cached item has this changekey
+        return item_id in self.changekeys and self.changekeys[item_id] == changekey
+
+
+class ResultCache(object):
+    """
+    A thread-safe cache of query results with a maximum age and a maximum total number of items. Entries that haven't
+    been used for the longest time are evicted first.
+
+    :param ttl: the number of seconds an entry is kept after it was last validated
+    :param fresh_for: the number of seconds after validation that an entry is served without asking the server. The
+           default, 0, means that the IDs and changekeys of the items are always compared with the server.
+    :param max_items: the maximum total number of items in all cached results. Results with more items are not cached.
+    """
+    def __init__(self, ttl=300, fresh_for=0, max_items=100000):
+        assert 0 <= fresh_for <= ttl
+        assert max_items >= 0
+        self.ttl = ttl
+        self.fresh_for = fresh_for
+        self.max_items = max_items
+        self._lock = Lock()
+        self._entries = OrderedDict()  # Least recently used entries first
+        self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        # The total number of items in all cached results
+        return self._size
+
+    def get(self, key):
+        # Returns the entry for 'key', or None if there is no entry or the entry has expired
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if time_func() - entry.validated >= self.ttl:
+                self._size -= len(entry)
+                return None
+            self._entries[key] = entry
+            return entry
+
+    def is_fresh(self, entry):
+        return time_func() - entry.validated < self.fresh_for
+
+    def put(self, key, items):
+        # Caches 'items', a list of items or (item_id, changekey) tuples, and returns the new entry
+        entry = CacheEntry(items=[copy(i) for i in items], validated=time_func())
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._size -= len(old_entry)
+            if len(entry) > self.max_items:
+                log.debug('Not caching a result of %s items', len(entry))
+                return entry
+            self._entries[key] = entry
+            self._size += len(entry)
+            while self._size > self.max_items:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+        return entry
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= len(entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    @staticmethod
+    def get_items(entry):
+        # Returns copies of the items of a cached result, in order
+        return [copy(entry.items[item_id]) for item_id, _ in entry.ids]
+
+
+_global_result_cache = None
+
+
+def set_global_result_cache(result_cache):
+    # Registers a result cache for all protocols that don't have their own. Pass None to disable the cache again.
+    global _global_result_cache
+    assert result_cache is None or isinstance(result_cache, ResultCache)
+    _global_result_cache = result_cache
+
+
+def get_result_cache(protocol=None):
+    # Returns the result cache registered on the protocol, or the global result cache. None means caching is disabled.
+    result_cache = getattr(protocol, 'result_cache', None)
+    if result_cache is None:
+        return _global_result_cache
+    return result_cache
@@ -13,11 +13,16 @@ Exchange EWS references:
 from __future__ import unicode_literals
 
 import abc
+from collections import deque
+import datetime
 from itertools import chain
 import logging
+import re
+from threading import Thread, Event
 import traceback
 from xml.etree.ElementTree import ParseError
 
+from future.moves.queue import Queue, Full
 from six import text_type
 
 from . import errors
@@ -28,12 +33,15 @@ from .errors import EWSWarning, TransportError, SOAPError, ErrorTimeoutExpired,
     ErrorMailboxMoveInProgress, ErrorAccessDenied, ErrorConnectionFailed, RateLimitError, ErrorServerBusy, \
     ErrorTooManyObjectsOpened, ErrorInvalidLicense, ErrorInvalidSchemaVersionForMailboxVersion, \
     ErrorInvalidServerVersion, ErrorItemNotFound, ErrorADUnavailable, ResponseMessageError, ErrorInvalidChangeKey, \
-    ErrorItemSave, ErrorInvalidIdMalformed, ErrorMessageSizeExceeded, UnauthorizedError, ErrorCannotDeleteTaskOccurrence
+    ErrorItemSave, ErrorInvalidIdMalformed, ErrorMessageSizeExceeded, UnauthorizedError, \
+    ErrorCannotDeleteTaskOccurrence, ErrorExceededFindCountLimit, ErrorCalendarViewRangeTooBig
 from .ewsdatetime import EWSDateTime, UTC
+from .metrics import get_metrics, SERVICE_REQUESTS, SERVICE_LATENCY, SUCCESS
+from .tracing import start_span, propagate_context, SERVICE, CHUNK, XML_PARSE
 from .transport import wrap, SOAPNS, TNS, MNS, ENS
 from .util import chunkify, create_element, add_xml_child, get_xml_attr, to_xml, post_ratelimited, ElementType, \
-    xml_to_str, set_xml_value
-from .version import EXCHANGE_2010, EXCHANGE_2013
+    xml_to_str, set_xml_value, time_func
+from .version import EXCHANGE_2010, EXCHANGE_2010_SP1, EXCHANGE_2013
 
 log = logging.getLogger(__name__)
 
@@ -110,6 +118,22 @@ class EWSService(object):
             raise
 
     def _get_response_xml(self, payload):
+        # Takes an XML tree and returns SOAP payload as an XML tree. Reports metrics and a tracing span for the request.
+        metrics = get_metrics(self.protocol)
+        outcome = SUCCESS
+        t1 = time_func()
+        with start_span(SERVICE, protocol=self.protocol, service=self.SERVICE_NAME):
+            try:
+                return self._send_payload(payload=payload)
+            except Exception as e:
+                outcome = e.__class__.__name__
+                raise
+            finally:
+                labels = dict(service=self.SERVICE_NAME, endpoint=self.protocol.service_endpoint, outcome=outcome)
+                metrics.increment(SERVICE_REQUESTS, **labels)
+                metrics.observe(SERVICE_LATENCY, time_func() - t1, **labels)
+
+    def _send_payload(self, payload):
         # Takes an XML tree and returns SOAP payload as an XML tree
         assert isinstance(payload, ElementType)
         # Microsoft really doesn't want to make our lives easy. The server may report one version in our initial version
@@ -135,11 +159,13 @@ class EWSService(object):
                 data=soap_payload,
                 timeout=self.protocol.TIMEOUT,
                 verify=self.protocol.verify_ssl,
-                allow_redirects=False)
+                allow_redirects=False,
+                service=self.SERVICE_NAME)
             self.protocol.release_session(session)
             log.debug('Trying API version %s for account %s', api_version, account)
             try:
-                soap_response_payload = to_xml(r.text)
+                with start_span(XML_PARSE, protocol=self.protocol, service=self.SERVICE_NAME):
+                    soap_response_payload = to_xml(r.text)
             except ParseError as e:
                 raise SOAPError('Bad SOAP response: %s' % e)
             try:
@@ -298,16 +324,22 @@ class EWSFolderService(EWSAccountService):
 
 
 class PagingEWSMixIn(EWSService):
-    def _paged_call(self, payload_func, **kwargs):
+    def _paged_call(self, payload_func, offset=0, max_items=None, **kwargs):
+        # Gets pages of items starting at 'offset' until there are no more items, or we have 'max_items' items
         account = self.account if isinstance(self, EWSAccountService) else None
         log_prefix = 'EWS %s, account %s, service %s' % (self.protocol.service_endpoint, account, self.SERVICE_NAME)
-        next_offset = 0
+        next_offset = offset
         calendar_view = kwargs.get('calendar_view')
-        max_items = None if calendar_view is None else calendar_view.max_items  # Hack, see below
+        if calendar_view is not None:
+            max_items = calendar_view.max_items  # Hack, see below
+        page_size = kwargs.get('page_size')
         item_count = 0
         while True:
             log.debug('%s: Getting items at offset %s', log_prefix, next_offset)
             kwargs['offset'] = next_offset
+            if page_size and max_items:
+                # Don't ask for more items than we need
+                kwargs['page_size'] = min(page_size, max_items - item_count)
             payload = payload_func(**kwargs)
             response = self._get_response_xml(payload=payload)
             rootfolder, next_offset = self._get_page(response)
@@ -317,6 +349,8 @@ class PagingEWSMixIn(EWSService):
                     raise TransportError('No %s elements in ResponseMessage (%s)' % (self.element_container_name,
                                                                                      xml_to_str(rootfolder)))
                 for elem in self._get_elements_in_container(container=container):
+                    if max_items and item_count >= max_items:
+                        break
                     item_count += 1
                     yield elem
                 if max_items and item_count >= max_items:
@@ -327,9 +361,9 @@ class PagingEWSMixIn(EWSService):
                     break
             if not next_offset:
                 break
-            if next_offset != item_count:
+            if next_offset != offset + item_count:
                 # Check paging offsets
-                raise TransportError('Unexpected next offset: %s -> %s' % (item_count, next_offset))
+                raise TransportError('Unexpected next offset: %s -> %s' % (offset + item_count, next_offset))
 
     def _get_page(self, response):
         assert len(response) == 1
@@ -348,6 +382,57 @@ class PagingEWSMixIn(EWSService):
         return rootfolder, next_offset
 
 
+class SyncingEWSMixIn(EWSService):
+    # Change types in the Changes element of SyncFolderItems and SyncFolderHierarchy responses
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    READ_FLAG_CHANGE = 'read_flag_change'
+    CHANGE_TYPES_MAP = {
+        '{%s}Create' % TNS: CREATE,
+        '{%s}Update' % TNS: UPDATE,
+        '{%s}Delete' % TNS: DELETE,
+        '{%s}ReadFlagChange' % TNS: READ_FLAG_CHANGE,
+    }
+    last_in_range_name = None  # The name of the XML element telling us if there are more changes to get
+
+    def __init__(self, *args, **kwargs):
+        super(SyncingEWSMixIn, self).__init__(*args, **kwargs)
+        self.sync_state = None
+
+    def _sync_call(self, payload_func, sync_state, **kwargs):
+        # Keep asking for changes until the server says we have them all. self.sync_state is only updated when all
+        # changes on a page have been consumed, so it's always safe for the caller to persist the current sync state and
+        # resume from it later.
+        account = self.account if isinstance(self, EWSAccountService) else None
+        log_prefix = 'EWS %s, account %s, service %s' % (self.protocol.service_endpoint, account, self.SERVICE_NAME)
+        self.sync_state = sync_state
+        while True:
+            log.debug('%s: Getting changes since sync state %s', log_prefix, self.sync_state)
+            kwargs['sync_state'] = self.sync_state
+            payload = payload_func(**kwargs)
+            response = self._get_response_xml(payload=payload)
+            assert len(response) == 1
+            container_or_exc = self._get_element_container(message=response[0], name=self.element_container_name)
+            if isinstance(container_or_exc, Exception):
+                # We can't skip past this page without losing changes
+                raise container_or_exc
+            next_sync_state = get_xml_attr(response[0], '{%s}SyncState' % MNS)
+            # Don't loop forever if the server forgets to tell us
+            is_last_page = get_xml_attr(response[0], self.last_in_range_name) != 'false'
+            for change in container_or_exc:
+                change_type = self.CHANGE_TYPES_MAP[change.tag]
+                if change_type in (self.CREATE, self.UPDATE):
+                    # The item or folder element is wrapped in the Create or Update element
+                    yield change_type, change[0]
+                else:
+                    yield change_type, change
+            self.sync_state = next_sync_state
+            log.debug('%s: Got page of changes (last_page %s)', log_prefix, is_last_page)
+            if is_last_page:
+                break
+
+
 class GetServerTimeZones(EWSService):
     """
     MSDN: https://msdn.microsoft.com/en-us/library/office/dd899371(v=exchg.150).aspx
@@ -415,8 +500,71 @@ class GetRooms(EWSService):
 
 class EWSPooledMixIn(EWSService):
     CHUNKSIZE = None
+    # When 'items' is a generator, the maximum number of chunks that are started but not yet consumed
+    MAX_PENDING_CHUNKS = 4
+
+    def _get_chunk_elements(self, payload_func, chunk, chunk_number, kwargs):
+        with start_span(CHUNK, protocol=self.protocol, service=self.SERVICE_NAME, chunk_number=chunk_number,
+                        chunk_size=len(chunk)):
+            return self._get_elements(payload=payload_func(chunk, **kwargs))
 
     def _pool_requests(self, payload_func, items, **kwargs):
+        if not hasattr(items, '__len__'):
+            return self._pipeline_requests(payload_func, items, **kwargs)
+        return self._pool_sized_requests(payload_func, items, **kwargs)
+
+    def _pipeline_requests(self, payload_func, items, **kwargs):
+        # 'items' is a generator that may be slow, e.g. the item IDs from a paging FindItem request. Consume it in a
+        # feeder thread that starts a worker for each chunk as soon as the chunk is complete. Producing the next chunk
+        # then overlaps with the workers and with the consumer handling the results. The queue of started chunks is
+        # bounded, so a slow consumer pauses the feeder instead of piling up results in memory.
+        results = Queue(maxsize=self.MAX_PENDING_CHUNKS)
+        stopped = Event()
+
+        def put(kind, value):
+            # Returns False if the consumer has gone away
+            while not stopped.is_set():
+                try:
+                    results.put((kind, value), timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def feed():
+            try:
+                for n, chunk in enumerate(chunkify(items, self.CHUNKSIZE), 1):
+                    log.debug('Starting %s._get_elements worker %s for %s items', self.__class__.__name__, n,
+                              len(chunk))
+                    r = self.protocol.thread_pool.apply_async(
+                        propagate_context(self._get_chunk_elements),
+                        (payload_func, chunk, n, kwargs)
+                    )
+                    if not put('result', r):
+                        log.debug('Consumer of %s results has stopped', self.__class__.__name__)
+                        return
+            except Exception as e:
+                put('error', e)
+                return
+            put('done', None)
+
+        # Carry the tracing context of this thread into the feeder thread
+        feeder = Thread(target=propagate_context(feed))
+        feeder.daemon = True
+        feeder.start()
+        try:
+            while True:
+                kind, value = results.get()
+                if kind == 'done':
+                    break
+                if kind == 'error':
+                    raise value
+                for elem in value.get():
+                    yield elem
+        finally:
+            stopped.set()
+
+    def _pool_sized_requests(self, payload_func, items, **kwargs):
         log.debug('Processing items in chunks of %s', self.CHUNKSIZE)
         # Chop items list into suitable pieces and let worker threads chew on the work. The order of the output result
         # list must be the same as the input id list, so the caller knows which status message belongs to which ID.
@@ -425,11 +573,12 @@ class EWSPooledMixIn(EWSService):
         n = 1
         for chunk in chunkify(items, self.CHUNKSIZE):
             log.debug('Starting %s._get_elements worker %s for %s items', self.__class__.__name__, n, len(chunk))
-            n += 1
+            # Carry the tracing context of this thread into the worker thread
             results.append(self.protocol.thread_pool.apply_async(
-                lambda c: self._get_elements(payload=payload_func(c, **kwargs)),
-                (chunk,)
+                propagate_context(self._get_chunk_elements),
+                (payload_func, chunk, n, kwargs)
             ))
+            n += 1
             # Results will be available before iteration has finished if 'items' is a slow generator. Return early
             for i, r in enumerate(results, 1):
                 if r is None:
@@ -761,8 +910,17 @@ class FindItem(EWSFolderService, PagingEWSMixIn):
     SERVICE_NAME = 'FindItem'
     element_container_name = '{%s}Items' % TNS
     CHUNKSIZE = 100
-
-    def call(self, additional_fields, restriction, order_fields, shape, query_string, depth, calendar_view, page_size):
+    # EWS does not page calendar views, and refuses or truncates views with too many items. Calendar views longer than
+    # this are split into windows that are fetched in parallel. Windows with too many items are split in half, down
+    # to MIN_CALENDAR_VIEW_WINDOW.
+    CALENDAR_VIEW_WINDOW = datetime.timedelta(days=28)
+    MIN_CALENDAR_VIEW_WINDOW = datetime.timedelta(hours=1)
+    # The maximum number of windows fetched ahead of the consumer, so a consumer that stops early doesn't pull the
+    # whole view into memory.
+    CALENDAR_VIEW_CONCURRENCY = 4
+
+    def call(self, additional_fields, restriction, order_fields, shape, query_string, depth, calendar_view, page_size,
+             offset=0, max_items=None):
         """
         Find items in an account.
 
@@ -774,9 +932,22 @@ class FindItem(EWSFolderService, PagingEWSMixIn):
         :param depth: How deep in the folder structure to search for items
         :param calendar_view: If set, returns recurring calendar items unfolded
         :param page_size: The number of items to return per request
+        :param offset: The number of items to skip. Ignored for calendar views.
+        :param max_items: The maximum number of items to return. Ignored for calendar views.
         :return: XML elements for the matching items
         """
-        return self._paged_call(payload_func=self.get_payload, **dict(
+        if calendar_view is not None and calendar_view.max_items is None \
+                and calendar_view.end - calendar_view.start > self.CALENDAR_VIEW_WINDOW:
+            return self._split_calendar_view(payload_func=self.get_payload, calendar_view=calendar_view, **dict(
+                additional_fields=additional_fields,
+                restriction=restriction,
+                order_fields=order_fields,
+                query_string=query_string,
+                shape=shape,
+                depth=depth,
+                page_size=page_size,
+            ))
+        return self._paged_call(payload_func=self.get_payload, offset=offset, max_items=max_items, **dict(
             additional_fields=additional_fields,
             restriction=restriction,
             order_fields=order_fields,
@@ -787,6 +958,72 @@ class FindItem(EWSFolderService, PagingEWSMixIn):
             page_size=page_size,
         ))
 
+    def _get_window(self, payload_func, kwargs):
+        # Gets the items in a single calendar view window. Returns the XML elements, or the exception if the server
+        # refused the window, and whether the window had more items than the server was willing to return.
+        calendar_view = kwargs['calendar_view']
+        with start_span(CHUNK, protocol=self.protocol, service=self.SERVICE_NAME, window_start=calendar_view.start,
+                        window_end=calendar_view.end):
+            try:
+                response = self._get_response_xml(payload=payload_func(**kwargs))
+                rootfolder, next_offset = self._get_page(response)
+            except (ErrorExceededFindCountLimit, ErrorCalendarViewRangeTooBig) as e:
+                return e, True
+            if rootfolder is None:
+                return [], False
+            container = rootfolder.find(self.element_container_name)
+            if container is None:
+                raise TransportError('No %s elements in ResponseMessage (%s)' % (self.element_container_name,
+                                                                                 xml_to_str(rootfolder)))
+            return self._get_elements_in_container(container=container), next_offset is not None
+
+    def _start_window(self, payload_func, calendar_view, kwargs):
+        kwargs = dict(kwargs, calendar_view=calendar_view)
+        # Carry the tracing context of this thread into the worker thread
+        return calendar_view, self.protocol.thread_pool.apply_async(
+            propagate_context(self._get_window), (payload_func, kwargs)
+        )
+
+    def _split_calendar_view(self, payload_func, calendar_view, **kwargs):
+        # Fetches the calendar view as a series of shorter windows, in parallel. The results are returned in the order
+        # of the windows. Occurrences overlapping more than one window are only returned the first time.
+        view_cls = calendar_view.__class__
+        windows = deque()
+        window_start = calendar_view.start
+        while window_start < calendar_view.end:
+            window_end = min(window_start + self.CALENDAR_VIEW_WINDOW, calendar_view.end)
+            windows.append(view_cls(start=window_start, end=window_end))
+            window_start = window_end
+        log.debug('Splitting calendar view %s -> %s into %s windows', calendar_view.start, calendar_view.end,
+                  len(windows))
+        pending = deque()
+        seen = set()
+        while pending or windows:
+            while windows and len(pending) < self.CALENDAR_VIEW_CONCURRENCY:
+                pending.append(self._start_window(payload_func, windows.popleft(), kwargs))
+            window, result = pending.popleft()
+            elems, overflowed = result.get()
+            if overflowed:
+                length = window.end - window.start
+                if length > self.MIN_CALENDAR_VIEW_WINDOW:
+                    middle = window.start + length // 2
+                    log.debug('Calendar view window %s -> %s has too many items. Splitting at %s', window.start,
+                              window.end, middle)
+                    pending.appendleft(self._start_window(payload_func, view_cls(start=middle, end=window.end), kwargs))
+                    pending.appendleft(self._start_window(payload_func, view_cls(start=window.start, end=middle),
+                                                          kwargs))
+                    continue
+                if isinstance(elems, Exception):
+                    raise elems
+                log.warning('Calendar view window %s -> %s was truncated by the server', window.start, window.end)
+            for elem in elems:
+                item_id = elem.find('{%s}ItemId' % TNS)
+                if item_id is not None:
+                    if item_id.get('Id') in seen:
+                        continue
+                    seen.add(item_id.get('Id'))
+                yield elem
+
     def get_payload(self, additional_fields, restriction, order_fields, query_string, shape, depth, calendar_view,
                     page_size, offset=0):
         finditem = create_element('m:%s' % self.SERVICE_NAME, Traversal=depth)
@@ -866,10 +1103,11 @@ class FindFolder(EWSFolderService, PagingEWSMixIn):
         return findfolder
 
 
-class GetFolder(EWSAccountService):
+class GetFolder(EWSAccountService, EWSPooledMixIn):
     """
     MSDN: https://msdn.microsoft.com/en-us/library/office/aa580263(v=exchg.150).aspx
     """
+    CHUNKSIZE = 100
     SERVICE_NAME = 'GetFolder'
     element_container_name = '{%s}Folders' % MNS
 
@@ -882,8 +1120,9 @@ class GetFolder(EWSAccountService):
         :param shape: The set of attributes to return
         :return: XML elements for the folders, in stable order
         """
-        return self._get_elements(payload=self.get_payload(
-            folders=folders,
+        # _pool_requests expects 'items', not 'folders'
+        return self._pool_requests(payload_func=self.get_payload, **dict(
+            items=folders,
             additional_fields=additional_fields,
             shape=shape,
         ))
@@ -913,15 +1152,121 @@ class GetFolder(EWSAccountService):
         return getfolder
 
 
-class SendItem(EWSAccountService):
+class SyncFolderHierarchy(EWSFolderService, SyncingEWSMixIn):
+    """
+    MSDN: https://msdn.microsoft.com/en-us/library/office/aa580990(v=exchg.150).aspx
+    """
+    SERVICE_NAME = 'SyncFolderHierarchy'
+    element_container_name = '{%s}Changes' % MNS
+    last_in_range_name = '{%s}IncludesLastFolderInRange' % MNS
+
+    def call(self, additional_fields, shape, sync_state):
+        """
+        Returns the changes to the folders below a folder since the given sync state, page by page. The new sync state
+        is available in self.sync_state.
+
+        :param additional_fields: the extra fields that should be returned with created and updated folders, as
+                                  FieldPath objects
+        :param shape: The set of attributes to return
+        :param sync_state: the sync state returned by a previous sync, or None to get all folders as 'create' changes
+        :return: (change_type, XML element) tuples, in the order the changes were returned by the server
+        """
+        return self._sync_call(payload_func=self.get_payload, sync_state=sync_state, **dict(
+            additional_fields=additional_fields,
+            shape=shape,
+        ))
+
+    def get_payload(self, additional_fields, shape, sync_state):
+        syncfolderhierarchy = create_element('m:%s' % self.SERVICE_NAME)
+        foldershape = create_element('m:FolderShape')
+        add_xml_child(foldershape, 't:BaseShape', shape)
+        if additional_fields:
+            additional_properties = create_element('t:AdditionalProperties')
+            expanded_fields = chain(*(f.expand(version=self.account.version) for f in additional_fields))
+            set_xml_value(additional_properties, expanded_fields, self.account.version)
+            foldershape.append(additional_properties)
+        syncfolderhierarchy.append(foldershape)
+        syncfolderid = create_element('m:SyncFolderId')
+        syncfolderid.append(self._folder_elem(self.folder))
+        syncfolderhierarchy.append(syncfolderid)
+        if sync_state:
+            add_xml_child(syncfolderhierarchy, 'm:SyncState', sync_state)
+        return syncfolderhierarchy
+
+
+class SyncFolderItems(EWSFolderService, SyncingEWSMixIn):
+    """
+    MSDN: https://msdn.microsoft.com/en-us/library/office/aa563967(v=exchg.150).aspx
+    """
+    SERVICE_NAME = 'SyncFolderItems'
+    element_container_name = '{%s}Changes' % MNS
+    last_in_range_name = '{%s}IncludesLastItemInRange' % MNS
+    CHUNKSIZE = 512  # The maximum value of MaxChangesReturned
+
+    def call(self, additional_fields, sync_state, ignore, max_changes_returned, sync_scope):
+        """
+        Returns the changes to items in a folder since the given sync state, page by page. The new sync state is
+        available in self.sync_state.
+
+        :param additional_fields: the extra fields that should be returned with created and updated items, as FieldPath
+                                  objects
+        :param sync_state: the sync state returned by a previous sync, or None to get all items as 'create' changes
+        :param ignore: a list of (id, changekey) tuples or Item objects to ignore changes for
+        :param max_changes_returned: the maximum number of changes to return per request
+        :param sync_scope: whether to include associated items. Requires Exchange 2010 or later
+        :return: (change_type, XML element) tuples, in the order the changes were returned by the server
+        """
+        if sync_scope and self.account.version.build < EXCHANGE_2010:
+            raise NotImplementedError('SyncScope is only supported for Exchange 2010 servers and later')
+        return self._sync_call(payload_func=self.get_payload, sync_state=sync_state, **dict(
+            additional_fields=additional_fields,
+            ignore=ignore,
+            max_changes_returned=max_changes_returned,
+            sync_scope=sync_scope,
+        ))
+
+    def get_payload(self, additional_fields, sync_state, ignore, max_changes_returned, sync_scope):
+        from .folders import ItemId
+        from .items import IdOnly
+        syncfolderitems = create_element('m:%s' % self.SERVICE_NAME)
+        itemshape = create_element('m:ItemShape')
+        add_xml_child(itemshape, 't:BaseShape', IdOnly)
+        if additional_fields:
+            additional_properties = create_element('t:AdditionalProperties')
+            expanded_fields = chain(*(f.expand(version=self.account.version) for f in additional_fields))
+            set_xml_value(additional_properties, expanded_fields, self.account.version)
+            itemshape.append(additional_properties)
+        syncfolderitems.append(itemshape)
+        syncfolderid = create_element('m:SyncFolderId')
+        syncfolderid.append(self._folder_elem(self.folder))
+        syncfolderitems.append(syncfolderid)
+        if sync_state:
+            add_xml_child(syncfolderitems, 'm:SyncState', sync_state)
+        if ignore:
+            item_ids = create_element('m:Ignore')
+            for item in ignore:
+                item_id = ItemId(*(item if isinstance(item, tuple) else (item.item_id, item.changekey)))
+                set_xml_value(item_ids, item_id, self.account.version)
+            syncfolderitems.append(item_ids)
+        add_xml_child(syncfolderitems, 'm:MaxChangesReturned', max_changes_returned)
+        if sync_scope:
+            add_xml_child(syncfolderitems, 'm:SyncScope', sync_scope)
+        return syncfolderitems
+
+
+class SendItem(EWSAccountService, EWSPooledMixIn):
     """
     MSDN: https://msdn.microsoft.com/en-us/library/office/aa580238(v=exchg.150).aspx
     """
+    CHUNKSIZE = 25
     SERVICE_NAME = 'SendItem'
     element_container_name = None  # SendItem doesn't return a response object, just status in XML attrs
 
     def call(self, items, saved_item_folder):
-        return self._get_elements(payload=self.get_payload(items=items, saved_item_folder=saved_item_folder))
+        return self._pool_requests(payload_func=self.get_payload, **dict(
+            items=items,
+            saved_item_folder=saved_item_folder,
+        ))
 
     def get_payload(self, items, saved_item_folder):
         from .folders import ItemId
@@ -943,15 +1288,16 @@ class SendItem(EWSAccountService):
         return senditem
 
 
-class MoveItem(EWSAccountService):
+class MoveItem(EWSAccountService, EWSPooledMixIn):
     """
     MSDN: https://msdn.microsoft.com/en-us/library/office/aa565781(v=exchg.150).aspx
     """
+    CHUNKSIZE = 100
     SERVICE_NAME = 'MoveItem'
     element_container_name = '{%s}Items' % MNS
 
     def call(self, items, to_folder):
-        return self._get_elements(payload=self.get_payload(
+        return self._pool_requests(payload_func=self.get_payload, **dict(
             items=items,
             to_folder=to_folder,
         ))
@@ -976,6 +1322,229 @@ class MoveItem(EWSAccountService):
         return moveeitem
 
 
+class Subscribe(EWSAccountService):
+    """
+    MSDN: https://msdn.microsoft.com/en-us/library/office/aa566188(v=exchg.150).aspx
+    """
+    SERVICE_NAME = 'Subscribe'
+    element_container_name = '{%s}SubscriptionId' % MNS
+
+    def call(self, folders, event_types, watermark, timeout, streaming):
+        """
+        Creates a pull or streaming subscription for events in the given folders.
+
+        :param folders: a list of Folder objects
+        :param event_types: a list of event type names, e.g. 'NewMailEvent'
+        :param watermark: the watermark to resume a previous pull subscription from, if any
+        :param timeout: the number of minutes a pull subscription stays alive without any GetEvents requests
+        :param streaming: whether to create a streaming subscription instead of a pull subscription
+        :return: (subscription_id, watermark) tuples. Streaming subscriptions don't have a watermark
+        """
+        if streaming and self.account.version.build < EXCHANGE_2010_SP1:
+            raise NotImplementedError('Streaming subscriptions are only supported for Exchange 2010 SP1 servers and '
+                                      'later')
+        return self._get_elements(payload=self.get_payload(
+            folders=folders,
+            event_types=event_types,
+            watermark=watermark,
+            timeout=timeout,
+            streaming=streaming,
+        ))
+
+    def get_payload(self, folders, event_types, watermark, timeout, streaming):
+        subscribe = create_element('m:%s' % self.SERVICE_NAME)
+        if streaming:
+            request_elem = create_element('m:StreamingSubscriptionRequest')
+        else:
+            request_elem = create_element('m:PullSubscriptionRequest')
+        folder_ids = create_element('t:FolderIds')
+        is_empty = True
+        for folder in folders:
+            is_empty = False
+            folder_ids.append(self._folder_elem(folder))
+        assert not is_empty, '"folders" must not be empty'
+        request_elem.append(folder_ids)
+        event_types_elem = create_element('t:EventTypes')
+        for event_type in event_types:
+            add_xml_child(event_types_elem, 't:EventType', event_type)
+        request_elem.append(event_types_elem)
+        if not streaming:
+            if watermark:
+                add_xml_child(request_elem, 't:Watermark', watermark)
+            add_xml_child(request_elem, 't:Timeout', timeout)
+        subscribe.append(request_elem)
+        return subscribe
+
+    def _get_elements_in_response(self, response):
+        for msg in response:
+            container_or_exc = self._get_element_container(message=msg, name=self.element_container_name)
+            if isinstance(container_or_exc, ElementType):
+                yield container_or_exc.text, get_xml_attr(msg, '{%s}Watermark' % MNS)
+            else:
+                yield container_or_exc
+
+
+class GetEvents(EWSAccountService):
+    """
+    MSDN: https://msdn.microsoft.com/en-us/library/office/aa566199(v=exchg.150).aspx
+    """
+    SERVICE_NAME = 'GetEvents'
+    element_container_name = '{%s}Notification' % MNS
+
+    def call(self, subscription_id, watermark):
+        """
+        Returns the Notification element containing the events of a pull subscription since the given watermark.
+        """
+        return self._get_elements(payload=self.get_payload(subscription_id=subscription_id, watermark=watermark))
+
+    def get_payload(self, subscription_id, watermark):
+        getevents = create_element('m:%s' % self.SERVICE_NAME)
+        add_xml_child(getevents, 'm:SubscriptionId', subscription_id)
+        add_xml_child(getevents, 'm:Watermark', watermark)
+        return getevents
+
+    def _get_elements_in_container(self, container):
+        # We want the whole Notification element. It contains the MoreEvents flag in addition to the events
+        return [container]
+
+
+class GetStreamingEvents(EWSAccountService):
+    """
+    MSDN: https://msdn.microsoft.com/en-us/library/office/ff406172(v=exchg.150).aspx
+
+    The server keeps the HTTP connection open and sends a SOAP envelope every time there are new events or the
+    connection needs a heartbeat, until 'connection_timeout' minutes have passed. All subscriptions on a connection must
+    be accessible by the account the request is sent as.
+    """
+    SERVICE_NAME = 'GetStreamingEvents'
+    element_container_name = '{%s}Notifications' % MNS
+    # Matches the end of a SOAP envelope in a stream of envelopes
+    ENVELOPE_END = re.compile(br'</(?:[A-Za-z0-9_]+:)?Envelope\s*>')
+
+    def __init__(self, *args, **kwargs):
+        super(GetStreamingEvents, self).__init__(*args, **kwargs)
+        self._response = None  # The streaming response, so close() can interrupt a connection from another thread
+        self._closed = False  # Set by close(), in case it is called before the response has arrived
+
+    def call(self, subscription_ids, connection_timeout):
+        """
+        Opens a connection that returns events for the given streaming subscriptions as they happen.
+
+        :param subscription_ids: a list of subscription IDs
+        :param connection_timeout: the number of minutes to keep the connection open (1-30)
+        :return: (subscription_id, Notification XML element) tuples as they arrive, or (subscription_id, exception)
+                 tuples for subscriptions that failed
+        """
+        if self.account.version.build < EXCHANGE_2010_SP1:
+            raise NotImplementedError('%s is only supported for Exchange 2010 SP1 servers and later' %
+                                      self.SERVICE_NAME)
+        payload = self.get_payload(subscription_ids=subscription_ids, connection_timeout=connection_timeout)
+        session = self.protocol.get_session()
+        r, session = post_ratelimited(
+            protocol=self.protocol,
+            session=session,
+            url=self.protocol.service_endpoint,
+            headers=None,
+            data=wrap(content=payload, version=self.account.version.api_version, account=self.account),
+            timeout=self.protocol.TIMEOUT,
+            verify=self.protocol.verify_ssl,
+            allow_redirects=False,
+            stream=True,
+            service=self.SERVICE_NAME)
+        self._response = r
+        if self._closed:
+            # close() was called while we were waiting for the response and couldn't interrupt the connection
+            self._response = None
+            r.close()
+            self.protocol.retire_session(session)
+            return
+        try:
+            for soap_response in self._get_soap_responses(r):
+                for msg in self._get_soap_payload(soap_response=soap_response):
+                    for res in self._get_notifications(msg):
+                        yield res
+        except Exception:
+            # The connection is in an unknown state. Don't reuse it.
+            self._response = None
+            r.close()
+            self.protocol.retire_session(session)
+            raise
+        self._response = None
+        r.close()
+        self.protocol.release_session(session)
+
+    def close(self):
+        # Interrupt the connection. Can be called from another thread, also before the connection is open.
+        self._closed = True
+        r = self._response
+        if r is not None:
+            r.close()
+
+    def _get_soap_responses(self, response):
+        # Chop the response stream into SOAP envelopes and return them as XML trees as soon as they are complete
+        buffer = b''
+        for chunk in response.iter_content(chunk_size=None):
+            buffer += chunk
+            while True:
+                match = self.ENVELOPE_END.search(buffer)
+                if not match:
+                    break
+                envelope, buffer = buffer[:match.end()], buffer[match.end():]
+                try:
+                    yield to_xml(envelope.decode('utf-8'))
+                except ParseError as e:
+                    raise SOAPError('Bad SOAP response: %s' % e)
+
+    def _get_notifications(self, message):
+        connection_status = get_xml_attr(message, '{%s}ConnectionStatus' % MNS)
+        if connection_status:
+            log.debug('%s: Connection status is %s', self.SERVICE_NAME, connection_status)
+        error_ids = [e.text for e in message.findall('{%s}ErrorSubscriptionIds/{%s}SubscriptionId' % (MNS, MNS))]
+        try:
+            res = self._get_element_container(message=message)
+        except Exception as e:
+            if not error_ids:
+                raise
+            res = e
+        if isinstance(res, Exception):
+            if not error_ids:
+                raise res
+            # The error only concerns some of the subscriptions on this connection
+            for subscription_id in error_ids:
+                yield subscription_id, res
+        notifications = message.find(self.element_container_name)
+        if notifications is None:
+            # This is just a heartbeat or a status message
+            return
+        for notification in notifications:
+            yield get_xml_attr(notification, '{%s}SubscriptionId' % TNS), notification
+
+    def get_payload(self, subscription_ids, connection_timeout):
+        getstreamingevents = create_element('m:%s' % self.SERVICE_NAME)
+        subscription_ids_elem = create_element('m:SubscriptionIds')
+        for subscription_id in subscription_ids:
+            add_xml_child(subscription_ids_elem, 't:SubscriptionId', subscription_id)
+        getstreamingevents.append(subscription_ids_elem)
+        add_xml_child(getstreamingevents, 'm:ConnectionTimeout', connection_timeout)
+        return getstreamingevents
+
+
+class Unsubscribe(EWSAccountService):
+    """
+    MSDN: https://msdn.microsoft.com/en-us/library/office/aa564263(v=exchg.150).aspx
+    """
+    SERVICE_NAME = 'Unsubscribe'
+    element_container_name = None  # Unsubscribe doesn't return a response object, just status in XML attrs
+
+    def call(self, subscription_id):
+        return self._get_elements(payload=self.get_payload(subscription_id=subscription_id))
+
+    def get_payload(self, subscription_id):
+        unsubscribe = create_element('m:%s' % self.SERVICE_NAME)
+        add_xml_child(unsubscribe, 'm:SubscriptionId', subscription_id)
+        return unsubscribe
+
+
 class ResolveNames(EWSService):
     """
     MSDN: https://msdn.microsoft.com/en-us/library/office/aa565329(v=exchg.150).aspx
@@ -0,0 +1,256 @@
+# coding=utf-8
+"""
+Tracing spans for the logical operations exchangelib performs: QuerySet evaluation, bulk calls, the chunks that bulk
+calls are split into, service requests, HTTP attempts, retry sleeps and XML parsing. Spans form a tree per trace, also
+across the thread pool that services use to send chunks in parallel, so you can find out which chunk, retry or parse
+step dominates the latency of a slow operation.
+
+By default, tracing is disabled and costs next to nothing. To collect spans, register an exporter globally or on a
+single Protocol:
+
+    from exchangelib.tracing import InMemorySpanExporter, set_global_exporter
+    exporter = InMemorySpanExporter()
+    set_global_exporter(exporter)  # Or: account.protocol.span_exporter = exporter
+    ...
+    for span in exporter.get_spans():
+        print(span.name, span.duration, span.attributes)
+
+To send spans to your own tracing system, subclass SpanExporter and implement export().
+"""
+from __future__ import unicode_literals
+
+import logging
+import random
+from threading import Lock, local
+import time
+
+from future.utils import PY2
+
+log = logging.getLogger(__name__)
+
+# Same clock as exchangelib.util.time_func. util imports this module, so we can't import it from there.
+time_func = time.time if PY2 else time.monotonic
+
+# Span names
+QUERYSET = 'QuerySet'
+BULK_CALL = 'Account.%s'  # Interpolated with the method name, e.g. 'Account.bulk_update'
+CHUNK = 'chunk'
+SERVICE = 'service'
+HTTP_ATTEMPT = 'http_attempt'
+RETRY_SLEEP = 'retry_sleep'
+XML_PARSE = 'xml_parse'
+
+_context = local()
+
+
+def get_current_span():
+    return getattr(_context, 'span', None)
+
+
+def _activate(span):
+    # Makes 'span' the current span of this thread and returns the span that was current before
+    previous = getattr(_context, 'span', None)
+    _context.span = span
+    return previous
+
+
+class Span(object):
+    """
+    A timed operation. Use as a context manager to make the span the parent of spans started in the same block.
+    """
+    def __init__(self, name, exporter, parent=None, attributes=None):
+        self.name = name
+        self.exporter = exporter
+        self.trace_id = parent.trace_id if parent else '%032x' % random.getrandbits(128)
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes or {}
+        self.start_time = None
+        self.end_time = None
+        self.error = None
+        self._previous = None
+
+    @property
+    def duration(self):
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def start(self):
+        self.start_time = time_func()
+        return self
+
+    def finish(self, error=None):
+        self.end_time = time_func()
+        if error is not None:
+            self.error = error.__class__.__name__
+        try:
+            self.exporter.export(self)
+        except Exception:
+            # Tracing must never break the traced operation
+            log.warning('Could not export span %s', self.name, exc_info=True)
+
+    def __enter__(self):
+        self.start()
+        self._previous = _activate(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _activate(self._previous)
+        self._previous = None
+        self.finish(error=exc_val)
+
+    def __repr__(self):
+        return '%s(name=%r, trace_id=%r, span_id=%r, parent_id=%r, duration=%r, error=%r, attributes=%r)' % (
+            self.__class__.__name__, self.name, self.trace_id, self.span_id, self.parent_id, self.duration, self.error,
+            self.attributes)
+
+
+class NoopSpan(object):
+    # Returned by start_span() when tracing is disabled
+    def set_attribute(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class SpanExporter(object):
+    """
+    Receives spans when they finish. Subclasses must be thread-safe.
+    """
+    def export(self, span):
+        raise NotImplementedError()
+
+
+class InMemorySpanExporter(SpanExporter):
+    """
+    Keeps all finished spans in memory. Useful for tests and benchmarks.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._spans = []
+
+    def export(self, span):
+        with self._lock:
+            self._spans.append(span)
+
+    def get_spans(self, name=None, trace_id=None):
+        # Returns finished spans in the order they finished, optionally filtered by name and trace
+        with self._lock:
+            return [s for s in self._spans
+                    if (name is None or s.name == name) and (trace_id is None or s.trace_id == trace_id)]
+
+    def get_children(self, span):
+        with self._lock:
+            return [s for s in self._spans if s.parent_id == span.span_id]
+
+    def reset(self):
+        with self._lock:
+            self._spans = []
+
+
+class LoggingSpanExporter(SpanExporter):
+    """
+    Logs each finished span at DEBUG level
+    """
+    def __init__(self, logger=log):
+        self.logger = logger
+
+    def export(self, span):
+        self.logger.debug('Span %s trace %s id %s parent %s: %.6f s, error %s, %s', span.name, span.trace_id,
+                          span.span_id, span.parent_id, span.duration, span.error, span.attributes)
+
+
+_global_exporter = None
+
+
+def set_global_exporter(exporter):
+    # Registers a span exporter for all protocols that don't have their own. Pass None to disable tracing again.
+    global _global_exporter
+    assert exporter is None or isinstance(exporter, SpanExporter)
+    _global_exporter = exporter
+
+
+def get_exporter(protocol=None):
+    # Returns the span exporter registered on the protocol, or the global exporter. None means tracing is disabled.
+    exporter = getattr(protocol, 'span_exporter', None)
+    if exporter is None:
+        return _global_exporter
+    return exporter
+
+
+def start_span(name, protocol=None, **attributes):
+    """
+    Returns a new span that is a child of the current span of this thread. Use the return value as a context manager:
+
+        with start_span('my_operation', protocol=account.protocol, foo='bar') as span:
+            ...
+            span.set_attribute('baz', 42)
+    """
+    exporter = get_exporter(protocol)
+    if exporter is None:
+        return NOOP_SPAN
+    return Span(name=name, exporter=exporter, parent=get_current_span(), attributes=attributes)
+
+
+def trace_iter(name, func, protocol=None, **attributes):
+    """
+    Returns an iterator over the iterable returned by 'func', in a span that lasts until the iterator is exhausted or
+    closed. The span is only current while the iterator is doing work, not while the consumer is handling the values it
+    returns, so spans started by the consumer are not mistaken for children of this span.
+    """
+    span = start_span(name, protocol=protocol, **attributes)
+    if span is NOOP_SPAN:
+        return iter(func())
+    return _traced_iter(span, func)
+
+
+def _traced_iter(span, func):
+    span.start()
+    iterator = None
+    error = None
+    try:
+        while True:
+            previous = _activate(span)
+            try:
+                if iterator is None:
+                    iterator = iter(func())
+                val = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                _activate(previous)
+            yield val
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        span.finish(error=error)
+
+
+def propagate_context(func):
+    """
+    Returns a wrapper around 'func' that runs with the current span of the calling thread as its current span. Use
+    this to carry the trace context into thread pool workers.
+    """
+    span = get_current_span()
+    if span is None:
+        return func
+
+    def wrapper(*args, **kwargs):
+        previous = _activate(span)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _activate(previous)
+    return wrapper
@@ -8,16 +8,20 @@ import logging
 import re
 import socket
 import time
+import zlib
 from xml.etree.ElementTree import Element, fromstring, ParseError
 
 from future.moves.urllib.parse import urlparse
 from future.moves._thread import get_ident
-from future.utils import PY2
+from future.utils import PY2, python_2_unicode_compatible
 import requests.exceptions
 from six import text_type, string_types
 
 from .errors import TransportError, RateLimitError, RedirectError, RelativeRedirect, CASError, UnauthorizedError, \
     ErrorInvalidSchemaVersionForMailboxVersion
+from .metrics import get_metrics, REQUEST_RETRIES, REQUEST_BYTES, RESPONSE_BYTES
+from .tracing import start_span, HTTP_ATTEMPT, RETRY_SLEEP
+from .wirelog import get_wire_log
 
 time_func = time.time if PY2 else time.monotonic
 
@@ -259,10 +263,34 @@ class DummyRequest(object):
     headers = {}
 
 
+def gzip_compress(data):
+    # zlib with wbits=31 produces the gzip format. gzip.compress() is not available on Python 2.
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gzip_decompress(data):
+    # The reverse of gzip_compress()
+    return zlib.decompress(data, 31)
+
+
+@python_2_unicode_compatible
+class LazyResponseText(object):
+    # Decodes the response body when the log message containing it is formatted, not when the message is created
+    def __init__(self, response):
+        self.response = response
+
+    def __str__(self):
+        return getattr(self.response, 'text', '')
+
+
 class DummyResponse(object):
     status_code = 503
     headers = {}
     text = ''
+    content = b''
     request = DummyRequest()
 
 
@@ -320,7 +348,8 @@ if not PY2:
     CONNECTION_ERRORS += (ConnectionResetError,)
 
 
-def post_ratelimited(protocol, session, url, headers, data, timeout=None, verify=True, allow_redirects=False):
+def post_ratelimited(protocol, session, url, headers, data, timeout=None, verify=True, allow_redirects=False,
+                     stream=False, service=None):
     """
     There are two error-handling policies implemented here: a fail-fast policy intended for stand-alone scripts which
     fails on all responses except HTTP 200. The other policy is intended for long-running tasks that need to respect
@@ -342,6 +371,11 @@ def post_ratelimited(protocol, session, url, headers, data, timeout=None, verify
 
     The contract on sessions here is to return the session that ends up being used, or retiring the session if we
     intend to raise an exception. We give up on max_wait timeout, not number of retries
+
+    If 'stream' is True, the response body of a successful request is not read. The caller must read the body and close
+    the response before releasing the session.
+
+    'service' is the name of the EWS service we're calling, if any. It's only used for the wire log.
     """
     wait = 10  # seconds
     redirects = 0
@@ -366,28 +400,66 @@ Response data: %(response_data)s
                     auth=session.auth, url=url, verify=verify, allow_redirects=allow_redirects, response_time=None,
                     status_code=None, request_headers=headers, response_headers=None, request_data=data,
                     response_data=None)
+    metrics = get_metrics(protocol)
+    wire_log = get_wire_log(protocol)
+    if wire_log is not None and not wire_log.should_log(service=service):
+        wire_log = None
+    threshold = getattr(protocol, 'compress_requests_over', None)
+    compressed_data = None
+    if threshold is not None and len(data) > threshold:
+        compressed_data = gzip_compress(data)
+        protocol.compression_stats.add(uncompressed_size=len(data), compressed_size=len(compressed_data))
     try:
         while True:
             log.debug('Session %(session_id)s thread %(thread_id)s: retry %(i)s timeout %(timeout)s POST\'ing to '
                       '%(url)s after %(wait)s s wait', log_vals)
+            if compressed_data is None:
+                post_headers, post_data = headers, data
+            else:
+                post_headers, post_data = dict(headers or {}, **{'Content-Encoding': 'gzip'}), compressed_data
+            metrics.observe(REQUEST_BYTES, len(post_data), endpoint=url)
             d1 = time_func()
-            try:
-                r = session.post(url=url, headers=headers, data=data, allow_redirects=False, timeout=timeout,
-                                 verify=verify)
-            except CONNECTION_ERRORS as e:
-                log.debug(
-                    'Session %(session_id)s thread %(thread_id)s: timeout or connection error POST\'ing to %(url)s',
-                    log_vals)
-                r = DummyResponse()
-                r.request.headers = headers
-                r.headers = {'TimeoutException': e}
+            with start_span(HTTP_ATTEMPT, protocol=protocol, url=url, attempt=log_vals['i']) as span:
+                try:
+                    r = session.post(url=url, headers=post_headers, data=post_data, allow_redirects=False,
+                                     timeout=timeout, verify=verify, stream=stream)
+                except CONNECTION_ERRORS as e:
+                    log.debug(
+                        'Session %(session_id)s thread %(thread_id)s: timeout or connection error POST\'ing to %(url)s',
+                        log_vals)
+                    r = DummyResponse()
+                    r.request.headers = headers
+                    r.headers = {'TimeoutException': e}
+                span.set_attribute('status_code', r.status_code)
             d2 = time_func()
+            if not (stream and r.status_code == 200):
+                metrics.observe(RESPONSE_BYTES, len(r.content), endpoint=url, status_code=r.status_code)
             log_vals['response_time'] = d2 - d1
             log_vals['status_code'] = r.status_code
             log_vals['request_headers'] = r.request.headers
             log_vals['response_headers'] = r.headers
-            log_vals['response_data'] = getattr(r, 'text', '')
+            # Don't consume a streaming response body here. We want to read it as it arrives. Don't decode the response
+            # body unless the log message is actually emitted. Responses can be huge.
+            log_vals['response_data'] = '[streaming]' if stream and r.status_code == 200 else LazyResponseText(r)
             log.debug(log_msg, log_vals)
+            if wire_log is not None:
+                wire_log.log_exchange(
+                    url=url, service=service, attempt=log_vals['i'], session_id=session.session_id,
+                    request_headers=r.request.headers, request_data=data, status_code=r.status_code,
+                    response_headers=r.headers, response_data=None if stream and r.status_code == 200 else r.content,
+                    response_time=d2 - d1,
+                )
+            if compressed_data is not None and r.status_code in (400, 415):
+                # The server doesn't accept compressed requests. Resend uncompressed, and stop compressing requests to
+                # this server.
+                log.warning('Server at %s rejected a compressed request (code %s). Disabling request compression',
+                            url, r.status_code)
+                protocol.compress_requests_over = None
+                protocol.compression_stats.add_fallback()
+                compressed_data = None
+                if stream:
+                    r.close()
+                continue
             # The genericerrorpage.htm/internalerror.asp is ridiculous behaviour for random outages. Redirect to
             # '/internalsite/internalerror.asp' or '/internalsite/initparams.aspx' is caused by e.g. SSL certificate
             # f*ckups on the Exchange server.
@@ -409,9 +481,11 @@ Response data: %(response_data)s
                     # We lost patience. Session is cleaned up in outer loop
                     raise RateLimitError(
                         'Session %(session_id)s URL %(url)s: Max timeout reached' % log_vals)
+                metrics.increment(REQUEST_RETRIES, endpoint=url, reason=r.status_code)
                 log.info("Session %(session_id)s thread %(thread_id)s: Connection error on URL %(url)s "
                          "(code %(status_code)s). Cool down %(wait)s secs", log_vals)
-                time.sleep(wait)  # Increase delay for every retry
+                with start_span(RETRY_SLEEP, protocol=protocol, url=url, wait=wait, reason=r.status_code):
+                    time.sleep(wait)  # Increase delay for every retry
                 wait *= 2
                 session = protocol.renew_session(session)
                 log_vals['wait'] = wait
@@ -0,0 +1,142 @@
+# coding=utf-8
+"""
+Structured logging of the HTTP requests and responses exchanged with the server. Debug logging of exchangelib already
+contains the XML documents, but it is far too verbose for production traffic. The wire log writes one JSON record per
+HTTP attempt, for a sample of the requests, with bodies capped at a maximum size and credentials redacted.
+
+The wire log is disabled by default and costs nothing when disabled. To enable it, register a WireLog instance globally
+or on a single Protocol:
+
+    from exchangelib.wirelog import WireLog, set_global_wire_log
+    set_global_wire_log(WireLog(filename='/var/log/ews-wire.log', sample_rate=0.01, max_body_size=2048))
+    # Or: account.protocol.wire_log = WireLog(services={'GetItem', 'FindItem'})
+"""
+from __future__ import unicode_literals
+
+import io
+import json
+import logging
+import random
+import re
+from threading import Lock
+import time
+
+log = logging.getLogger(__name__)
+
+REDACTED = '[REDACTED]'
+# Compared case-insensitively
+REDACTED_HEADERS = ('authorization', 'proxy-authorization', 'www-authenticate', 'cookie', 'set-cookie',
+                    'x-anchormailbox')
+# The impersonated user in the SOAP header. The closing tag may have been cut off by the body size cap.
+_impersonation_RE = re.compile(br'<t:ExchangeImpersonation>.*?(</t:ExchangeImpersonation>|$)', re.DOTALL)
+
+
+def redact_headers(headers, names=REDACTED_HEADERS):
+    # Returns a copy of 'headers' as a dict of strings where the values of headers in 'names' are redacted
+    if not headers:
+        return {}
+    names = {n.lower() for n in names}
+    return {k: REDACTED if k.lower() in names else '%s' % v for k, v in headers.items()}
+
+
+def redact_body(body):
+    # Returns a copy of the XML document 'body', as bytes, where the impersonated user is redacted
+    replacement = b'<t:ExchangeImpersonation>' + REDACTED.encode('ascii') + b'</t:ExchangeImpersonation>'
+    return _impersonation_RE.sub(replacement, body)
+
+
+class WireLog(object):
+    """
+    Writes a JSON record for each HTTP attempt to a logger, or to a file if 'filename' is set.
+
+    :param logger: the logger to write records to. Defaults to the 'exchangelib.wire' logger. Records are logged at
+           INFO level.
+    :param filename: a file to append records to instead of logging them, one record per line
+    :param sample_rate: the fraction of requests to log, between 0 and 1. All attempts of a request are logged together.
+    :param services: an iterable of service names, e.g. {'GetItem', 'FindItem'}, to only log requests to these services.
+           None means all requests, including requests that are not service requests, like autodiscover.
+    :param max_body_size: the maximum number of bytes of the request and response bodies to log. 0 disables logging
+           of bodies. None logs the full bodies.
+    :param redact_headers: names of HTTP headers whose values are replaced with '[REDACTED]'
+    """
+    def __init__(self, logger=None, filename=None, sample_rate=1.0, services=None, max_body_size=4096,
+                 redact_headers=REDACTED_HEADERS):
+        assert 0 <= sample_rate <= 1
+        assert max_body_size is None or max_body_size >= 0
+        self.logger = logger or logging.getLogger('exchangelib.wire')
+        self.filename = filename
+        self.sample_rate = sample_rate
+        self.services = None if services is None else set(services)
+        self.max_body_size = max_body_size
+        self.redact_headers = {h.lower() for h in redact_headers}
+        self._lock = Lock()
+
+    def should_log(self, service=None):
+        # Decides whether to log a request. Called once per request, before the first attempt.
+        if self.services is not None and service not in self.services:
+            return False
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def _headers(self, headers):
+        return redact_headers(headers, names=self.redact_headers)
+
+    def _body(self, body):
+        # Returns a capped and redacted copy of a request or response body, as text
+        if not body or self.max_body_size == 0:
+            return ''
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        truncated = self.max_body_size is not None and len(body) > self.max_body_size
+        if truncated:
+            body = body[:self.max_body_size]
+        body = redact_body(body).decode('utf-8', 'replace')
+        if truncated:
+            body += '[...]'
+        return body
+
+    def log_exchange(self, url, service, attempt, session_id, request_headers, request_data, status_code,
+                     response_headers, response_data, response_time):
+        # 'response_data' is the raw response body as bytes, or None if the body was not read, e.g. when streaming
+        record = dict(
+            timestamp=time.time(),
+            url=url,
+            service=service,
+            attempt=attempt,
+            session_id=session_id,
+            status_code=status_code,
+            response_time=response_time,
+            request_headers=self._headers(request_headers),
+            response_headers=self._headers(response_headers),
+            request_body=self._body(request_data),
+            request_size=len(request_data or b''),
+            response_body=self._body(response_data),
+            response_size=None if response_data is None else len(response_data),
+        )
+        self.emit(record)
+
+    def emit(self, record):
+        line = json.dumps(record, sort_keys=True, default=str)
+        if self.filename is None:
+            self.logger.info('%s', line)
+            return
+        with self._lock:
+            with io.open(self.filename, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+
+_global_wire_log = None
+
+
+def set_global_wire_log(wire_log):
+    # Registers a wire log for all protocols that don't have their own. Pass None to disable wire logging again.
+    global _global_wire_log
+    assert wire_log is None or isinstance(wire_log, WireLog)
+    _global_wire_log = wire_log
+
+
+def get_wire_log(protocol=None):
+    # Returns the wire log registered on the protocol, or the global wire log. None means wire logging is disabled.
+    wire_log = getattr(protocol, 'wire_log', None)
+    if wire_log is None:
+        return _global_wire_log
+    return wire_log
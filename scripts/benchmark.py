@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+"""
+Repeatable performance benchmarks that run against a local mock EWS server, so no Exchange server or credentials are
+needed. Covers request serialization, response parsing, item parsing, QuerySet iteration, pooled bulk operations,
+replay of recorded traffic and autodiscover.
+
+Usage:
+    python benchmark.py [--output results.json] [--compare baseline.json] [--items 1000] [--repeat 5] [NAME ...]
+    python benchmark.py --memory-items 1000000 [NAME ...]
+
+Results are written as JSON, one entry per benchmark with timing statistics per iteration. Use --compare with the
+results of an earlier run (e.g. from the previous release) to print the relative change of each benchmark.
+
+--memory-items N also measures the memory used by N calendar items held in memory, e.g. a day of meetings for thousands
+of rooms. This requires Python 3.4 or later.
+"""
+from __future__ import unicode_literals, print_function
+
+import argparse
+from collections import OrderedDict
+import copy
+import datetime
+import gc
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from exchangelib import DELEGATE, Account, Configuration, Credentials, Message, CalendarItem, EWSDateTime, UTC, NTLM, \
+    BASIC
+from exchangelib.autodiscover import AutodiscoverProtocol, discover, _autodiscover_cache
+from exchangelib.cassette import Cassette, Recorder, Replayer
+from exchangelib.errors import ErrorServerBusy
+from exchangelib.fields import FieldPath
+from exchangelib.items import LAZY_PER_FIELD
+from exchangelib.services import GetItem, TNS
+from exchangelib.transport import NOAUTH, wrap
+from exchangelib.util import to_xml, create_element, add_xml_child
+
+from mockserver import MockEWSServer, SOAP_THROTTLING
+
+logging.basicConfig(level=logging.WARNING)
+
+try:
+    time_func = time.perf_counter
+except AttributeError:
+    time_func = time.time
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(func):
+    # Register a benchmark. The function gets the parsed command line options and returns a callable to time, and the
+    # number of operations (e.g. items) each call of the callable processes.
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def make_account(server, auth_type=NOAUTH):
+    config = Configuration(service_endpoint=server.service_endpoint, credentials=Credentials('foo', 'bar'),
+                           auth_type=auth_type, verify_ssl=False)
+    return Account(primary_smtp_address=server.email, config=config, access_type=DELEGATE, default_timezone=UTC)
+
+
+def find_item_response(n):
+    # A FindItem response with n items, as the server would send it
+    server = MockEWSServer(items=n)
+    try:
+        _, body = server.handle_ews_request(wrap(content=finditem_payload(), version='Exchange2016'))
+    finally:
+        server.stop()
+    return body
+
+
+def finditem_payload():
+    finditem = create_element('m:FindItem', Traversal='Shallow')
+    itemshape = create_element('m:ItemShape')
+    add_xml_child(itemshape, 't:BaseShape', 'AllProperties')
+    finditem.append(itemshape)
+    finditem.append(create_element('m:IndexedPageItemView', Offset='0', BasePoint='Beginning'))
+    parentfolderids = create_element('m:ParentFolderIds')
+    parentfolderids.append(create_element('t:DistinguishedFolderId', Id='inbox'))
+    finditem.append(parentfolderids)
+    return finditem
+
+
+@benchmark
+def wrap_getitem(options):
+    # Serialize a GetItem request for a chunk of items, requesting all fields
+    server = MockEWSServer(items=0).start()
+    account = make_account(server)
+    item_ids = [('AAMkItem%08d' % i, 'CQAAAB%08d' % i) for i in range(GetItem.CHUNKSIZE)]
+    additional_fields = [FieldPath(field=f) for f in Message.supported_fields(version=account.version)]
+    service = GetItem(account=account)
+
+    def run():
+        payload = service.get_payload(items=item_ids, additional_fields=additional_fields)
+        wrap(content=payload, version=account.version.api_version, account=account)
+    return run, len(item_ids), server
+
+
+@benchmark
+def to_xml_finditem(options):
+    # Parse a FindItem response
+    body = find_item_response(options.items)
+
+    def run():
+        to_xml(body)
+    return run, options.items
+
+
+@benchmark
+def item_from_xml(options):
+    # Create Message objects from parsed XML. from_xml() clears the elements, so we parse a fresh copy for each call
+    body = find_item_response(options.items)
+    tree = to_xml(body)
+    items_tag = '{%s}Items' % TNS
+
+    def run():
+        elems = copy.deepcopy(tree).iter(items_tag)
+        for elem in next(elems):
+            Message.from_xml(elem=elem, account=None)
+    return run, options.items
+
+
+@benchmark
+def item_from_xml_lazy(options):
+    # Like item_from_xml, but with lazy decoding, and only the subject is read
+    body = find_item_response(options.items)
+    tree = to_xml(body)
+    items_tag = '{%s}Items' % TNS
+
+    def run():
+        elems = copy.deepcopy(tree).iter(items_tag)
+        for elem in next(elems):
+            Message.from_xml(elem=elem, account=None, lazy=LAZY_PER_FIELD).subject
+    return run, options.items
+
+
+@benchmark
+def queryset_only(options):
+    # Iterate a QuerySet of simple fields. This is FindItem paging only.
+    server = MockEWSServer(items=options.items, page_size=options.page_size, latency=options.latency).start()
+    account = make_account(server)
+
+    def run():
+        for _ in account.inbox.all().only('subject', 'datetime_received', 'is_read'):
+            pass
+    return run, options.items, server
+
+
+@benchmark
+def queryset_deep_slice(options):
+    # Get the last 10 items of a QuerySet with a slice. The offset is sent to the server.
+    server = MockEWSServer(items=options.items, page_size=options.page_size, latency=options.latency).start()
+    account = make_account(server)
+    qs = account.inbox.all().only('subject', 'datetime_received', 'is_read')
+
+    def run():
+        for _ in qs[options.items - 10:options.items]:
+            pass
+    return run, 10, server
+
+
+@benchmark
+def queryset_full(options):
+    # Iterate a QuerySet of full items. This is FindItem paging plus pooled GetItem requests.
+    server = MockEWSServer(items=options.items, page_size=options.page_size, latency=options.latency).start()
+    account = make_account(server)
+
+    def run():
+        for _ in account.inbox.all():
+            pass
+    return run, options.items, server
+
+
+@benchmark
+def queryset_ntlm(options):
+    # Like queryset_only, but each new connection must do an NTLM handshake
+    server = MockEWSServer(items=options.items, page_size=options.page_size, latency=options.latency,
+                           auth=NTLM).start()
+    account = make_account(server, auth_type=NTLM)
+
+    def run():
+        for _ in account.inbox.all().only('subject'):
+            pass
+    return run, options.items, server
+
+
+@benchmark
+def bulk_create_delete(options):
+    # Pooled CreateItem and DeleteItem requests
+    server = MockEWSServer(items=0, latency=options.latency, auth=BASIC).start()
+    account = make_account(server, auth_type=BASIC)
+    items = [Message(subject='Benchmark %s' % i, body='This is a benchmark') for i in range(options.items)]
+
+    def run():
+        ids = account.bulk_create(folder=account.inbox, items=items)
+        account.bulk_delete(ids=ids)
+    return run, options.items, server
+
+
+@benchmark
+def bulk_create_gzip(options):
+    # Like bulk_create_delete, but with gzip-compressed request bodies and larger items
+    server = MockEWSServer(items=0, latency=options.latency).start()
+    account = make_account(server)
+    account.protocol.compress_requests_over = 1024
+    body = 'This is a benchmark with a somewhat longer body. ' * 100
+    items = [Message(subject='Benchmark %s' % i, body=body) for i in range(options.items)]
+
+    def run():
+        ids = account.bulk_create(folder=account.inbox, items=items)
+        account.bulk_delete(ids=ids)
+
+    def cleanup():
+        print('Request compression: %s' % account.protocol.compression_stats)
+        server.stop()
+    return run, options.items, cleanup
+
+
+@benchmark
+def throttled_fetch(options):
+    # GetItem requests where every 10th request is throttled. Measures the cost of the error path, and that throttled
+    # requests don't leak sessions.
+    server = MockEWSServer(items=options.items, latency=options.latency, throttle_every=10,
+                           throttling=SOAP_THROTTLING).start()
+    account = make_account(server)
+    ids = [(i.item_id, i.changekey) for i in account.inbox.all().only('item_id', 'changekey')]
+    chunks = [ids[i:i + 10] for i in range(0, len(ids), 10)]
+
+    def run():
+        for chunk in chunks:
+            try:
+                for _ in account.fetch(ids=chunk):
+                    pass
+            except ErrorServerBusy:
+                pass
+    return run, options.items, server
+
+
+@benchmark
+def replay_queryset(options):
+    # Like queryset_full, but replays a recording of the traffic instead of talking to the mock server. This measures
+    # parsing, paging and pooling without any HTTP overhead.
+    server = MockEWSServer(items=options.items, page_size=options.page_size).start()
+    account = make_account(server)
+    folder = account.inbox
+    cassette = Cassette()
+    account.protocol.set_session_factory(Recorder(cassette))
+    list(folder.all())
+    server.stop()
+
+    def run():
+        account.protocol.set_session_factory(Replayer(cassette))
+        for _ in folder.all():
+            pass
+
+    def cleanup():
+        account.protocol.set_session_factory(None)
+    return run, options.items, cleanup
+
+
+@benchmark
+def autodiscover(options):
+    # Autodiscover with a primed autodiscover cache. This is the common case for long-running processes.
+    server = MockEWSServer(latency=options.latency, email='benchmark@exchangelib-mock.invalid').start()
+    credentials = Credentials('foo', 'bar')
+    cache_key = ('exchangelib-mock.invalid', credentials, False)
+    _autodiscover_cache[cache_key] = AutodiscoverProtocol(service_endpoint=server.autodiscover_endpoint,
+                                                          credentials=credentials, auth_type=NOAUTH, verify_ssl=False)
+
+    def run():
+        discover(email=server.email, credentials=credentials, verify_ssl=False)
+
+    def cleanup():
+        del _autodiscover_cache[cache_key]
+        server.stop()
+    return run, 1, cleanup
+
+
+def run_benchmark(name, options):
+    setup = BENCHMARKS[name](options)
+    func, ops = setup[:2]
+    cleanup = setup[2] if len(setup) > 2 else None
+    if cleanup is not None and not callable(cleanup):
+        cleanup = cleanup.stop  # A MockEWSServer
+    try:
+        func()  # Warm up caches and connections
+        timings = []
+        for _ in range(options.repeat):
+            gc.collect()
+            t1 = time_func()
+            func()
+            timings.append(time_func() - t1)
+    finally:
+        if cleanup:
+            cleanup()
+    timings.sort()
+    median = timings[len(timings) // 2]
+    return OrderedDict([
+        ('name', name),
+        ('ops', ops),
+        ('repeat', options.repeat),
+        ('min', min(timings)),
+        ('median', median),
+        ('mean', sum(timings) / len(timings)),
+        ('max', max(timings)),
+        ('ops_per_sec', ops / median if median else None),
+    ])
+
+
+def item_memory(n):
+    # Returns the memory used by n calendar items with a few fields set, or None if tracemalloc is not available
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    slots = [UTC.localize(EWSDateTime(2017, 1, 2, 8)) + datetime.timedelta(minutes=30 * i) for i in range(21)]
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        items = [
+            CalendarItem(item_id='AAMkADk%012d' % i, changekey='DwAAABYA%08d' % i, subject='Meeting %s' % (i % 1000),
+                         start=slots[i % 20], end=slots[i % 20 + 1], location='Room %s' % (i % 20000))
+            for i in range(n)
+        ]
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    return OrderedDict([
+        ('items', n),
+        ('bytes', used),
+        ('bytes_per_item', used / n if n else None),
+        # The size of the item object itself, without the values of its fields
+        ('item_size', sys.getsizeof(items[0]) if items else None),
+    ])
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except Exception:
+        return None
+
+
+def exchangelib_version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('exchangelib').version
+    except Exception:
+        return None
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = {r['name']: r for r in json.load(f)['results']}
+    print('\nComparison with %s (median, negative is faster):' % baseline_file)
+    for r in results:
+        old = baseline.get(r['name'])
+        if not old:
+            print('%-20s (not in baseline)' % r['name'])
+            continue
+        change = (r['median'] - old['median']) / old['median'] * 100 if old['median'] else 0
+        print('%-20s %10.4fs -> %10.4fs  %+7.1f%%' % (r['name'], old['median'], r['median'], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run exchangelib benchmarks against a local mock EWS server')
+    parser.add_argument('names', nargs='*', help='Benchmarks to run. Default is all of: %s' % ', '.join(BENCHMARKS))
+    parser.add_argument('--output', default='benchmark-results.json', help='File to write JSON results to')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--items', type=int, default=500, help='Number of items per benchmark')
+    parser.add_argument('--page-size', type=int, default=100, help='Max items per FindItem page in the mock server')
+    parser.add_argument('--latency', type=float, default=0, help='Mock server latency per request, in seconds')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs of each benchmark')
+    parser.add_argument('--memory-items', type=int, default=0,
+                        help='Also measure the memory used by this many calendar items, e.g. 1000000')
+    options = parser.parse_args()
+    for name in options.names:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark %s' % name)
+
+    results = []
+    for name in options.names or BENCHMARKS:
+        result = run_benchmark(name, options)
+        print('%-20s median %.4fs (min %.4fs, max %.4fs) %10.1f ops/s' % (
+            name, result['median'], result['min'], result['max'], result['ops_per_sec'] or 0))
+        results.append(result)
+
+    memory = None
+    if options.memory_items:
+        memory = item_memory(options.memory_items)
+        if memory is None:
+            print('Memory benchmark requires tracemalloc (Python 3.4+)')
+        else:
+            print('%s calendar items use %.1f MB, %.0f bytes per item (item object %s bytes)' % (
+                memory['items'], memory['bytes'] / 1e6, memory['bytes_per_item'], memory['item_size']))
+
+    report = OrderedDict([
+        ('timestamp', datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')),
+        ('exchangelib_version', exchangelib_version()),
+        ('git_revision', git_revision()),
+        ('python_version', platform.python_version()),
+        ('platform', platform.platform()),
+        ('options', OrderedDict([('items', options.items), ('page_size', options.page_size),
+                                 ('latency', options.latency), ('repeat', options.repeat)])),
+        ('results', results),
+        ('memory', memory),
+    ])
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results written to %s' % options.output)
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,478 @@
+# coding=utf-8
+"""
+A local mock EWS server for offline testing and benchmarking. It speaks just enough EWS to let exchangelib create an
+Account, autodiscover, page through items and do bulk operations, without a real Exchange server.
+
+Responses are canned but parameterizable: the number of items in the mailbox, items per page, body size, added
+latency, periodic throttling errors and the auth scheme (none, Basic or NTLM). NTLM is only simulated: the server sends
+a challenge and accepts any response to it.
+
+Usage:
+    with MockEWSServer(items=1000, page_size=100, latency=0.01, auth=NTLM) as server:
+        config = Configuration(service_endpoint=server.service_endpoint, credentials=Credentials('foo', 'bar'),
+                               auth_type=NTLM, verify_ssl=False)
+        account = Account(primary_smtp_address=server.email, config=config, access_type=DELEGATE)
+        for item in account.inbox.all():
+            ...
+
+Run this file directly to start a server in the foreground: python mockserver.py [port]
+"""
+from __future__ import unicode_literals, print_function
+
+import base64
+from collections import Counter, OrderedDict
+import datetime
+import logging
+import struct
+import sys
+from threading import Thread, Lock
+import time
+import zlib
+
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+
+from exchangelib.transport import NOAUTH, BASIC, NTLM, SOAPNS, TNS, MNS
+from exchangelib.util import to_xml
+
+log = logging.getLogger(__name__)
+
+EWS_PATH = '/EWS/Exchange.asmx'
+TYPES_PATH = '/EWS/types.xsd'
+AUTODISCOVER_PATH = '/Autodiscover/Autodiscover.xml'
+AUTODISCOVER_RESPONSE_NS = 'http://schemas.microsoft.com/exchange/autodiscover/outlook/responseschema/2006a'
+
+# Throttling modes
+HTTP_THROTTLING = 'http'  # HTTP 503 Service Unavailable
+SOAP_THROTTLING = 'soap'  # ErrorServerBusy response message
+THROTTLING_CHOICES = (HTTP_THROTTLING, SOAP_THROTTLING)
+
+DISTINGUISHED_FOLDERS = OrderedDict([
+    # Distinguished folder ID -> (display name, folder class)
+    ('root', ('Root', None)),
+    ('msgfolderroot', ('Top of Information Store', 'IPF.Note')),
+    ('inbox', ('Inbox', 'IPF.Note')),
+    ('sentitems', ('Sent Items', 'IPF.Note')),
+    ('deleteditems', ('Deleted Items', 'IPF.Note')),
+    ('drafts', ('Drafts', 'IPF.Note')),
+    ('outbox', ('Outbox', 'IPF.Note')),
+    ('junkemail', ('Junk E-mail', 'IPF.Note')),
+    ('calendar', ('Calendar', 'IPF.Appointment')),
+    ('contacts', ('Contacts', 'IPF.Contact')),
+    ('tasks', ('Tasks', 'IPF.Task')),
+])
+
+ENVELOPE = '''<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="%(soapns)s" xmlns:m="%(mns)s" xmlns:t="%(tns)s">
+<s:Header><t:ServerVersionInfo MajorVersion="%(major)s" MinorVersion="%(minor)s" MajorBuildNumber="%(major_build)s" \
+MinorBuildNumber="%(minor_build)s" Version="%(api_version)s"/></s:Header>
+<s:Body><m:%(service)sResponse><m:ResponseMessages>%(messages)s</m:ResponseMessages></m:%(service)sResponse></s:Body>
+</s:Envelope>'''
+
+FAULT = '''<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="%s"><s:Body><s:Fault><faultcode>%s</faultcode><faultstring>%s</faultstring></s:Fault></s:Body>
+</s:Envelope>'''
+
+MESSAGE = '''<m:%(service)sResponseMessage ResponseClass="%(response_class)s">\
+%(message_text)s<m:ResponseCode>%(code)s</m:ResponseCode>%(content)s</m:%(service)sResponseMessage>'''
+
+ITEM = '''<t:Message><t:ItemId Id="%(id)s" ChangeKey="%(changekey)s"/>\
+<t:ParentFolderId Id="%(folder_id)s" ChangeKey="AQAAAA=="/><t:ItemClass>IPM.Note</t:ItemClass>\
+<t:Subject>%(subject)s</t:Subject><t:Sensitivity>Normal</t:Sensitivity><t:Body BodyType="Text">%(body)s</t:Body>\
+<t:DateTimeReceived>%(datetime_received)s</t:DateTimeReceived><t:Size>%(size)s</t:Size>\
+<t:Categories><t:String>Benchmark</t:String><t:String>Category %(category)s</t:String></t:Categories>\
+<t:Importance>Normal</t:Importance><t:DateTimeSent>%(datetime_received)s</t:DateTimeSent>\
+<t:DateTimeCreated>%(datetime_received)s</t:DateTimeCreated><t:HasAttachments>false</t:HasAttachments>\
+<t:Culture>en-US</t:Culture><t:From><t:Mailbox><t:Name>Sender %(category)s</t:Name>\
+<t:EmailAddress>sender%(category)s@example.com</t:EmailAddress><t:MailboxType>Mailbox</t:MailboxType></t:Mailbox>\
+</t:From><t:IsRead>%(is_read)s</t:IsRead><t:IsDraft>false</t:IsDraft></t:Message>'''
+
+ITEM_ID_ONLY = '<t:Message><t:ItemId Id="%(id)s" ChangeKey="%(changekey)s"/></t:Message>'
+
+FOLDER = '''<t:Folder><t:FolderId Id="%(id)s" ChangeKey="AQAAAA=="/>\
+<t:ParentFolderId Id="%(parent_id)s" ChangeKey="AQAAAA=="/>%(folder_class)s<t:DisplayName>%(name)s</t:DisplayName>\
+<t:TotalCount>%(total_count)s</t:TotalCount><t:ChildFolderCount>%(child_count)s</t:ChildFolderCount>\
+<t:UnreadCount>0</t:UnreadCount></t:Folder>'''
+
+TYPES_XSD = '''<?xml version="1.0" encoding="utf-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" version="%s"/>'''
+
+AUTODISCOVER = '''<?xml version="1.0" encoding="utf-8"?>
+<Autodiscover xmlns="http://schemas.microsoft.com/exchange/autodiscover/responseschema/2006">
+<Response xmlns="%s"><User><AutoDiscoverSMTPAddress>%s</AutoDiscoverSMTPAddress></User>
+<Account><AccountType>email</AccountType><Action>settings</Action>
+<Protocol><Type>EXPR</Type><EwsUrl>%s</EwsUrl></Protocol></Account></Response></Autodiscover>'''
+
+
+def ntlm_challenge():
+    # A minimal NTLM CHALLENGE_MESSAGE. See [MS-NLMP] 2.2.1.2. Clients accept it, and we accept any AUTHENTICATE_MESSAGE
+    # in return, so NTLM handshakes can be exercised without a domain controller.
+    target_name = 'MOCK'.encode('utf-16-le')
+    target_info = b''.join(
+        struct.pack('<HH', av_id, len(value)) + value
+        for av_id, value in ((2, target_name), (1, target_name), (0, b''))  # NbDomainName, NbComputerName, EOL
+    )
+    flags = 0xe2898235  # Unicode, NTLM, sign, seal, always sign, extended session security, target info, 128, 56 etc.
+    header_len = 56
+    return b''.join([
+        b'NTLMSSP\0',
+        struct.pack('<I', 2),
+        struct.pack('<HHI', len(target_name), len(target_name), header_len),
+        struct.pack('<I', flags),
+        b'\x01\x23\x45\x67\x89\xab\xcd\xef',  # Server challenge
+        b'\0' * 8,  # Reserved
+        struct.pack('<HHI', len(target_info), len(target_info), header_len + len(target_name)),
+        b'\x06\x01\xb1\x1d\0\0\0\x0f',  # Version
+        target_name,
+        target_info,
+    ])
+
+
+def xml_escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MockEWSServer(object):
+    """
+    A mock EWS server running in a background thread on localhost.
+
+    Supported services are ResolveNames, GetFolder, FindItem, GetItem, CreateItem, DeleteItem, MoveItem and SendItem.
+    All folders share the same set of items. Other services get a SOAP fault.
+    """
+    def __init__(self, items=100, page_size=None, body_size=100, latency=0, auth=NOAUTH, throttle_every=0,
+                 throttling=SOAP_THROTTLING, build=(15, 1, 225, 42), api_version='Exchange2016',
+                 email='foo@example.com', port=0, accept_gzip=True):
+        """
+        :param items: the number of items the mailbox starts with
+        :param page_size: the maximum number of items returned per FindItem page, regardless of what the client asks for
+        :param body_size: the length of the text body of each item
+        :param latency: seconds to wait before responding to each request
+        :param auth: the auth scheme required for EWS requests: NOAUTH, BASIC or NTLM
+        :param throttle_every: return a throttling error for every n'th EWS request. 0 disables throttling
+        :param throttling: how to throttle: HTTP_THROTTLING or SOAP_THROTTLING
+        :param build: the server build number reported in ServerVersionInfo
+        :param api_version: the API version reported in ServerVersionInfo and types.xsd
+        :param email: the primary SMTP address of the mailbox
+        :param port: the port to listen on. 0 picks a free port
+        :param accept_gzip: accept gzip-compressed request bodies. If False, compressed requests get a 415 response
+        """
+        assert auth in (NOAUTH, BASIC, NTLM), 'Unsupported auth type %s' % auth
+        assert throttling in THROTTLING_CHOICES
+        self.page_size = page_size
+        self.body_size = body_size
+        self.latency = latency
+        self.auth = auth
+        self.throttle_every = throttle_every
+        self.throttling = throttling
+        self.build = build
+        self.api_version = api_version
+        self.email = email
+        self.accept_gzip = accept_gzip
+        self.stats = Counter()  # Requests per service name, plus 'throttled', 'auth_challenges' and 'gzip_requests'
+        self._lock = Lock()
+        self._request_count = 0
+        self._next_id = 0
+        self._items = OrderedDict()
+        for _ in range(items):
+            self._add_item(subject=None)
+        self._httpd = _ThreadingHTTPServer(('127.0.0.1', port), self._handler_class())
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.port
+
+    @property
+    def service_endpoint(self):
+        return self.url + EWS_PATH
+
+    @property
+    def autodiscover_endpoint(self):
+        return self.url + AUTODISCOVER_PATH
+
+    @property
+    def item_count(self):
+        return len(self._items)
+
+    def start(self):
+        self._thread = Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        log.debug('Mock EWS server listening on %s', self.url)
+        return self
+
+    def stop(self):
+        if self._thread:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args, **kwargs):
+        self.stop()
+
+    def _add_item(self, subject):
+        with self._lock:
+            self._next_id += 1
+            i = self._next_id
+            item_id = 'AAMkItem%08d' % i
+            self._items[item_id] = dict(
+                id=item_id,
+                changekey='CQAAAB%08d' % i,
+                folder_id='AAMkFolder-inbox',
+                subject=xml_escape(subject) if subject else 'Test item %s' % i,
+                body=('Body of item %s. ' % i * (self.body_size // 10 + 1))[:self.body_size],
+                datetime_received=(datetime.datetime(2017, 1, 1) + datetime.timedelta(minutes=i)).strftime(
+                    '%Y-%m-%dT%H:%M:%SZ'),
+                size=1000 + self.body_size,
+                category=i % 10,
+                is_read='true' if i % 2 else 'false',
+            )
+        return item_id
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep connections alive. NTLM needs this
+            disable_nagle_algorithm = True  # Don't add delayed ACK latency to responses written in multiple parts
+
+            def log_message(self, fmt, *args):
+                log.debug(fmt, *args)
+
+            def do_GET(self):
+                if self.path == TYPES_PATH:
+                    return self._respond(200, TYPES_XSD % server.api_version)
+                return self._respond(404, 'Not found', content_type='text/plain')
+
+            def do_POST(self):
+                data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if server.latency:
+                    time.sleep(server.latency)
+                if self.path == AUTODISCOVER_PATH:
+                    server.stats['Autodiscover'] += 1
+                    return self._respond(200, AUTODISCOVER % (AUTODISCOVER_RESPONSE_NS, server.email,
+                                                              server.service_endpoint))
+                if self.path != EWS_PATH:
+                    return self._respond(404, 'Not found', content_type='text/plain')
+                if not self._is_authenticated():
+                    return
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    if not server.accept_gzip:
+                        return self._respond(415, 'Unsupported Media Type', content_type='text/plain')
+                    server.stats['gzip_requests'] += 1
+                    data = zlib.decompress(data, 31)
+                status, body = server.handle_ews_request(data)
+                return self._respond(status, body)
+
+            def _is_authenticated(self):
+                header = self.headers.get('Authorization', '')
+                if server.auth == NOAUTH:
+                    return True
+                if server.auth == BASIC:
+                    if header.startswith('Basic '):
+                        return True
+                    server.stats['auth_challenges'] += 1
+                    self._respond(401, '', headers={'WWW-Authenticate': 'Basic realm="mock"'})
+                    return False
+                # NTLM authenticates the connection, not the request. There is one handler instance per connection.
+                if getattr(self, '_ntlm_authenticated', False):
+                    return True
+                if header.startswith('NTLM '):
+                    msg = base64.b64decode(header[5:])
+                    msg_type = struct.unpack('<I', msg[8:12])[0]
+                    if msg_type == 3:
+                        self._ntlm_authenticated = True
+                        return True
+                    server.stats['auth_challenges'] += 1
+                    self._respond(401, '', headers={
+                        'WWW-Authenticate': 'NTLM %s' % base64.b64encode(ntlm_challenge()).decode('ascii')
+                    })
+                    return False
+                self._respond(401, '', headers={'WWW-Authenticate': 'NTLM'})
+                return False
+
+            def _respond(self, status, body, content_type='text/xml; charset=utf-8', headers=None):
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def handle_ews_request(self, data):
+        # Returns (HTTP status, response body) for an EWS request
+        try:
+            request = to_xml(data.decode('utf-8'))
+            service_elem = request.find('{%s}Body' % SOAPNS)[0]
+        except Exception as e:
+            return 500, FAULT % (SOAPNS, 'a:ErrorInvalidRequest', xml_escape('Bad request: %s' % e))
+        service = service_elem.tag.split('}')[1]
+        with self._lock:
+            self.stats[service] += 1
+            self._request_count += 1
+            throttle = self.throttle_every and self._request_count % self.throttle_every == 0
+        if throttle:
+            self.stats['throttled'] += 1
+            if self.throttling == HTTP_THROTTLING:
+                return 503, 'Service Unavailable'
+            return 200, self._envelope(service, [self._message(
+                service, code='ErrorServerBusy', message_text='The server cannot service this request right now.'
+            )])
+        try:
+            handler = getattr(self, '_%s' % service)
+        except AttributeError:
+            return 500, FAULT % (SOAPNS, 'a:ErrorInvalidRequest', 'Service %s is not supported' % service)
+        return 200, self._envelope(service, handler(service_elem))
+
+    def _envelope(self, service, messages):
+        major, minor, major_build, minor_build = self.build
+        return ENVELOPE % dict(soapns=SOAPNS, mns=MNS, tns=TNS, major=major, minor=minor, major_build=major_build,
+                               minor_build=minor_build, api_version=self.api_version, service=service,
+                               messages=''.join(messages))
+
+    @staticmethod
+    def _message(service, content='', code='NoError', message_text=None):
+        return MESSAGE % dict(
+            service=service,
+            response_class='Success' if code == 'NoError' else 'Error',
+            message_text='<m:MessageText>%s</m:MessageText>' % message_text if message_text else '',
+            code=code,
+            content=content,
+        )
+
+    def _item_xml(self, item_id, id_only=False):
+        return (ITEM_ID_ONLY if id_only else ITEM) % self._items[item_id]
+
+    def _ResolveNames(self, elem):
+        content = '''<m:ResolutionSet TotalItemsInView="1" IncludesLastItemInRange="true"><t:Resolution>\
+<t:Mailbox><t:Name>Mock User</t:Name><t:EmailAddress>%s</t:EmailAddress><t:RoutingType>SMTP</t:RoutingType>\
+<t:MailboxType>Mailbox</t:MailboxType></t:Mailbox></t:Resolution></m:ResolutionSet>''' % self.email
+        return [self._message('ResolveNames', content=content)]
+
+    def _GetFolder(self, elem):
+        messages = []
+        for folder_elem in elem.find('{%s}FolderIds' % MNS):
+            folder_id = folder_elem.get('Id')
+            if folder_elem.tag == '{%s}FolderId' % TNS:
+                folder_id = folder_id.replace('AAMkFolder-', '', 1)
+            try:
+                name, folder_class = DISTINGUISHED_FOLDERS[folder_id]
+            except KeyError:
+                messages.append(self._message('GetFolder', code='ErrorFolderNotFound',
+                                              message_text='The specified folder could not be found in the store.'))
+                continue
+            is_root = folder_id == 'root'
+            folder_xml = FOLDER % dict(
+                id='AAMkFolder-%s' % folder_id,
+                parent_id='AAMkFolder-%s' % ('root' if folder_id == 'msgfolderroot' else 'msgfolderroot'),
+                folder_class='<t:FolderClass>%s</t:FolderClass>' % folder_class if folder_class else '',
+                name=name,
+                total_count=0 if is_root else self.item_count,
+                child_count=len(DISTINGUISHED_FOLDERS) - 1 if is_root else 0,
+            )
+            messages.append(self._message('GetFolder', content='<m:Folders>%s</m:Folders>' % folder_xml))
+        return messages
+
+    def _FindItem(self, elem):
+        shape = elem.find('{%s}ItemShape' % MNS)
+        id_only = shape.find('{%s}BaseShape' % TNS).text == 'IdOnly' \
+            and shape.find('{%s}AdditionalProperties' % TNS) is None
+        view = elem.find('{%s}IndexedPageItemView' % MNS)
+        offset, max_entries = 0, None
+        if view is not None:
+            offset = int(view.get('Offset', 0))
+            max_entries = int(view.get('MaxEntriesReturned')) if view.get('MaxEntriesReturned') else None
+        if self.page_size:
+            max_entries = min(max_entries or self.page_size, self.page_size)
+        with self._lock:
+            item_ids = list(self._items.keys())
+            total = len(item_ids)
+            page = item_ids[offset:offset + max_entries if max_entries else None]
+            items_xml = ''.join(self._item_xml(i, id_only=id_only) for i in page)
+        next_offset = offset + len(page)
+        content = '''<m:RootFolder IndexedPagingOffset="%s" TotalItemsInView="%s" IncludesLastItemInRange="%s">\
+<t:Items>%s</t:Items></m:RootFolder>''' % (next_offset, total, 'true' if next_offset >= total else 'false', items_xml)
+        return [self._message('FindItem', content=content)]
+
+    def _GetItem(self, elem):
+        messages = []
+        with self._lock:
+            for item_id_elem in elem.find('{%s}ItemIds' % MNS):
+                item_id = item_id_elem.get('Id')
+                if item_id not in self._items:
+                    messages.append(self._message('GetItem', code='ErrorItemNotFound',
+                                                  message_text='The specified object was not found in the store.'))
+                    continue
+                messages.append(self._message('GetItem', content='<m:Items>%s</m:Items>' % self._item_xml(item_id)))
+        return messages
+
+    def _CreateItem(self, elem):
+        messages = []
+        for item_elem in elem.find('{%s}Items' % MNS):
+            subject_elem = item_elem.find('{%s}Subject' % TNS)
+            item_id = self._add_item(subject=subject_elem.text if subject_elem is not None else None)
+            item = self._items[item_id]
+            messages.append(self._message('CreateItem', content='<m:Items><%s><t:ItemId Id="%s" ChangeKey="%s"/></%s>'
+                                                                '</m:Items>' % (
+                item_elem.tag.replace('{%s}' % TNS, 't:'), item['id'], item['changekey'],
+                item_elem.tag.replace('{%s}' % TNS, 't:'))))
+        return messages
+
+    def _delete_items(self, service, elem):
+        messages = []
+        with self._lock:
+            for item_id_elem in elem.find('{%s}ItemIds' % MNS):
+                if self._items.pop(item_id_elem.get('Id'), None) is None:
+                    messages.append(self._message(service, code='ErrorItemNotFound',
+                                                  message_text='The specified object was not found in the store.'))
+                else:
+                    messages.append(self._message(service))
+        return messages
+
+    def _DeleteItem(self, elem):
+        return self._delete_items('DeleteItem', elem)
+
+    def _SendItem(self, elem):
+        return self._delete_items('SendItem', elem)
+
+    def _MoveItem(self, elem):
+        messages = []
+        with self._lock:
+            for item_id_elem in elem.find('{%s}ItemIds' % MNS):
+                item_id = item_id_elem.get('Id')
+                if item_id not in self._items:
+                    messages.append(self._message('MoveItem', code='ErrorItemNotFound',
+                                                  message_text='The specified object was not found in the store.'))
+                    continue
+                messages.append(self._message('MoveItem', content='<m:Items>%s</m:Items>' % self._item_xml(
+                    item_id, id_only=True)))
+        return messages
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    mock_server = MockEWSServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080).start()
+    print('EWS endpoint: %s' % mock_server.service_endpoint)
+    print('Autodiscover endpoint: %s' % mock_server.autodiscover_endpoint)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        mock_server.stop()
@@ -4,6 +4,9 @@ Exchange account on your Ubuntu desktop.
 
 Usage: notifier.py [notify_interval]
 
+New emails are pushed by the server over a streaming subscription as they arrive. Upcoming appointments are checked
+every 'notify_interval' seconds.
+
 You need to install the `libxml2-dev` `libxslt1-dev` packages for
 'exchangelib' to work on Ubuntu.
 
@@ -32,6 +35,7 @@ pip3 install sh bs4 exchangelib > /dev/null
 sleep=${1:-600}
 while true
 do
+    # notifier.py only exits if something goes wrong. Restart it after a while.
     python3 notifier.py $sleep
     sleep $sleep
 done
@@ -43,8 +47,10 @@ import sys
 import warnings
 
 from exchangelib import DELEGATE, Credentials, Account, EWSTimeZone, UTC_NOW
+from exchangelib.notifications import StreamingDispatcher, NEW_MAIL
 
 from bs4 import BeautifulSoup
+from six.moves.queue import Queue, Empty
 import sh
 
 # Disable insecure SSL warnings
@@ -57,35 +63,62 @@ zenity = sh.Command('/usr/bin/zenity')
 # Get the local timezone
 tz = EWSTimeZone.localzone()
 
-sleep = int(sys.argv[1])  # 1st arg to this script is the number of seconds to look back in the inbox
-now = UTC_NOW()
-emails_since = now - timedelta(seconds=sleep)
-cal_items_before = now + timedelta(seconds=sleep * 4)  # Longer notice of upcoming appointments than new emails
+sleep = int(sys.argv[1])  # 1st arg to this script is the number of seconds between calendar checks
 username, _, password = netrc().authenticators('office365')
 c = Credentials(username, password)
 a = Account(primary_smtp_address=c.username, credentials=c, access_type=DELEGATE, autodiscover=True, verify_ssl=False)
 
-for msg in a.calendar.view(start=now, end=cal_items_before)\
-        .only('start', 'end', 'subject', 'location')\
-        .order_by('start', 'end'):
-    if msg.start < now:
-        continue
-    minutes_to_appointment = int((msg.start - now).total_seconds() / 60)
-    subj = 'You have a meeting in %s minutes' % minutes_to_appointment
-    body = '%s-%s: %s\n%s' % (
-        msg.start.astimezone(tz).strftime('%H:%M'),
-        msg.end.astimezone(tz).strftime('%H:%M'),
-        msg.subject[:150],
-        msg.location
-    )
-    zenity(**{'info': None, 'no-markup': None, 'title': subj, 'text': body})
-
-for msg in a.inbox.filter(datetime_received__gt=emails_since, is_read=False)\
-        .only('datetime_received', 'subject', 'body')\
-        .order_by('datetime_received',):
-    subj = 'New mail: %s' % msg.subject
-    body = BeautifulSoup(msg.body)
-    for s in body(['script', 'style']):
-        s.extract()
-    clean_body = '\n'.join(l for l in body.text.split('\n') if l)
-    notify(subj, clean_body[:200])
+# Let the server tell us about new emails instead of polling the inbox
+dispatcher = StreamingDispatcher(queue=Queue(), max_connections=1)
+dispatcher.subscribe(a, folders=[a.inbox], event_types=[NEW_MAIL])
+dispatcher.start()
+
+
+def notify_calendar(now):
+    cal_items_before = now + timedelta(seconds=sleep * 4)  # Longer notice of upcoming appointments than new emails
+    for msg in a.calendar.view(start=now, end=cal_items_before)\
+            .only('start', 'end', 'subject', 'location')\
+            .order_by('start', 'end'):
+        if msg.start < now:
+            continue
+        minutes_to_appointment = int((msg.start - now).total_seconds() / 60)
+        subj = 'You have a meeting in %s minutes' % minutes_to_appointment
+        body = '%s-%s: %s\n%s' % (
+            msg.start.astimezone(tz).strftime('%H:%M'),
+            msg.end.astimezone(tz).strftime('%H:%M'),
+            msg.subject[:150],
+            msg.location
+        )
+        zenity(**{'info': None, 'no-markup': None, 'title': subj, 'text': body})
+
+
+def notify_mail(item_id):
+    for msg in a.fetch(ids=[(item_id.id, item_id.changekey)], only_fields=['subject', 'body']):
+        if isinstance(msg, Exception):
+            # The message was probably deleted or moved before we got to it
+            continue
+        subj = 'New mail: %s' % msg.subject
+        body = BeautifulSoup(msg.body)
+        for s in body(['script', 'style']):
+            s.extract()
+        clean_body = '\n'.join(l for l in body.text.split('\n') if l)
+        notify(subj, clean_body[:200])
+
+
+next_calendar_check = UTC_NOW()
+try:
+    while True:
+        now = UTC_NOW()
+        if now >= next_calendar_check:
+            notify_calendar(now)
+            next_calendar_check = now + timedelta(seconds=sleep)
+        try:
+            subscription, event = dispatcher.queue.get(timeout=(next_calendar_check - now).total_seconds())
+        except Empty:
+            continue
+        if isinstance(event, Exception):
+            # The subscription failed. Exit and let the wrapper script restart us.
+            raise event
+        notify_mail(event.item_id)
+finally:
+    dispatcher.stop()
@@ -1,57 +1,80 @@
 # coding=utf-8
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import copy
 import datetime
 from decimal import Decimal
 import glob
 from itertools import chain
 import io
+import json
 from keyword import kwlist
+import logging
 import os
+import pickle
 import random
 import string
+from threading import Thread, Event, Lock
+import tempfile
 import time
 import unittest
+import zlib
 from xml.etree.ElementTree import ParseError
 
 import requests
 import requests_mock
-from six import PY2, string_types
+from six import PY2, string_types, with_metaclass
+from six.moves.queue import Queue
 from yaml import load
 
 from exchangelib import close_connections
 from exchangelib.account import Account, SAVE_ONLY, SEND_ONLY, SEND_AND_SAVE_COPY
 from exchangelib.attachments import FileAttachment, ItemAttachment
 from exchangelib.autodiscover import AutodiscoverProtocol, discover
+from exchangelib.cassette import Cassette, Recorder, Replayer
 from exchangelib.configuration import Configuration
 from exchangelib.credentials import DELEGATE, IMPERSONATION, Credentials, ServiceAccount
 from exchangelib.errors import RelativeRedirect, ErrorItemNotFound, ErrorInvalidOperation, AutoDiscoverRedirect, \
     AutoDiscoverCircularRedirect, AutoDiscoverFailed, ErrorNonExistentMailbox, UnknownTimeZone, \
     ErrorNameResolutionNoResults, TransportError, RedirectError, CASError, RateLimitError, UnauthorizedError, \
     ErrorInvalidChangeKey, ErrorInvalidIdMalformed, ErrorContainsFilterWrongType, ErrorAccessDenied, \
-    ErrorFolderNotFound, ErrorInvalidRequest, SOAPError, ErrorInvalidServerVersion
+    ErrorFolderNotFound, ErrorInvalidRequest, SOAPError, ErrorInvalidServerVersion, ErrorSubscriptionNotFound, \
+    ErrorExceededFindCountLimit
 from exchangelib.ewsdatetime import EWSDateTime, EWSDate, EWSTimeZone, UTC, UTC_NOW
 from exchangelib.extended_properties import ExtendedProperty, ExternId
+from exchangelib.fanout import FanOut, map_accounts
 from exchangelib.fields import BooleanField, IntegerField, DecimalField, TextField, EmailField, URIField, ChoiceField, \
     BodyField, DateTimeField, Base64Field, PhoneNumberField, EmailAddressField, \
     PhysicalAddressField, ExtendedPropertyField, MailboxField, AttendeesField, AttachmentField, TextListField, \
-    MailboxListField, Choice, FieldPath, EWSElementField
+    MailboxListField, Choice, FieldPath, FieldOrder, EWSElementField
 from exchangelib.folders import Calendar, DeletedItems, Drafts, Inbox, Outbox, SentItems, JunkEmail, Messages, Tasks, \
-    Contacts, Folder
+    Contacts, Folder, Root, FolderTree, ParentFolderId, DEEP, CalendarView
 from exchangelib.indexed_properties import IndexedElement, EmailAddress, PhysicalAddress, PhoneNumber, \
     SingleFieldIndexedElement, MultiFieldIndexedElement
-from exchangelib.items import Item, CalendarItem, Message, Contact, Task, DistributionList, ALL_OCCURRENCIES
+from exchangelib.items import Item, CalendarItem, Message, Contact, Task, DistributionList, ALL_OCCURRENCIES, \
+    LAZY_PER_FIELD, LAZY_PER_ITEM
 from exchangelib.properties import Attendee, Mailbox, RoomList, MessageHeader, Room, ItemId, Member, EWSElement
-from exchangelib.protocol import Protocol
-from exchangelib.queryset import QuerySet, DoesNotExist, MultipleObjectsReturned
+from exchangelib.protocol import Protocol, CachingProtocol
+from exchangelib.queryset import QuerySet, DoesNotExist, MultipleObjectsReturned, order_key
 from exchangelib.recurrence import Recurrence, AbsoluteYearlyPattern, RelativeYearlyPattern, AbsoluteMonthlyPattern, \
     RelativeMonthlyPattern, WeeklyPattern, DailyPattern, FirstOccurrence, LastOccurrence, Occurrence, \
-    DeletedOccurrence, NoEndPattern, EndDatePattern, NumberedPattern
+    DeletedOccurrence, NoEndPattern, EndDatePattern, NumberedPattern, Pattern, WEEK_DAY, LAST
 from exchangelib.restriction import Restriction, Q
-from exchangelib.services import GetServerTimeZones, GetRoomLists, GetRooms, GetAttachment, ResolveNames, TNS
+from exchangelib.resultcache import ResultCache
+from exchangelib.metrics import InMemoryMetrics, set_global_metrics, get_metrics, SERVICE_REQUESTS, \
+    SERVICE_LATENCY, SESSION_WAIT, SESSION_WARMUP, REQUEST_BYTES, RESPONSE_BYTES, SUCCESS, PROTOCOL_CACHE, HIT, MISS, \
+    NEGATIVE_HIT, RESULT_CACHE, REVALIDATED
+from exchangelib.mirror import ItemMirror
+from exchangelib.notifications import events_from_xml, NewMailEvent, MovedEvent, ModifiedEvent, StatusEvent, \
+    StreamingDispatcher
+from exchangelib.services import GetServerTimeZones, GetRoomLists, GetRooms, GetAttachment, ResolveNames, SendItem, \
+    SyncFolderItems, GetStreamingEvents, FindItem, TNS, MNS
+from exchangelib.tracing import InMemorySpanExporter, set_global_exporter, start_span, trace_iter, \
+    propagate_context, get_current_span
 from exchangelib.transport import NOAUTH, BASIC, DIGEST, NTLM, wrap, _get_auth_method_from_response
 from exchangelib.util import chunkify, peek, get_redirect_url, to_xml, BOM, get_domain, \
-    post_ratelimited, create_element, CONNECTION_ERRORS
+    post_ratelimited, create_element, CONNECTION_ERRORS, LazyResponseText, gzip_compress
 from exchangelib.version import Build, Version, EXCHANGE_2007, EXCHANGE_2010, EXCHANGE_2013, EXCHANGE_2016
+from exchangelib.wirelog import WireLog
 from exchangelib.winzone import generate_map, PYTZ_TO_MS_TIMEZONE_MAP
 
 if PY2:
@@ -61,14 +84,16 @@ string_type = string_types[0]
 
 mock_account = namedtuple('mock_account', ('protocol', 'version'))
 mock_protocol = namedtuple('mock_protocol', ('version', 'service_endpoint'))
+mock_pooled_protocol = namedtuple('mock_pooled_protocol', ('version', 'service_endpoint', 'thread_pool'))
 mock_version = namedtuple('mock_version', ('build',))
 
 
 def mock_post(url, status_code, headers, text):
     req = namedtuple('request', ['headers'])(headers={})
     return lambda **kwargs: namedtuple(
-        'response', ['status_code', 'headers', 'text', 'request', 'history', 'url']
-    )(status_code=status_code, headers=headers, text=text, request=req, history=None, url=url)
+        'response', ['status_code', 'headers', 'text', 'content', 'request', 'history', 'url']
+    )(status_code=status_code, headers=headers, text=text, content=text.encode('utf-8'), request=req, history=None,
+      url=url)
 
 
 def mock_session_exception(exc_cls):
@@ -264,6 +289,597 @@ class ProtocolTest(unittest.TestCase):
             self.assertEqual(id(base_p.thread_pool), id(p.thread_pool))
             self.assertEqual(id(base_p._session_pool), id(p._session_pool))
 
+    def test_protocol_cache_locking(self):
+        # Test that protocols are created once per key without blocking other keys, and that errors are cached for a
+        # limited time
+        calls = []
+
+        class MockProtocol(with_metaclass(CachingProtocol, object)):
+            NEGATIVE_CACHE_TTL = 0.2
+
+            def __init__(self, service_endpoint, credentials, verify_ssl):
+                calls.append(service_endpoint)
+                if 'dead' in service_endpoint:
+                    raise TransportError('Connection refused')
+                if 'slow' in service_endpoint:
+                    time.sleep(0.5)
+
+            def close(self):
+                pass
+
+        metrics = InMemoryMetrics()
+        set_global_metrics(metrics)
+        try:
+            threads = [Thread(target=MockProtocol, kwargs=dict(service_endpoint='https://slow.example.com',
+                                                               credentials=None, verify_ssl=True))
+                       for _ in range(5)]
+            for t in threads:
+                t.start()
+            time.sleep(0.1)
+            # The slow server doesn't block other servers
+            t1 = time.time()
+            MockProtocol(service_endpoint='https://fast.example.com', credentials=None, verify_ssl=True)
+            self.assertLess(time.time() - t1, 0.3)
+            for t in threads:
+                t.join()
+            self.assertEqual(calls.count('https://slow.example.com'), 1)
+            self.assertEqual(metrics.get_counter(PROTOCOL_CACHE, endpoint='https://slow.example.com', result=MISS), 1)
+            self.assertEqual(metrics.get_counter(PROTOCOL_CACHE, endpoint='https://slow.example.com', result=HIT), 4)
+            # Key locks are dropped when they are no longer needed
+            self.assertEqual(CachingProtocol._protocol_cache_key_locks, {})
+
+            # Errors are raised again until they expire
+            for _ in range(3):
+                with self.assertRaises(TransportError):
+                    MockProtocol(service_endpoint='https://dead.example.com', credentials=None, verify_ssl=True)
+            self.assertEqual(calls.count('https://dead.example.com'), 1)
+            self.assertEqual(
+                metrics.get_counter(PROTOCOL_CACHE, endpoint='https://dead.example.com', result=NEGATIVE_HIT), 2)
+            time.sleep(MockProtocol.NEGATIVE_CACHE_TTL * (1 + MockProtocol.NEGATIVE_CACHE_JITTER))
+            with self.assertRaises(TransportError):
+                MockProtocol(service_endpoint='https://dead.example.com', credentials=None, verify_ssl=True)
+            self.assertEqual(calls.count('https://dead.example.com'), 2)
+            self.assertEqual(CachingProtocol._protocol_cache_key_locks, {})
+        finally:
+            set_global_metrics(None)
+            CachingProtocol.clear_cache()
+
+    @requests_mock.mock()
+    def test_session_warmup(self, m):
+        m.post('https://warm.example.com/EWS/Exchange.asmx', status_code=200)
+
+        class WarmProtocol(Protocol):
+            PREWARM_SESSIONS = True
+
+        metrics = InMemoryMetrics()
+        set_global_metrics(metrics)
+        try:
+            protocol = WarmProtocol(service_endpoint='https://warm.example.com/EWS/Exchange.asmx',
+                                    credentials=Credentials('A', 'B'), auth_type=NTLM, verify_ssl=True,
+                                    version=Version(Build(15, 1)))
+            self.assertEqual(m.call_count, protocol.SESSION_POOLSIZE)
+            self.assertEqual(len(metrics.get_observations(SESSION_WARMUP, outcome=SUCCESS)), protocol.SESSION_POOLSIZE)
+
+            # Retired sessions are replaced by warm sessions in the background
+            protocol.retire_session(protocol.get_session())
+            sessions = [protocol.get_session() for _ in range(protocol.SESSION_POOLSIZE)]
+            self.assertEqual(m.call_count, protocol.SESSION_POOLSIZE + 1)
+            for session in sessions:
+                protocol.release_session(session)
+
+            # Renewed sessions are also replaced in the background
+            session = protocol.get_session()
+            new_session = protocol.renew_session(session)
+            self.assertNotEqual(id(session), id(new_session))
+            protocol.release_session(new_session)
+            sessions = [protocol.get_session() for _ in range(protocol.SESSION_POOLSIZE)]
+            self.assertEqual(m.call_count, protocol.SESSION_POOLSIZE + 2)
+            for session in sessions:
+                protocol.release_session(session)
+            protocol.close()
+        finally:
+            set_global_metrics(None)
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'os.fork() is not available on this platform')
+    @requests_mock.mock()
+    def test_fork(self, m):
+        m.get('https://fork.example.com/EWS/types.xsd', status_code=200)
+        protocol = Protocol(service_endpoint='https://fork.example.com/EWS/Exchange.asmx',
+                            credentials=Credentials('A', 'B'), auth_type=NTLM, verify_ssl=True,
+                            version=Version(Build(15, 1)))
+        session_ids = {id(s) for s in protocol._session_pool.queue}
+        thread_pool = protocol.thread_pool
+        call_count = m.call_count
+        pid = os.fork()
+        if pid == 0:
+            # pylint: disable=bare-except
+            try:
+                # The child gets its own sessions and threads, but keeps the cached protocol and its version
+                p = Protocol(service_endpoint='https://fork.example.com/EWS/Exchange.asmx',
+                             credentials=Credentials('A', 'B'), auth_type=NTLM, verify_ssl=True)
+                assert p is protocol
+                # Threads that use the protocol at the same time all get the same new thread pool
+                thread_pools = []
+                threads = [Thread(target=lambda: thread_pools.append(p.thread_pool)) for _ in range(4)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                assert len({id(tp) for tp in thread_pools}) == 1
+                session = p.get_session()
+                assert id(session) not in session_ids
+                p.release_session(session)
+                assert p.thread_pool is not thread_pool
+                assert p.thread_pool.apply_async(lambda: 42).get(timeout=5) == 42
+                assert p.version.build == Build(15, 1)
+                assert m.call_count == call_count
+                p.close()
+            except:
+                os._exit(1)
+            os._exit(0)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        # The parent is not affected
+        self.assertEqual({id(s) for s in protocol._session_pool.queue}, session_ids)
+        self.assertIs(protocol.thread_pool, thread_pool)
+        self.assertEqual(protocol.thread_pool.apply_async(lambda: 42).get(timeout=5), 42)
+
+    @requests_mock.mock()
+    def test_session_keepalive(self, m):
+        m.post('https://keepalive.example.com/EWS/Exchange.asmx', status_code=200)
+
+        class KeepaliveProtocol(Protocol):
+            KEEPALIVE_INTERVAL = 0.2
+
+        protocol = KeepaliveProtocol(service_endpoint='https://keepalive.example.com/EWS/Exchange.asmx',
+                                     credentials=Credentials('A', 'B'), auth_type=NTLM, verify_ssl=True,
+                                     version=Version(Build(15, 1)))
+        self.assertEqual(m.call_count, 0)
+        # Recently used sessions are left alone
+        session = protocol.get_session()
+        time.sleep(0.3)
+        protocol.release_session(session)
+        self.assertEqual(m.call_count, protocol.SESSION_POOLSIZE - 1)
+        protocol.close()
+        call_count = m.call_count
+        time.sleep(0.3)
+        self.assertEqual(m.call_count, call_count)
+        # Sessions from a session factory are not kept alive
+        m.post('https://keepalive2.example.com/EWS/Exchange.asmx', status_code=200)
+        protocol = KeepaliveProtocol(service_endpoint='https://keepalive2.example.com/EWS/Exchange.asmx',
+                                     credentials=Credentials('A', 'B'), auth_type=NTLM, verify_ssl=True,
+                                     version=Version(Build(15, 1)))
+        protocol.set_session_factory(lambda p: p.create_http_session())
+        call_count = m.call_count
+        time.sleep(0.3)
+        self.assertEqual(m.call_count, call_count)
+        protocol.close()
+
+
+class FanOutTest(unittest.TestCase):
+    mock_account = namedtuple('mock_account', ('primary_smtp_address',))
+
+    def test_round_robin(self):
+        # Accounts take turns, so the account with many tasks doesn't block the others
+        a, b = self.mock_account('a@example.com'), self.mock_account('b@example.com')
+        started = Event()
+        order = []
+        with FanOut(max_workers=1) as fan_out:
+            fan_out.submit(a, started.wait)
+            for i in range(3):
+                fan_out.submit(a, order.append, 'a%s' % i)
+            fan_out.submit(b, order.append, 'b0')
+            started.set()
+            for _ in range(5):
+                fan_out.get_result(timeout=5)
+            self.assertEqual(fan_out.pending, 0)
+        self.assertEqual(order, ['b0', 'a0', 'a1', 'a2'])
+
+    def test_concurrency_limits(self):
+        a, b = self.mock_account('a@example.com'), self.mock_account('b@example.com')
+        lock = Lock()
+        running = {a: 0, b: 0}
+        max_running = {a: 0, b: 0, None: 0}
+
+        def task(account):
+            with lock:
+                running[account] += 1
+                max_running[account] = max(max_running[account], running[account])
+                max_running[None] = max(max_running[None], sum(running.values()))
+            time.sleep(0.02)
+            with lock:
+                running[account] -= 1
+
+        with FanOut(max_workers=3, max_per_account=2) as fan_out:
+            for _ in range(6):
+                fan_out.submit(a, task, a)
+                fan_out.submit(b, task, b)
+            for _ in range(12):
+                fan_out.get_result(timeout=5)
+        self.assertEqual(max_running[a], 2)
+        self.assertEqual(max_running[b], 2)
+        self.assertEqual(max_running[None], 3)
+
+    def test_map_accounts(self):
+        consumed = []
+
+        def accounts():
+            for i in range(20):
+                consumed.append(i)
+                yield self.mock_account('user%s@example.com' % i)
+
+        def fn(account):
+            if account.primary_smtp_address == 'user7@example.com':
+                raise ErrorAccessDenied('Denied')
+            return account.primary_smtp_address.upper()
+
+        results = map_accounts(accounts(), fn, max_workers=2)
+        next(results)
+        # The accounts are consumed lazily
+        self.assertLess(len(consumed), 20)
+        res = dict((account.primary_smtp_address, result) for account, result in results)
+        self.assertEqual(len(consumed), 20)
+        self.assertIsInstance(res.pop('user7@example.com'), ErrorAccessDenied)
+        for address, result in res.items():
+            self.assertEqual(result, address.upper())
+
+
+class MetricsTest(unittest.TestCase):
+    def test_in_memory_metrics(self):
+        metrics = InMemoryMetrics()
+        metrics.increment(SERVICE_REQUESTS, service='GetItem', outcome=SUCCESS)
+        metrics.increment(SERVICE_REQUESTS, 2, service='GetItem', outcome='ErrorServerBusy')
+        metrics.increment(SERVICE_REQUESTS, service='FindItem', outcome=SUCCESS)
+        self.assertEqual(metrics.get_counter(SERVICE_REQUESTS), 4)
+        self.assertEqual(metrics.get_counter(SERVICE_REQUESTS, service='GetItem'), 3)
+        self.assertEqual(metrics.get_counter(SERVICE_REQUESTS, outcome=SUCCESS), 2)
+        self.assertEqual(metrics.get_counter(SERVICE_REQUESTS, service='XXX'), 0)
+        metrics.observe(SERVICE_LATENCY, 0.5, service='GetItem')
+        metrics.observe(SERVICE_LATENCY, 1.5, service='GetItem')
+        self.assertEqual(sorted(metrics.get_observations(SERVICE_LATENCY, service='GetItem')), [0.5, 1.5])
+        self.assertEqual(len(metrics.get_labels(SERVICE_REQUESTS)), 3)
+        metrics.reset()
+        self.assertEqual(metrics.get_counter(SERVICE_REQUESTS), 0)
+        self.assertEqual(metrics.get_observations(SERVICE_LATENCY), [])
+
+    def test_global_metrics(self):
+        metrics = InMemoryMetrics()
+        set_global_metrics(metrics)
+        try:
+            self.assertEqual(id(get_metrics()), id(metrics))
+            self.assertEqual(id(get_metrics(mock_protocol(version=None, service_endpoint=None))), id(metrics))
+        finally:
+            set_global_metrics(None)
+        self.assertNotEqual(id(get_metrics()), id(metrics))
+
+    @requests_mock.mock()
+    def test_service_metrics(self, m):
+        # Test that service calls report requests, latency, bytes and session wait to the protocol metrics
+        endpoint = 'https://example.com/Metrics.asmx'
+        m.get('https://example.com/EWS/types.xsd', status_code=200)
+        protocol = Protocol(service_endpoint=endpoint, credentials=Credentials('A', 'B'), auth_type=NOAUTH,
+                            verify_ssl=True, version=Version(Build(15, 1)))
+        protocol.metrics = InMemoryMetrics()
+        try:
+            response = '''<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">
+  <s:Body>
+    <m:GetRoomListsResponse xmlns:m="%s" xmlns:t="%s" ResponseClass="Success">
+      <m:ResponseCode>NoError</m:ResponseCode>
+      <m:RoomLists />
+    </m:GetRoomListsResponse>
+  </s:Body>
+</s:Envelope>''' % (MNS, TNS)
+            m.post(endpoint, status_code=200, text=response)
+            self.assertEqual(GetRoomLists(protocol=protocol).call(), [])
+            metrics = protocol.metrics
+            self.assertEqual(metrics.get_counter(SERVICE_REQUESTS, service='GetRoomLists', endpoint=endpoint,
+                                                 outcome=SUCCESS), 1)
+            self.assertEqual(len(metrics.get_observations(SERVICE_LATENCY, service='GetRoomLists')), 1)
+            self.assertEqual(len(metrics.get_observations(SESSION_WAIT, endpoint=endpoint)), 1)
+            self.assertEqual(metrics.get_observations(REQUEST_BYTES, endpoint=endpoint),
+                             [len(m.last_request.body)])
+            self.assertEqual(metrics.get_observations(RESPONSE_BYTES, endpoint=endpoint, status_code=200),
+                             [len(response.encode('utf-8'))])
+
+            # Failed requests are labelled with the exception class
+            m.post(endpoint, status_code=200, text='XXX')
+            with self.assertRaises(SOAPError):
+                GetRoomLists(protocol=protocol).call()
+            self.assertEqual(metrics.get_counter(SERVICE_REQUESTS, outcome='SOAPError'), 1)
+            self.assertEqual(metrics.get_counter(SERVICE_REQUESTS, service='GetRoomLists'), 2)
+        finally:
+            protocol.metrics = None
+
+
+class TracingTest(unittest.TestCase):
+    def setUp(self):
+        self.exporter = InMemorySpanExporter()
+        set_global_exporter(self.exporter)
+
+    def tearDown(self):
+        set_global_exporter(None)
+
+    def test_disabled(self):
+        set_global_exporter(None)
+        with start_span('foo') as span:
+            self.assertIsNone(get_current_span())
+            span.set_attribute('bar', 42)
+        self.assertEqual(list(trace_iter('foo', lambda: [1, 2])), [1, 2])
+        self.assertEqual(id(propagate_context(get_current_span)), id(get_current_span))
+        self.assertEqual(self.exporter.get_spans(), [])
+
+    def test_span_tree(self):
+        with start_span('parent', foo='bar') as parent:
+            self.assertEqual(id(get_current_span()), id(parent))
+            with start_span('child') as child:
+                child.set_attribute('baz', 42)
+            with self.assertRaises(ValueError):
+                with start_span('failing'):
+                    raise ValueError()
+        self.assertIsNone(get_current_span())
+        self.assertEqual([s.name for s in self.exporter.get_spans()], ['child', 'failing', 'parent'])
+        self.assertEqual([s.name for s in self.exporter.get_children(parent)], ['child', 'failing'])
+        self.assertEqual(len({s.trace_id for s in self.exporter.get_spans()}), 1)
+        self.assertIsNone(parent.parent_id)
+        self.assertEqual(parent.attributes, {'foo': 'bar'})
+        self.assertEqual(child.attributes, {'baz': 42})
+        self.assertIsNone(child.error)
+        self.assertEqual(self.exporter.get_spans('failing')[0].error, 'ValueError')
+        self.assertGreaterEqual(parent.duration, child.duration)
+
+    def test_trace_iter(self):
+        def gen():
+            for i in range(3):
+                with start_span('inner'):
+                    pass
+                yield i
+
+        consumer_parents = []
+        for _ in trace_iter('outer', gen):
+            # The consumer does not run in the span of the iterator
+            consumer_parents.append(get_current_span())
+        self.assertEqual(consumer_parents, [None, None, None])
+        outer = self.exporter.get_spans('outer')[0]
+        self.assertEqual(len(self.exporter.get_children(outer)), 3)
+
+        # The span is finished when the iterator is closed early
+        it = trace_iter('closed', gen)
+        next(it)
+        it.close()
+        self.assertEqual(len(self.exporter.get_spans('closed')), 1)
+
+    def test_propagate_context(self):
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(processes=2)
+        try:
+            def work(i):
+                with start_span('work', i=i):
+                    return get_current_span().parent_id
+            with start_span('parent') as parent:
+                results = [pool.apply_async(propagate_context(work), (i,)) for i in range(4)]
+                parent_ids = [r.get() for r in results]
+            # Without propagation, the worker spans would start new traces
+            self.assertEqual(parent_ids, [parent.span_id] * 4)
+            self.assertEqual({s.trace_id for s in self.exporter.get_spans('work')}, {parent.trace_id})
+        finally:
+            pool.terminate()
+
+    @requests_mock.mock()
+    def test_service_spans(self, m):
+        endpoint = 'https://example.com/Tracing.asmx'
+        m.get('https://example.com/EWS/types.xsd', status_code=200)
+        protocol = Protocol(service_endpoint=endpoint, credentials=Credentials('A', 'B'), auth_type=NOAUTH,
+                            verify_ssl=True, version=Version(Build(15, 1)))
+        m.post(endpoint, status_code=200, text='''<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">
+  <s:Body>
+    <m:GetRoomListsResponse xmlns:m="%s" xmlns:t="%s" ResponseClass="Success">
+      <m:ResponseCode>NoError</m:ResponseCode>
+      <m:RoomLists />
+    </m:GetRoomListsResponse>
+  </s:Body>
+</s:Envelope>''' % (MNS, TNS))
+        GetRoomLists(protocol=protocol).call()
+        service = self.exporter.get_spans('service')[0]
+        self.assertEqual(service.attributes['service'], 'GetRoomLists')
+        self.assertEqual(sorted(s.name for s in self.exporter.get_children(service)), ['http_attempt', 'xml_parse'])
+        self.assertEqual(self.exporter.get_spans('http_attempt')[0].attributes['status_code'], 200)
+
+
+class WireLogTest(unittest.TestCase):
+    def test_body(self):
+        wire_log = WireLog(max_body_size=60)
+        body = b'<s:Header><t:ExchangeImpersonation><t:ConnectingSID>foo@example.com</t:ConnectingSID>' \
+               b'</t:ExchangeImpersonation></s:Header>'
+        self.assertEqual(wire_log._body(body),
+                         '<s:Header><t:ExchangeImpersonation>[REDACTED]</t:ExchangeImpersonation>[...]')
+        self.assertEqual(WireLog(max_body_size=None)._body(body),
+                         '<s:Header><t:ExchangeImpersonation>[REDACTED]</t:ExchangeImpersonation></s:Header>')
+        self.assertEqual(WireLog(max_body_size=0)._body(body), '')
+        self.assertEqual(wire_log._body(None), '')
+        self.assertEqual(wire_log._headers({'Authorization': 'NTLM xxx', 'Content-Type': 'text/xml'}),
+                         {'Authorization': '[REDACTED]', 'Content-Type': 'text/xml'})
+
+    def test_should_log(self):
+        self.assertTrue(WireLog().should_log(service='GetItem'))
+        self.assertFalse(WireLog(sample_rate=0).should_log(service='GetItem'))
+        self.assertTrue(WireLog(services=['GetItem']).should_log(service='GetItem'))
+        self.assertFalse(WireLog(services=['GetItem']).should_log(service='FindItem'))
+        self.assertFalse(WireLog(services=['GetItem']).should_log(service=None))
+
+    def test_lazy_response_text(self):
+        class Response(object):
+            @property
+            def text(self):
+                raise AssertionError('Response body was decoded')
+
+        # Formatting is skipped entirely when the log level is disabled
+        logging.getLogger('exchangelib.util').debug('%s', LazyResponseText(Response()))
+
+    @requests_mock.mock()
+    def test_wire_log(self, m):
+        endpoint = 'https://example.com/WireLog.asmx'
+        m.get('https://example.com/EWS/types.xsd', status_code=200)
+        protocol = Protocol(service_endpoint=endpoint, credentials=Credentials('A', 'B'), auth_type=NOAUTH,
+                            verify_ssl=True, version=Version(Build(15, 1)))
+        m.post(endpoint, status_code=200, text='''<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">
+  <s:Body>
+    <m:GetRoomListsResponse xmlns:m="%s" xmlns:t="%s" ResponseClass="Success">
+      <m:ResponseCode>NoError</m:ResponseCode>
+      <m:RoomLists />
+    </m:GetRoomListsResponse>
+  </s:Body>
+</s:Envelope>''' % (MNS, TNS), headers={'Set-Cookie': 'secret'})
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            protocol.wire_log = WireLog(filename=filename, services=['GetRoomLists'], max_body_size=10)
+            GetRoomLists(protocol=protocol).call()
+            with self.assertRaises(SOAPError):
+                protocol.get_timezones()  # Not in 'services', so not logged
+            with io.open(filename, encoding='utf-8') as f:
+                records = [json.loads(line) for line in f]
+        finally:
+            protocol.wire_log = None
+            os.unlink(filename)
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual(record['service'], 'GetRoomLists')
+        self.assertEqual(record['status_code'], 200)
+        self.assertEqual(record['request_body'], '<?xml vers[...]')
+        self.assertEqual(record['request_size'], len(m.request_history[0].body))
+        self.assertEqual(record['response_headers']['Set-Cookie'], '[REDACTED]')
+
+
+class CompressionTest(unittest.TestCase):
+    @requests_mock.mock()
+    def test_request_compression(self, m):
+        endpoint = 'https://example.com/Compression.asmx'
+        m.get('https://example.com/EWS/types.xsd', status_code=200)
+        protocol = Protocol(service_endpoint=endpoint, credentials=Credentials('A', 'B'), auth_type=NOAUTH,
+                            verify_ssl=True, version=Version(Build(15, 1)))
+        data = b'<foo>' + b'x' * 10000 + b'</foo>'
+        try:
+            # Small requests are not compressed
+            protocol.compress_requests_over = len(data)
+            m.post(endpoint, status_code=200, text='OK')
+            session = protocol.get_session()
+            r, session = post_ratelimited(protocol=protocol, session=session, url=endpoint, headers=None, data=data)
+            self.assertNotIn('Content-Encoding', m.last_request.headers)
+            self.assertEqual(m.last_request.body, data)
+
+            protocol.compress_requests_over = 1024
+            r, session = post_ratelimited(protocol=protocol, session=session, url=endpoint, headers=None, data=data)
+            self.assertEqual(m.last_request.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(zlib.decompress(m.last_request.body, 31), data)
+            self.assertEqual(protocol.compression_stats.compressed_requests, 1)
+            self.assertEqual(protocol.compression_stats.uncompressed_bytes, len(data))
+            self.assertLess(protocol.compression_stats.ratio, 0.1)
+
+            # The server rejects compressed requests. We resend uncompressed and stop compressing.
+            m.post(endpoint, [{'status_code': 415, 'text': ''}, {'status_code': 200, 'text': 'OK'}])
+            r, session = post_ratelimited(protocol=protocol, session=session, url=endpoint, headers=None, data=data)
+            self.assertEqual(r.text, 'OK')
+            self.assertEqual(m.request_history[-2].headers['Content-Encoding'], 'gzip')
+            self.assertNotIn('Content-Encoding', m.last_request.headers)
+            self.assertEqual(m.last_request.body, data)
+            self.assertIsNone(protocol.compress_requests_over)
+            self.assertEqual(protocol.compression_stats.fallbacks, 1)
+            protocol.release_session(session)
+        finally:
+            protocol.compress_requests_over = None
+
+
+class CassetteTest(unittest.TestCase):
+    @requests_mock.mock()
+    def test_record_and_replay(self, m):
+        endpoint = 'https://example.com/Cassette.asmx'
+        m.get('https://example.com/EWS/types.xsd', status_code=200)
+        protocol = Protocol(service_endpoint=endpoint, credentials=Credentials('A', 'B'), auth_type=NOAUTH,
+                            verify_ssl=True, version=Version(Build(15, 1)))
+        response = '''<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">
+  <s:Body>
+    <m:GetRoomListsResponse xmlns:m="%s" xmlns:t="%s" ResponseClass="Success">
+      <m:ResponseCode>NoError</m:ResponseCode>
+      <m:RoomLists>
+        <t:Address><t:Name>Room list %s</t:Name><t:EmailAddress>roomlist@example.com</t:EmailAddress></t:Address>
+      </m:RoomLists>
+    </m:GetRoomListsResponse>
+  </s:Body>
+</s:Envelope>'''
+        m.post(endpoint, [
+            {'status_code': 200, 'text': response % (MNS, TNS, 1), 'headers': {'Set-Cookie': 'secret'}},
+            {'status_code': 200, 'text': response % (MNS, TNS, 2)},
+        ])
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            cassette = Cassette()
+            protocol.set_session_factory(Recorder(cassette))
+            recorded = [protocol.get_roomlists(), protocol.get_roomlists()]
+            protocol.set_session_factory(None)
+            self.assertEqual(len(cassette), 2)
+            self.assertEqual(cassette.interactions[0]['service'], 'GetRoomLists')
+            self.assertEqual(cassette.interactions[0]['response']['headers']['Set-Cookie'], '[REDACTED]')
+            cassette.save(filename)
+
+            # Replay without the server
+            m.post(endpoint, exc=AssertionError('Replay must not send requests'))
+            protocol.set_session_factory(Replayer(Cassette.load(filename)))
+            self.assertEqual([protocol.get_roomlists(), protocol.get_roomlists()], recorded)
+            self.assertEqual([r.name for r in recorded[0] + recorded[1]], ['Room list 1', 'Room list 2'])
+            # All recordings have been used
+            with self.assertRaises(ValueError):
+                protocol.get_roomlists()
+        finally:
+            protocol.set_session_factory(None)
+            os.unlink(filename)
+
+    def test_replay_matching(self):
+        def interaction(service, body, elapsed=0):
+            return dict(service=service, elapsed=elapsed, request=dict(url='https://a.example.com/EWS', headers={},
+                                                                       body=body),
+                        response=dict(status_code=200, reason='OK', headers={}, body=body.upper()))
+
+        replayer = Replayer(Cassette(interactions=[
+            interaction('GetItem', '<s:Body><m:GetItem>1</m:GetItem></s:Body>'),
+            interaction('GetItem', '<s:Body><m:GetItem>2</m:GetItem></s:Body>'),
+            interaction('FindItem', '<s:Body><m:FindItem>1</m:FindItem></s:Body>'),
+        ]))
+        # Matched on URL path and body, regardless of the order of requests and the server name
+        r = replayer.get_response(url='https://b.example.com/EWS', headers=None,
+                                  data=b'<s:Body><m:GetItem>2</m:GetItem></s:Body>')
+        self.assertEqual(r.text, '<S:BODY><M:GETITEM>2</M:GETITEM></S:BODY>')
+        # Unknown bodies fall back to the first unused recording of the same service
+        r = replayer.get_response(url='https://b.example.com/EWS', headers=None,
+                                  data=b'<s:Body><m:GetItem>3</m:GetItem></s:Body>')
+        self.assertEqual(r.text, '<S:BODY><M:GETITEM>1</M:GETITEM></S:BODY>')
+        with self.assertRaises(ValueError):
+            replayer.get_response(url='https://b.example.com/EWS', headers=None,
+                                  data=b'<s:Body><m:GetItem>1</m:GetItem></s:Body>')
+        self.assertEqual(replayer.remaining, 1)
+
+    def test_record_compressed(self):
+        # Test that compressed requests are recorded uncompressed and redacted, and that they can be replayed
+        body = b'<s:Header><t:ExchangeImpersonation>secret@example.com</t:ExchangeImpersonation></s:Header>' \
+               b'<s:Body><m:GetItem>1</m:GetItem></s:Body>'
+        response = namedtuple('mock_response', ('status_code', 'reason', 'headers', 'content'))(
+            status_code=200, reason='OK', headers={}, content=b'<s:Body>OK</s:Body>')
+        cassette = Cassette()
+        cassette.add(url='https://example.com/EWS', request_headers={'Content-Encoding': 'gzip'},
+                     request_data=gzip_compress(body), response=response, elapsed=0)
+        interaction = cassette.interactions[0]
+        self.assertEqual(interaction['service'], 'GetItem')
+        self.assertNotIn('secret', interaction['request']['body'])
+        self.assertIn('[REDACTED]', interaction['request']['body'])
+        self.assertEqual(interaction['request']['headers'], {})
+        r = Replayer(cassette).get_response(url='https://example.com/EWS', headers={'Content-Encoding': 'gzip'},
+                                            data=gzip_compress(body))
+        self.assertEqual(r.content, b'<s:Body>OK</s:Body>')
+
 
 class CredentialsTest(unittest.TestCase):
     def test_hash(self):
@@ -602,6 +1218,184 @@ class ItemTest(unittest.TestCase):
         # We reset percent_complete to 0.0 if state is not_started
         self.assertEqual(task.percent_complete, Decimal(0))
 
+    def test_compact_items(self):
+        # Items have no __dict__. Extended properties are stored in a side table that only exists when needed.
+        class TestProp(ExtendedProperty):
+            property_set_id = 'deadbeaf-cafe-cafe-cafe-deadbeefcafe'
+            property_name = 'Test Property'
+            property_type = 'Integer'
+
+        for item in (Message(subject='foo'), CalendarItem(), Contact(), Task(), DistributionList(), Item()):
+            self.assertFalse(hasattr(item, '__dict__'), item.__class__)
+            self.assertIsNone(item._extended_properties)
+            with self.assertRaises(AttributeError):
+                item.no_such_field = 1
+
+        # Subclasses that don't add fields can still have arbitrary attributes
+        class MyMessage(Message):
+            pass
+
+        item = MyMessage(subject='foo')
+        item.my_attr = 1
+        self.assertEqual((item.subject, item.my_attr), ('foo', 1))
+        Message.register(attr_name='test_prop', attr_cls=TestProp)
+        try:
+            item = Message(subject='foo', extern_id='bar')
+            self.assertIsNone(item.test_prop)
+            self.assertEqual(item._extended_properties, {'extern_id': 'bar'})
+            item.test_prop = 42
+            # Copies don't share changes to extended properties
+            item_copy = copy.copy(item)
+            item_copy.test_prop = 43
+            item.extern_id = None
+            self.assertEqual(item._extended_properties, {'test_prop': 42})
+            self.assertEqual((item_copy.extern_id, item_copy.test_prop), ('bar', 43))
+            self.assertEqual(pickle.loads(pickle.dumps(item_copy)).test_prop, 43)
+        finally:
+            Message.deregister(attr_name='test_prop')
+        self.assertFalse(hasattr(Message, 'test_prop'))
+        self.assertFalse(hasattr(CalendarItem(), 'test_prop'))
+
+    def test_lazy_decoding(self):
+        xml = '''\
+<t:Message xmlns:t="http://schemas.microsoft.com/exchange/services/2006/types">
+    <t:ItemId Id="id1" ChangeKey="ck1"/>
+    <t:Subject>Foo</t:Subject>
+    <t:Body BodyType="Text">Bar</t:Body>
+    <t:ExtendedProperty>
+        <t:ExtendedFieldURI PropertySetId="c11ff724-aa03-4555-9952-8fa248a11c3e" PropertyName="External ID"
+                            PropertyType="String" />
+        <t:Value>Baz</t:Value>
+    </t:ExtendedProperty>
+    <t:IsRead>true</t:IsRead>
+</t:Message>'''
+        eager = Message.from_xml(elem=to_xml(xml), account=None)
+        # Fields are decoded on first access
+        item = Message.from_xml(elem=to_xml(xml), account=None, lazy=LAZY_PER_FIELD)
+        self.assertEqual((item.item_id, item.changekey), ('id1', 'ck1'))
+        num_pending = len(item._lazy[2])
+        self.assertEqual(item.subject, 'Foo')
+        self.assertEqual(item.extern_id, 'Baz')
+        self.assertEqual(len(item._lazy[2]), num_pending - 2)
+        # Values set before decoding are kept
+        item.is_read = False
+        item.extern_id = None
+        self.assertEqual((item.is_read, item.extern_id), (False, None))
+        item.is_read, item.extern_id = True, 'Baz'
+        self.assertEqual(repr(item), repr(eager))
+        # 'is_read' was set before it was decoded, so it will never be decoded. The element is kept.
+        self.assertEqual(item._lazy[2], {'is_read'})
+        self.assertEqual(item.attachments, [])
+        with self.assertRaises(AttributeError):
+            item.no_such_field
+        # All fields are decoded on the first access to any field
+        item = Message.from_xml(elem=to_xml(xml), account=None, lazy=LAZY_PER_ITEM)
+        item_copy = copy.copy(item)
+        self.assertEqual(item.body, 'Bar')
+        self.assertIsNone(item._lazy)
+        self.assertEqual(repr(item), repr(eager))
+        # Copies decode their own fields
+        self.assertEqual(repr(item_copy), repr(eager))
+        # Copying a lazy item doesn't decode any fields, also not when the item goes through the result cache
+        item = Message.from_xml(elem=to_xml(xml), account=None, lazy=LAZY_PER_FIELD)
+        pending = item._lazy[2]
+        item_copy = copy.copy(item)
+        self.assertEqual((item._lazy[2], item_copy._lazy[2]), (pending, pending))
+        self.assertEqual(item_copy.item_id, 'id1')
+        cache = ResultCache()
+        cached_item = cache.get_items(cache.put('key', [item]))[0]
+        self.assertEqual((item._lazy[2], cached_item._lazy[2]), (pending, pending))
+        self.assertEqual(repr(cached_item), repr(eager))
+        self.assertEqual(item._lazy[2], pending)
+        # New lazy items share the set of pending field names until they decode a field
+        self.assertIs(Message.from_xml(elem=to_xml(xml), account=None, lazy=LAZY_PER_FIELD)._lazy[2],
+                      Message.from_xml(elem=to_xml(xml), account=None, lazy=LAZY_PER_FIELD)._lazy[2])
+        Message.register(attr_name='lazy_prop', attr_cls=ExternId)
+        try:
+            item = Message.from_xml(elem=to_xml(xml), account=None, lazy=LAZY_PER_FIELD)
+            self.assertIn('lazy_prop', item._lazy[2])
+            self.assertEqual(item.lazy_prop, 'Baz')
+        finally:
+            Message.deregister(attr_name='lazy_prop')
+        self.assertNotIn('lazy_prop', Message.from_xml(elem=to_xml(xml), account=None, lazy=LAZY_PER_FIELD)._lazy[2])
+
+
+class RecurrenceTest(unittest.TestCase):
+    def test_pattern_dates(self):
+        start = EWSDate(2017, 1, 2)  # A Monday
+        tested = set()
+        for pattern, number, dates in (
+                (DailyPattern(interval=3), 3, [(2017, 1, 2), (2017, 1, 5), (2017, 1, 8)]),
+                (WeeklyPattern(interval=2, weekdays=[5, 1]), 4,
+                 [(2017, 1, 2), (2017, 1, 6), (2017, 1, 16), (2017, 1, 20)]),
+                (WeeklyPattern(interval=1, weekdays=[1], first_day_of_week=3), 2, [(2017, 1, 2), (2017, 1, 9)]),
+                (AbsoluteMonthlyPattern(interval=1, day_of_month=31), 3, [(2017, 1, 31), (2017, 2, 28), (2017, 3, 31)]),
+                (RelativeMonthlyPattern(interval=2, week_number=LAST, weekdays=WEEK_DAY), 2,
+                 [(2017, 1, 31), (2017, 3, 31)]),
+                (RelativeMonthlyPattern(interval=1, week_number=2, weekdays=[2]), 2, [(2017, 1, 10), (2017, 2, 14)]),
+                (AbsoluteYearlyPattern(month=2, day_of_month=29), 2, [(2017, 2, 28), (2018, 2, 28)]),
+                (RelativeYearlyPattern(month=3, week_number=1, weekdays=[7]), 2, [(2017, 3, 5), (2018, 3, 4)]),
+        ):
+            pattern.clean()
+            recurrence = Recurrence(pattern=pattern, start=start, number=number)
+            self.assertEqual(list(recurrence.dates()), [EWSDate(*d) for d in dates], pattern)
+            tested.add(pattern.__class__)
+        # All pattern classes implement the hooks that expand them, and are tested above
+        self.assertEqual(tested, set(Pattern.__subclasses__()))
+        for cls in tested:
+            self.assertIn('period_index', cls.__dict__)
+            self.assertIn('period_dates', cls.__dict__)
+
+    def test_boundaries(self):
+        pattern = DailyPattern(interval=1)
+        boundary = NumberedPattern(start=EWSDate(2017, 1, 1), number=0)
+        self.assertEqual(list(Recurrence(pattern=pattern, boundary=boundary).dates()), [])
+        self.assertEqual(list(Recurrence(pattern=pattern, start=EWSDate(2017, 1, 1), end=EWSDate(2017, 1, 3)).dates()),
+                         [EWSDate(2017, 1, 1), EWSDate(2017, 1, 2), EWSDate(2017, 1, 3)])
+        # Numbered recurrences are counted from the start, also when asking for a later window
+        recurrence = Recurrence(pattern=pattern, start=EWSDate(2017, 1, 1), number=10)
+        self.assertEqual(list(recurrence.dates(start=EWSDate(2017, 1, 9))), [EWSDate(2017, 1, 9), EWSDate(2017, 1, 10)])
+        # Windows far into the future are generated lazily
+        recurrence = Recurrence(pattern=WeeklyPattern(interval=1, weekdays=[1, 2, 3, 4, 5]), start=EWSDate(2017, 1, 1))
+        self.assertEqual(list(recurrence.dates(start=EWSDate(9000, 1, 3), end=EWSDate(9000, 1, 6))),
+                         [EWSDate(9000, 1, 3), EWSDate(9000, 1, 6)])
+        self.assertEqual(len(list(recurrence.dates(start=EWSDate(9999, 12, 1)))), 23)
+
+    def test_expand(self):
+        tz = EWSTimeZone.timezone('Europe/Copenhagen')
+        item = CalendarItem(
+            start=tz.localize(EWSDateTime(2017, 3, 24, 9)),
+            end=tz.localize(EWSDateTime(2017, 3, 24, 10)),
+            recurrence=Recurrence(pattern=DailyPattern(interval=1), start=EWSDate(2017, 3, 24), number=7),
+            deleted_occurrences=[DeletedOccurrence(start=tz.localize(EWSDateTime(2017, 3, 25, 9)))],
+            modified_occurrences=[Occurrence(
+                item_id='XXX', changekey='YYY',
+                start=tz.localize(EWSDateTime(2017, 3, 29, 12)), end=tz.localize(EWSDateTime(2017, 3, 29, 13)),
+                original_start=tz.localize(EWSDateTime(2017, 3, 26, 9)),
+            )],
+        )
+        occurrences = list(item.expand(start=UTC.localize(EWSDateTime(2017, 3, 1)),
+                                       end=UTC.localize(EWSDateTime(2017, 4, 1)), tz=tz))
+        # The local start time stays the same across the DST change on March 26
+        self.assertEqual(
+            [(o.item_id, o.start.astimezone(tz).day, o.start.astimezone(tz).hour) for o in occurrences],
+            [(None, 24, 9), (None, 27, 9), (None, 28, 9), (None, 29, 9), ('XXX', 29, 12), (None, 30, 9)]
+        )
+        self.assertEqual(occurrences[0].end - occurrences[0].start, datetime.timedelta(hours=1))
+        # The window is half-open, like CalendarView
+        occurrences = list(item.expand(start=tz.localize(EWSDateTime(2017, 3, 27, 10)),
+                                       end=tz.localize(EWSDateTime(2017, 3, 28, 9)), tz=tz))
+        self.assertEqual(occurrences, [])
+        occurrences = list(item.expand(start=tz.localize(EWSDateTime(2017, 3, 27, 9, 30)),
+                                       end=tz.localize(EWSDateTime(2017, 3, 28, 9, 30)), tz=tz))
+        self.assertEqual([o.start.astimezone(tz).day for o in occurrences], [27, 28])
+
+        # Non-recurring items
+        item = CalendarItem(item_id='XXX', start=tz.localize(EWSDateTime(2017, 3, 24, 9)),
+                            end=tz.localize(EWSDateTime(2017, 3, 24, 10)))
+        self.assertEqual([o.item_id for o in item.expand(start=item.start, end=item.end)], ['XXX'])
+        self.assertEqual(list(item.expand(start=item.end, end=item.end + datetime.timedelta(days=1))), [])
+
 
 class RestrictionTest(unittest.TestCase):
     def setUp(self):
@@ -692,6 +1486,50 @@ class RestrictionTest(unittest.TestCase):
         self.assertEqual((~~Q(foo__contains=('bar', 'baz'))).conn_type, Q.AND)
         self.assertEqual(Q(foo__contains=('bar', 'baz')), ~~Q(foo__contains=('bar', 'baz')))
 
+    def test_q_split(self):
+        q = Q(foo__in=range(5)) & Q(bar=1)
+        self.assertEqual(
+            [i.expr() for i in q.split(max_values=2)],
+            ['(foo == 0 OR foo == 1) AND bar == 1', '(foo == 2 OR foo == 3) AND bar == 1', 'bar == 1 AND foo == 4']
+        )
+        # The original is unchanged
+        self.assertEqual(len(q.children[0].children), 5)
+        # Two lists are both split
+        self.assertEqual(len(Q(foo__in=range(5), bar__in=range(3)).split(max_values=2)), 6)
+        # Lists that are OR'ed with something else can't be split
+        q = Q(foo__in=range(5)) | Q(bar=1)
+        self.assertEqual(q.split(max_values=2), [q])
+        q = Q(foo__in=range(5))
+        self.assertEqual(q.split(max_values=5), [q])
+
+    def test_q_simplify(self):
+        # Nested expressions are flattened, and duplicates and double negations are removed
+        q = (Q(foo=1) & Q(foo=1)) & (Q(bar=2) & ~~Q(baz__contains='x'))
+        self.assertEqual(q.simplify().expr(), "bar == 2 AND baz contains 'x' AND foo == 1")
+        self.assertEqual((Q(foo=1) | (Q(bar=2) | Q(foo=1))).simplify().expr(), 'bar == 2 OR foo == 1')
+        self.assertEqual((~(~Q(foo__contains='x') & ~Q(foo__contains='x'))).simplify().expr(), "foo contains 'x'")
+        # Bounds on the same field are merged
+        self.assertEqual((Q(foo__range=(1, 10)) & Q(foo__gt=3) & Q(foo__not=20) & Q(foo__not=5)).simplify().expr(),
+                         'foo > 3 AND foo <= 10 AND foo != 5')
+        self.assertEqual((Q(foo__gte=3) & Q(foo__lte=3)).simplify().expr(), 'foo == 3')
+        self.assertEqual((Q(foo=3) & Q(foo__lt=5)).simplify().expr(), 'foo == 3')
+        dt = UTC.localize(EWSDateTime(2017, 1, 1))
+        self.assertEqual((Q(start__gt=dt) & Q(start__gt=dt - datetime.timedelta(days=1))).simplify().expr(),
+                         'start > %r' % dt)
+        # Strings are not merged
+        self.assertEqual((Q(foo__gt='a') & Q(foo__gt='b')).simplify().expr(), "foo > 'a' AND foo > 'b'")
+        # Contradictions
+        self.assertIsNone((Q(foo__gt=5) & Q(foo__lt=3)).simplify())
+        self.assertIsNone((Q(foo__gt=5) & Q(foo__lte=5)).simplify())
+        self.assertIsNone((Q(foo=1) & Q(foo=2)).simplify())
+        self.assertIsNone((Q(foo=1) & ~Q(foo=1)).simplify())
+        self.assertEqual(((Q(foo=1) & Q(foo=2)) | Q(bar=3)).simplify().expr(), 'bar == 3')
+        self.assertTrue((~(Q(foo=1) & Q(foo=2))).simplify().is_empty())
+        # Unchanged
+        q = Q(foo=1) | Q(bar=2)
+        self.assertEqual(q.simplify(), q)
+        self.assertEqual(Q().simplify(), Q())
+
     def test_q_boolean_ops(self):
         self.assertEqual((Q(foo=5) & Q(foo=6)).conn_type, Q.AND)
         self.assertEqual((Q(foo=5) | Q(foo=6)).conn_type, Q.OR)
@@ -710,6 +1548,297 @@ class QuerySetTest(unittest.TestCase):
         self.assertIsInstance(folder.filter(subject='foo'), QuerySet)
         self.assertIsInstance(folder.exclude(subject='foo'), QuerySet)
 
+    def test_order_key(self):
+        folder = Calendar(account='XXX')
+        items = [CalendarItem(subject=subject, start=UTC.localize(EWSDateTime(2017, 1, day)))
+                 for subject, day in (('b', 1), ('a', 2), ('b', 3), (None, 4), ('a', 1))]
+        order_fields = [FieldOrder.from_string(f, folder=folder) for f in ('subject', '-start')]
+        self.assertEqual([(i.subject, i.start.day) for i in sorted(items, key=order_key(order_fields))],
+                         [(None, 4), ('a', 2), ('a', 1), ('b', 3), ('b', 1)])
+
+    def test_clientside_ordering(self):
+        # Test that calendar views are sorted client-side without sorting or fetching more than needed
+        class MockCalendar(Calendar):
+            find_items_result = []
+
+            def find_items(self, *args, **kwargs):
+                for i in self.find_items_result:
+                    if isinstance(i, Exception):
+                        raise i
+                    yield i
+
+        version = mock_version(build=EXCHANGE_2010)
+        account = mock_account(version=version, protocol=mock_protocol(version=version, service_endpoint='example.com'))
+        folder = MockCalendar(account=account)
+        start = UTC.localize(EWSDateTime(2017, 1, 1))
+        window = FindItem.CALENDAR_VIEW_WINDOW
+        folder.find_items_result = [
+            CalendarItem(subject='a', start=start + datetime.timedelta(hours=3)),
+            CalendarItem(subject='b', start=start + datetime.timedelta(hours=1)),
+            CalendarItem(subject='c', start=start + datetime.timedelta(hours=2)),
+            CalendarItem(subject='d', start=start + window + datetime.timedelta(hours=2)),
+            CalendarItem(subject='e', start=start + window + datetime.timedelta(hours=1)),
+        ]
+        qs = folder.view(start=start, end=start + 3 * window).only('subject', 'start')
+        self.assertEqual([i.subject for i in qs.order_by('start')], ['b', 'c', 'a', 'e', 'd'])
+        self.assertEqual([i.subject for i in qs.order_by('-start')], ['d', 'e', 'a', 'c', 'b'])
+        self.assertEqual([i.subject for i in qs.order_by('-subject')[:2]], ['e', 'd'])
+        self.assertEqual(qs.order_by('-subject')[1].subject, 'd')
+
+        # Sorting on start is done one window at a time, so we stop fetching when we have enough items
+        folder.find_items_result = folder.find_items_result[:4] + [AssertionError('Fetched too many windows')]
+        sliced_qs = qs.order_by('start')
+        self.assertEqual([i.subject for i in sliced_qs[:2]], ['b', 'c'])
+        # A partial result must not fill the cache
+        self.assertIsNone(sliced_qs._cache)
+
+    def test_serverside_slicing(self):
+        # Test that slices and indexes are sent to the server as offsets and limits
+        class MockInbox(Inbox):
+            calls = []
+
+            def find_items(self, *args, **kwargs):
+                self.calls.append((kwargs['offset'], kwargs['max_items'], kwargs['page_size']))
+                for i in range(kwargs['offset'], 200)[:kwargs['max_items']]:
+                    yield i, 'XXX'
+
+        version = mock_version(build=EXCHANGE_2010)
+        account = mock_account(version=version, protocol=mock_protocol(version=version, service_endpoint='example.com'))
+        folder = MockInbox(account=account)
+        qs = folder.all().only('item_id')
+        self.assertEqual([i.item_id for i in qs[150:160]], list(range(150, 160)))
+        self.assertEqual([i.item_id for i in qs[10:20:5]], [10, 15])
+        self.assertEqual([i.item_id for i in qs[190:]], list(range(190, 200)))
+        self.assertEqual(list(qs[20:10]), [])
+        self.assertEqual(qs[42].item_id, 42)
+        with self.assertRaises(IndexError):
+            qs[200]
+        self.assertEqual(MockInbox.calls, [(150, 10, 10), (10, 10, 10), (190, None, None), (42, 1, 1), (200, 1, 1)])
+        self.assertIsNone(qs._cache)
+
+    def test_split_in_lookups(self):
+        # Test that long '__in' lookups are split into several FindItem requests, and the results are merged
+        from multiprocessing.pool import ThreadPool
+        messages = [Message(item_id='id%03d' % i, changekey='XXX', subject='Subject %03d' % i) for i in range(600)]
+
+        class MockInbox(Inbox):
+            calls = []
+
+            def find_items(self, q, **kwargs):
+                subjects = [c.value for c in q.children] if q.children else [q.value]
+                self.calls.append((len(subjects), kwargs['order_fields'], kwargs['max_items']))
+                items = [m for m in messages if m.subject in subjects]
+                if kwargs['order_fields']:
+                    items.sort(key=order_key(kwargs['order_fields']))
+                for m in items[:kwargs['max_items']]:
+                    if kwargs['additional_fields']:
+                        yield Message(item_id=m.item_id, changekey=m.changekey, subject=m.subject)
+                    else:
+                        yield m.item_id, m.changekey
+
+        version = mock_version(build=EXCHANGE_2010)
+        protocol = mock_pooled_protocol(version=version, service_endpoint='example.com', thread_pool=ThreadPool(4))
+        try:
+            folder = MockInbox(account=mock_account(version=version, protocol=protocol))
+            # Subject 000 is listed twice
+            subjects = [m.subject for m in reversed(messages)] + ['Subject 000']
+            qs = folder.filter(subject__in=subjects)
+
+            self.assertEqual(sorted(i for i in qs.values_list('item_id', flat=True)), [m.item_id for m in messages])
+            # The duplicate value is removed before splitting
+            self.assertEqual(MockInbox.calls, [(250, None, None), (250, None, None), (100, None, None)])
+
+            # Results are merged in order
+            MockInbox.calls = []
+            self.assertEqual([i for i in qs.order_by('-subject').values_list('subject', flat=True)],
+                             [m.subject for m in reversed(messages)])
+            self.assertEqual(len(MockInbox.calls), 3)
+            self.assertEqual([i for i in qs.order_by('subject').values_list('item_id', flat=True)][:3],
+                             ['id000', 'id001', 'id002'])
+            # Fields that are only needed for merging are not returned
+            self.assertIsNone(qs.order_by('subject').only('is_read')[0].subject)
+
+            # Slices are applied to the merged result
+            MockInbox.calls = []
+            self.assertEqual([i.subject for i in qs.order_by('subject').only('subject')[10:15]],
+                             [m.subject for m in messages[10:15]])
+            self.assertEqual([c[2] for c in MockInbox.calls], [15, 15, 15])
+        finally:
+            protocol.thread_pool.terminate()
+
+    def test_result_cache(self):
+        # Test that identical queries share results, and only new and changed items are fetched again
+        store = OrderedDict((i, Message(item_id=i, changekey='ck1', subject='Subject %s' % i)) for i in ('a', 'b', 'c'))
+
+        class MockInbox(Inbox):
+            calls = []
+
+            def find_items(self, q, **kwargs):
+                self.calls.append(('find', bool(kwargs['additional_fields'])))
+                for m in store.values():
+                    if kwargs['additional_fields']:
+                        yield Message(item_id=m.item_id, changekey=m.changekey, subject=m.subject)
+                    else:
+                        yield m.item_id, m.changekey
+
+            def fetch(self, ids, **kwargs):
+                self.calls.append(('fetch', [item_id for item_id, _ in ids]))
+                for item_id, _ in ids:
+                    m = store[item_id]
+                    yield Message(item_id=m.item_id, changekey=m.changekey, subject=m.subject)
+
+        version = mock_version(build=EXCHANGE_2010)
+        cache = ResultCache(ttl=60)
+        metrics = InMemoryMetrics()
+        protocol = namedtuple('mock_protocol', ('version', 'service_endpoint', 'result_cache', 'metrics'))(
+            version=version, service_endpoint='example.com', result_cache=cache, metrics=metrics)
+        account = namedtuple('mock_account', ('protocol', 'version', 'primary_smtp_address'))(
+            protocol=protocol, version=version, primary_smtp_address='foo@example.com')
+        folder = MockInbox(account=account)
+
+        def subjects():
+            return [i.subject for i in folder.filter(is_read=False).only('subject')]
+
+        self.assertEqual(subjects(), ['Subject a', 'Subject b', 'Subject c'])
+        self.assertEqual(MockInbox.calls, [('find', True)])
+        self.assertEqual((len(cache), cache.size), (1, 3))
+        # A new QuerySet only asks for IDs and changekeys
+        del MockInbox.calls[:]
+        self.assertEqual(subjects(), ['Subject a', 'Subject b', 'Subject c'])
+        self.assertEqual(MockInbox.calls, [('find', False)])
+        # Only new and changed items are fetched
+        del MockInbox.calls[:]
+        store['b'] = Message(item_id='b', changekey='ck2', subject='Changed b')
+        store['d'] = Message(item_id='d', changekey='ck1', subject='Subject d')
+        del store['a']
+        self.assertEqual(subjects(), ['Changed b', 'Subject c', 'Subject d'])
+        self.assertEqual(MockInbox.calls, [('find', False), ('fetch', ['b', 'd'])])
+        # Cached items are not changed by consumers
+        for i in folder.filter(is_read=False).only('subject'):
+            i.subject = 'XXX'
+        self.assertEqual(subjects(), ['Changed b', 'Subject c', 'Subject d'])
+        # Fresh entries are served without a request
+        del MockInbox.calls[:]
+        cache.fresh_for = 60
+        self.assertEqual(subjects(), ['Changed b', 'Subject c', 'Subject d'])
+        self.assertEqual([i for i in folder.filter(is_read=False).values_list('subject', flat=True)],
+                         ['Changed b', 'Subject c', 'Subject d'])
+        self.assertEqual(MockInbox.calls, [])
+        # Other queries have their own entries
+        self.assertEqual(folder.filter(is_read=False).count(), 3)
+        self.assertEqual(MockInbox.calls, [('find', False)])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(metrics.get_counter(RESULT_CACHE, result=MISS), 2)
+        self.assertEqual(metrics.get_counter(RESULT_CACHE, result=REVALIDATED), 4)
+        self.assertEqual(metrics.get_counter(RESULT_CACHE, result=HIT), 2)
+        # Lazy queries don't share entries with eager queries
+        del MockInbox.calls[:]
+        self.assertEqual([i.subject for i in folder.filter(is_read=False).only('subject').lazy()],
+                         ['Changed b', 'Subject c', 'Subject d'])
+        self.assertEqual(MockInbox.calls, [('find', True)])
+        self.assertEqual(len(cache), 3)
+
+    def test_result_cache_limits(self):
+        cache = ResultCache(ttl=60, max_items=3)
+        cache.put('foo', [('a', 'ck'), ('b', 'ck')])
+        cache.put('bar', [('c', 'ck')])
+        self.assertEqual(cache.get('foo').ids, [('a', 'ck'), ('b', 'ck')])
+        # The least recently used entry is evicted
+        cache.put('baz', [('d', 'ck')])
+        self.assertIsNone(cache.get('bar'))
+        self.assertEqual((len(cache), cache.size), (2, 3))
+        # Results that are too large are not cached
+        cache.put('foo', [('a', 'ck'), ('b', 'ck'), ('c', 'ck'), ('d', 'ck')])
+        self.assertIsNone(cache.get('foo'))
+        self.assertEqual((len(cache), cache.size), (1, 1))
+        # Expired entries are dropped
+        cache.ttl = 0
+        self.assertIsNone(cache.get('baz'))
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+    def test_values_rows(self):
+        # Test that values() and values_list() decode the requested fields without creating items
+        xml = '''\
+<t:Message xmlns:t="http://schemas.microsoft.com/exchange/services/2006/types">
+    <t:ItemId Id="id%(i)s" ChangeKey="ck%(i)s"/>
+    <t:Subject>Subject %(i)s</t:Subject>
+    <t:DateTimeReceived>2017-01-0%(i)sT10:00:00Z</t:DateTimeReceived>
+    <t:ReminderMinutesBeforeStart>%(i)s</t:ReminderMinutesBeforeStart>
+</t:Message>'''
+
+        class MockInbox(Inbox):
+            kwargs = []
+
+            def find_items(self, q, **kwargs):
+                raise AssertionError('Items should not be created')
+
+            def _find_item_elems(self, q, **kwargs):
+                self.kwargs.append(kwargs)
+                return (to_xml(xml % dict(i=i)) for i in range(1, 4)[kwargs['offset']:][:kwargs['max_items']])
+
+        version = mock_version(build=EXCHANGE_2010)
+        account = mock_account(version=version, protocol=mock_protocol(version=version, service_endpoint='example.com'))
+        folder = MockInbox(account=account)
+        qs = folder.filter(subject__contains='Subject')
+        minutes = 'reminder_minutes_before_start'
+        fields = ('subject', 'datetime_received', minutes, 'item_id', 'changekey')
+        expected = [Message.from_xml(elem=to_xml(xml % dict(i=i)), account=None) for i in range(1, 4)]
+        self.assertEqual([i for i in qs.values(*fields)], [{f: getattr(m, f) for f in fields} for m in expected])
+        self.assertEqual({f.path for f in MockInbox.kwargs[0]['additional_fields']}, set(fields[:3]))
+        self.assertEqual([i for i in qs.values_list('changekey', minutes)], [('ck1', 1), ('ck2', 2), ('ck3', 3)])
+        self.assertEqual([i for i in qs.values_list(minutes, flat=True)], [1, 2, 3])
+        self.assertEqual(qs.values_list('subject', flat=True)[1], 'Subject 2')
+        self.assertEqual((MockInbox.kwargs[-1]['offset'], MockInbox.kwargs[-1]['max_items']), (1, 1))
+        # Columnar results
+        self.assertEqual(qs.columns('item_id', minutes), {'item_id': ['id1', 'id2', 'id3'], minutes: [1, 2, 3]})
+        self.assertEqual([b for b in qs.column_batches(minutes, batch_size=2)], [{minutes: [1, 2]}, {minutes: [3]}])
+        self.assertEqual(qs.none().columns(minutes), {minutes: []})
+        with self.assertRaises(AttributeError):
+            list(qs.column_batches(minutes, foo=True))
+
+    def test_lazy(self):
+        class MockInbox(Inbox):
+            kwargs = []
+
+            def find_items(self, q, **kwargs):
+                self.kwargs.append(kwargs)
+                return iter([])
+
+        version = mock_version(build=EXCHANGE_2010)
+        account = mock_account(version=version, protocol=mock_protocol(version=version, service_endpoint='example.com'))
+        folder = MockInbox(account=account)
+        self.assertIsNone(folder.all().lazy_mode)
+        list(folder.all().lazy().only('subject'))
+        self.assertEqual(MockInbox.kwargs[-1]['lazy'], LAZY_PER_FIELD)
+        qs = folder.filter(subject='foo').lazy(LAZY_PER_ITEM)
+        list(qs.order_by('subject').only('subject'))
+        self.assertEqual(MockInbox.kwargs[-1]['lazy'], LAZY_PER_ITEM)
+        with self.assertRaises(ValueError):
+            folder.all().lazy('XXX')
+
+    def test_simplified_restriction(self):
+        class MockInbox(Inbox):
+            restrictions = []
+
+            def find_items(self, q, **kwargs):
+                self.restrictions.append(q)
+                return iter([])
+
+        version = mock_version(build=EXCHANGE_2010)
+        account = mock_account(version=version, protocol=mock_protocol(version=version, service_endpoint='example.com'))
+        folder = MockInbox(account=account)
+        # Impossible queries don't send any requests
+        self.assertEqual(list(folder.filter(size__gt=10).filter(size__lt=5)), [])
+        self.assertEqual(folder.filter(size=10).exclude(size__in=[10]).count(), 0)
+        self.assertEqual(MockInbox.restrictions, [])
+        qs = folder.filter(subject='foo').filter(subject='foo', size__range=(1, 10)).exclude(size__gte=5)
+        [i for i in qs.only('item_id')]
+        self.assertEqual(MockInbox.restrictions[0].expr(), "size >= 1 AND size < 5 AND subject == 'foo'")
+        # The simplified restriction is cached, also on copies that don't change the restriction
+        self.assertIs(qs._get_simplified_q(), qs._get_simplified_q())
+        self.assertIs(qs.only('subject')._get_simplified_q(), qs._get_simplified_q())
+        self.assertIsNot(qs.filter(is_read=True)._get_simplified_q(), qs._get_simplified_q())
+
     def test_queryset_copy(self):
         qs = QuerySet(folder=Inbox(account='XXX'))
         qs.q = Q()
@@ -783,6 +1912,398 @@ class ServicesTest(unittest.TestCase):
         with self.assertRaises(NotImplementedError):
             GetRooms(protocol=account.protocol).call('XXX')
 
+    def test_pooled_requests(self):
+        # Test that services using EWSPooledMixIn split the items into chunks of CHUNKSIZE and return results in order
+        from multiprocessing.pool import ThreadPool
+        version = mock_version(build=EXCHANGE_2010)
+        protocol = mock_pooled_protocol(version=version, service_endpoint='example.com', thread_pool=ThreadPool(4))
+        try:
+            account = mock_account(version=version, protocol=protocol)
+            service = SendItem(account=account)
+            # Return the number of item IDs in each payload instead of sending the request
+            service._get_elements = lambda payload: [(payload[0][0].get('Id'), len(payload[0]))]
+            ids = [('id%s' % i, 'changekey%s' % i) for i in range(60)]
+            self.assertEqual(
+                list(service.call(items=ids, saved_item_folder=None)),
+                [('id0', SendItem.CHUNKSIZE), ('id25', SendItem.CHUNKSIZE), ('id50', 10)]
+            )
+        finally:
+            protocol.thread_pool.terminate()
+
+    def test_pipelined_requests(self):
+        # Test that chunks of a slow generator are processed and returned while the generator is still producing items,
+        # and that the generator is not consumed too far ahead of the consumer.
+        from multiprocessing.pool import ThreadPool
+        version = mock_version(build=EXCHANGE_2010)
+        protocol = mock_pooled_protocol(version=version, service_endpoint='example.com', thread_pool=ThreadPool(4))
+        try:
+            account = mock_account(version=version, protocol=protocol)
+            service = SendItem(account=account)
+            service._get_elements = lambda payload: [(payload[0][0].get('Id'), len(payload[0]))]
+            first_chunk_consumed = Event()
+            produced = []
+
+            def ids():
+                for i in range(1000):
+                    if i == SendItem.CHUNKSIZE + 1:
+                        # Like waiting for the next FindItem page. The consumer must get the first chunk before this.
+                        self.assertTrue(first_chunk_consumed.wait(5))
+                    produced.append(i)
+                    yield 'id%s' % i, 'changekey%s' % i
+
+            res = service.call(items=ids(), saved_item_folder=None)
+            self.assertEqual(next(res), ('id0', SendItem.CHUNKSIZE))
+            first_chunk_consumed.set()
+            self.assertEqual(next(res), ('id25', SendItem.CHUNKSIZE))
+            time.sleep(0.5)
+            # The feeder stops when MAX_PENDING_CHUNKS chunks are waiting for the consumer
+            self.assertLess(len(produced), (SendItem.MAX_PENDING_CHUNKS + 4) * SendItem.CHUNKSIZE)
+            res.close()
+            # All chunks are returned in order
+            self.assertEqual(
+                [r[0] for r in service.call(items=(('id%s' % i, 'ck') for i in range(60)), saved_item_folder=None)],
+                ['id0', 'id25', 'id50']
+            )
+        finally:
+            protocol.thread_pool.terminate()
+
+    def test_split_calendar_view(self):
+        # Test that long calendar views are split into windows, that windows with too many items are split again, and
+        # that occurrences spanning several windows are only returned once
+        from multiprocessing.pool import ThreadPool
+        start = UTC.localize(EWSDateTime(2017, 1, 1))
+        # One-hour items every day at noon, 20 items on January 20, and an item spanning all of February
+        hour = datetime.timedelta(hours=1)
+        calendar = [('day%s' % i, start + datetime.timedelta(days=i) + 12 * hour,
+                     start + datetime.timedelta(days=i) + 13 * hour) for i in range(90)]
+        calendar += [('busy%s' % i, start + datetime.timedelta(days=19) + i * hour,
+                      start + datetime.timedelta(days=19) + (i + 1) * hour) for i in range(20)]
+        calendar.append(('february', UTC.localize(EWSDateTime(2017, 2, 1)), UTC.localize(EWSDateTime(2017, 3, 1))))
+        windows = []
+
+        def get_response(payload):
+            view = payload
+            windows.append((view.start, view.end))
+            items = sorted((i for i in calendar if i[1] < view.end and i[2] >= view.start), key=lambda i: i[1])
+            if len(items) > 40:
+                return [to_xml('''<m:FindItemResponseMessage xmlns:m="%s" ResponseClass="Error">
+    <m:MessageText>Too many items</m:MessageText>
+    <m:ResponseCode>ErrorExceededFindCountLimit</m:ResponseCode>
+</m:FindItemResponseMessage>''' % MNS)]
+            return [to_xml('''<m:FindItemResponseMessage xmlns:m="%s" xmlns:t="%s" ResponseClass="Success">
+    <m:ResponseCode>NoError</m:ResponseCode>
+    <m:RootFolder TotalItemsInView="%s" IncludesLastItemInRange="true"><t:Items>%s</t:Items></m:RootFolder>
+</m:FindItemResponseMessage>''' % (MNS, TNS, len(items), ''.join(
+                '<t:CalendarItem><t:ItemId Id="%s" ChangeKey="XXX"/></t:CalendarItem>' % i[0] for i in items)))]
+
+        version = mock_version(build=EXCHANGE_2010)
+        protocol = mock_pooled_protocol(version=version, service_endpoint='example.com', thread_pool=ThreadPool(4))
+        try:
+            account = mock_account(version=version, protocol=protocol)
+            folder = namedtuple('mock_folder', ('account',))(account=account)
+            service = FindItem(folder=folder)
+            service.get_payload = lambda **kwargs: kwargs['calendar_view']
+            service._get_response_xml = get_response
+            kwargs = dict(additional_fields=None, restriction=None, order_fields=None, shape='IdOnly',
+                          query_string=None, depth='Shallow', page_size=100)
+            ids = [elem.find('{%s}ItemId' % TNS).get('Id') for elem in service.call(
+                calendar_view=CalendarView(start=start, end=start + datetime.timedelta(days=90)), **kwargs)]
+            self.assertEqual(len(ids), 111)
+            self.assertEqual(len(set(ids)), 111)
+            self.assertEqual(ids[:21], ['day%s' % i for i in range(19)] + ['busy0', 'busy1'])
+            # 4 windows, where the first one was split in two
+            self.assertEqual(len(windows), 6)
+            self.assertEqual(min(w[0] for w in windows), start)
+            self.assertEqual(max(w[1] for w in windows), start + datetime.timedelta(days=90))
+
+            # Short views and views with max_items are not split
+            del windows[:]
+            list(service.call(calendar_view=CalendarView(start=start, end=start + datetime.timedelta(days=7)),
+                              **kwargs))
+            self.assertEqual(len(windows), 1)
+            service._paged_call = lambda payload_func, **kwargs: iter(get_response(kwargs['calendar_view'])[0])
+            list(service.call(calendar_view=CalendarView(start=start, end=start + datetime.timedelta(days=90),
+                                                         max_items=5), **kwargs))
+            self.assertEqual(len(windows), 2)
+            del service._paged_call
+
+            # Windows that are still too big at the minimum size raise the error
+            calendar += [('overbooked%s' % i, start, start + datetime.timedelta(minutes=30)) for i in range(50)]
+            with self.assertRaises(ErrorExceededFindCountLimit):
+                list(service.call(calendar_view=CalendarView(start=start, end=start + datetime.timedelta(days=90)),
+                                  **kwargs))
+        finally:
+            protocol.thread_pool.terminate()
+
+    def test_paged_call_offset(self):
+        # Test that paging starts at the requested offset and stops when we have 'max_items' items
+        version = mock_version(build=EXCHANGE_2010)
+        account = mock_account(version=version, protocol=mock_protocol(version=version, service_endpoint='example.com'))
+        folder = namedtuple('mock_folder', ('account',))(account=account)
+        service = FindItem(folder=folder)
+        requests = []
+
+        def get_response(payload):
+            offset, page_size = payload['offset'], payload['page_size']
+            ids = range(offset, min(offset + page_size, 1000))
+            return [to_xml('''<m:FindItemResponseMessage xmlns:m="%s" xmlns:t="%s" ResponseClass="Success">
+    <m:ResponseCode>NoError</m:ResponseCode>
+    <m:RootFolder IndexedPagingOffset="%s" TotalItemsInView="1000" IncludesLastItemInRange="%s">
+        <t:Items>%s</t:Items>
+    </m:RootFolder>
+</m:FindItemResponseMessage>''' % (MNS, TNS, ids[-1] + 1, 'true' if ids[-1] == 999 else 'false', ''.join(
+                '<t:Message><t:ItemId Id="%s" ChangeKey="XXX"/></t:Message>' % i for i in ids)))]
+
+        service.get_payload = lambda **kwargs: requests.append((kwargs['offset'], kwargs['page_size'])) or kwargs
+        service._get_response_xml = get_response
+        kwargs = dict(additional_fields=None, restriction=None, order_fields=None, shape='IdOnly', query_string=None,
+                      depth='Shallow', calendar_view=None, page_size=100)
+        ids = [e.find('{%s}ItemId' % TNS).get('Id') for e in service.call(offset=500, max_items=150, **kwargs)]
+        self.assertEqual(ids, [str(i) for i in range(500, 650)])
+        self.assertEqual(requests, [(500, 100), (600, 50)])
+        del requests[:]
+        self.assertEqual(len(list(service.call(offset=950, **kwargs))), 50)
+        self.assertEqual(requests, [(950, 100)])
+
+    def test_sync_folder_items(self):
+        # Test that we keep syncing until the server says we have all changes, and that the sync state is only updated
+        # when a full page of changes has been consumed.
+        version = mock_version(build=EXCHANGE_2010)
+        account = mock_account(version=version, protocol=mock_protocol(version=version, service_endpoint='example.com'))
+        folder = namedtuple('mock_folder', ('account',))(account=account)
+        pages = [
+            ('state1', 'false', '<t:Create><t:Message><t:ItemId Id="a" ChangeKey="a1"/></t:Message></t:Create>'
+                                '<t:Update><t:Message><t:ItemId Id="b" ChangeKey="b2"/></t:Message></t:Update>'),
+            ('state2', 'true', '<t:Delete><t:ItemId Id="c"/></t:Delete>'
+                               '<t:ReadFlagChange><t:ItemId Id="d"/><t:IsRead>true</t:IsRead></t:ReadFlagChange>'),
+        ]
+        responses = [
+            [to_xml('''<m:SyncFolderItemsResponseMessage xmlns:m="%s" xmlns:t="%s" ResponseClass="Success">
+    <m:ResponseCode>NoError</m:ResponseCode>
+    <m:SyncState>%s</m:SyncState>
+    <m:IncludesLastItemInRange>%s</m:IncludesLastItemInRange>
+    <m:Changes>%s</m:Changes>
+</m:SyncFolderItemsResponseMessage>''' % (MNS, TNS, sync_state, is_last_page, changes))]
+            for sync_state, is_last_page, changes in pages
+        ]
+        service = SyncFolderItems(folder=folder)
+        sent_sync_states = []
+        service.get_payload = lambda **kwargs: sent_sync_states.append(kwargs['sync_state'])
+        service._get_response_xml = lambda payload: responses.pop(0)
+        changes = []
+        for change_type, elem in service.call(additional_fields=None, sync_state='state0', ignore=None,
+                                              max_changes_returned=2, sync_scope=None):
+            changes.append((change_type, elem.tag, service.sync_state))
+        self.assertEqual(changes, [
+            (SyncFolderItems.CREATE, '{%s}Message' % TNS, 'state0'),
+            (SyncFolderItems.UPDATE, '{%s}Message' % TNS, 'state0'),
+            (SyncFolderItems.DELETE, '{%s}Delete' % TNS, 'state1'),
+            (SyncFolderItems.READ_FLAG_CHANGE, '{%s}ReadFlagChange' % TNS, 'state1'),
+        ])
+        self.assertEqual(sent_sync_states, ['state0', 'state1'])
+        self.assertEqual(service.sync_state, 'state2')
+
+    @requests_mock.mock()
+    def test_get_streaming_events(self, m):
+        # Test that we split the stream of SOAP envelopes correctly and return notifications for each subscription
+        m.get('https://example.com/EWS/types.xsd', status_code=200)
+        protocol = Protocol(service_endpoint='https://example.com/Foo.asmx', credentials=Credentials('A', 'B'),
+                            auth_type=NTLM, verify_ssl=True, version=Version(Build(15, 1)))
+        account = namedtuple('mock_account', ('protocol', 'version', 'access_type', 'primary_smtp_address'))(
+            protocol=protocol, version=protocol.version, access_type=DELEGATE, primary_smtp_address='foo@example.com')
+        envelope = '''<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">
+  <s:Body>
+    <m:GetStreamingEventsResponse xmlns:m="%s" xmlns:t="%s">
+      <m:ResponseMessages>
+        <m:GetStreamingEventsResponseMessage ResponseClass="%s">
+          %s
+        </m:GetStreamingEventsResponseMessage>
+      </m:ResponseMessages>
+    </m:GetStreamingEventsResponse>
+  </s:Body>
+</s:Envelope>'''
+        notification = '''<m:ResponseCode>NoError</m:ResponseCode>
+<m:Notifications>
+  <m:Notification>
+    <t:SubscriptionId>%s</t:SubscriptionId>
+    <t:NewMailEvent><t:Watermark>w1</t:Watermark><t:TimeStamp>2017-01-01T00:00:00Z</t:TimeStamp>
+      <t:ItemId Id="a" ChangeKey="a1"/><t:ParentFolderId Id="b" ChangeKey="b1"/></t:NewMailEvent>
+  </m:Notification>
+</m:Notifications>'''
+        body = ''.join([
+            envelope % (MNS, TNS, 'Success', notification % 'sub1'),
+            envelope % (MNS, TNS, 'Success', '<m:ResponseCode>NoError</m:ResponseCode>'
+                                             '<m:ConnectionStatus>OK</m:ConnectionStatus>'),
+            envelope % (MNS, TNS, 'Success', notification % 'sub2'),
+            envelope % (MNS, TNS, 'Error', '<m:MessageText>Expired</m:MessageText>'
+                                           '<m:ResponseCode>ErrorSubscriptionNotFound</m:ResponseCode>'
+                                           '<m:ErrorSubscriptionIds><m:SubscriptionId>sub1</m:SubscriptionId>'
+                                           '</m:ErrorSubscriptionIds>'),
+            envelope % (MNS, TNS, 'Success', '<m:ResponseCode>NoError</m:ResponseCode>'
+                                             '<m:ConnectionStatus>Closed</m:ConnectionStatus>'),
+        ]).encode('utf-8')
+
+        class StreamBody(io.BytesIO):
+            # Like a socket, report the stream as closed when all data has been read
+            def read(self, *args, **kwargs):
+                res = super(StreamBody, self).read(*args, **kwargs)
+                if not res:
+                    self.close()
+                return res
+
+        m.post('https://example.com/Foo.asmx', status_code=200, body=StreamBody(body))
+        res = list(GetStreamingEvents(account=account).call(subscription_ids=['sub1', 'sub2'], connection_timeout=1))
+        self.assertEqual([sub_id for sub_id, _ in res], ['sub1', 'sub2', 'sub1'])
+        self.assertEqual(res[0][1].tag, '{%s}Notification' % MNS)
+        self.assertIsInstance(res[2][1], ErrorSubscriptionNotFound)
+        self.assertEqual(m.last_request.text.count('<t:SubscriptionId>'), 2)
+
+    @requests_mock.mock()
+    def test_streaming_dispatcher_subscribe(self, m):
+        # Test that adding a subscription while the connection is being opened makes the dispatcher reconnect with the
+        # new set of subscriptions, instead of waiting for the old connection to time out.
+        m.get('https://example.com/EWS/types.xsd', status_code=200)
+        protocol = Protocol(service_endpoint='https://example.com/Foo.asmx', credentials=Credentials('A', 'B'),
+                            auth_type=NTLM, verify_ssl=True, version=Version(Build(15, 1)))
+
+        class MockAccount(object):
+            def __init__(self):
+                self.protocol = protocol
+                self.version = protocol.version
+                self.access_type = DELEGATE
+                self.primary_smtp_address = 'foo@example.com'
+                self.subscription_ids = iter(['sub1', 'sub2'])
+
+            def subscribe_to_streaming(self, folders, event_types):
+                return next(self.subscription_ids)
+
+        class BlockingBody(io.BytesIO):
+            # Like a server with no events to report, block until the connection is closed
+            def __init__(self):
+                super(BlockingBody, self).__init__()
+                self.closed_event = Event()
+
+            def read(self, *args, **kwargs):
+                self.closed_event.wait(10)
+                return b''
+
+            def close(self):
+                self.closed_event.set()
+                super(BlockingBody, self).close()
+
+        request_received, subscribed, reconnected = Event(), Event(), Event()
+        subscription_counts = []
+
+        def body(request, context):
+            subscription_counts.append(request.text.count('<t:SubscriptionId>'))
+            if len(subscription_counts) == 1:
+                # Hold back the response until the second subscription has been added
+                request_received.set()
+                self.assertTrue(subscribed.wait(5))
+            else:
+                reconnected.set()
+            return BlockingBody()
+
+        m.post('https://example.com/Foo.asmx', status_code=200, body=body)
+        account = MockAccount()
+        dispatcher = StreamingDispatcher(queue=Queue())
+        dispatcher.subscribe(account, folders=[])
+        dispatcher.start()
+        try:
+            self.assertTrue(request_received.wait(5))
+            dispatcher.subscribe(account, folders=[])
+            subscribed.set()
+            self.assertTrue(reconnected.wait(5))
+        finally:
+            dispatcher.stop()
+        self.assertEqual(subscription_counts, [1, 2])
+
+    @requests_mock.mock()
+    def test_streaming_dispatcher_errors(self, m):
+        # Test that failed subscriptions are dropped from the connection, and that we don't reconnect right away when
+        # the server closes the connection right away
+        m.get('https://example.com/EWS/types.xsd', status_code=200)
+        protocol = Protocol(service_endpoint='https://example.com/Foo.asmx', credentials=Credentials('A', 'B'),
+                            auth_type=NTLM, verify_ssl=True, version=Version(Build(15, 1)))
+        account = namedtuple('mock_account', ('protocol', 'version', 'access_type', 'primary_smtp_address',
+                                              'subscribe_to_streaming'))(
+            protocol=protocol, version=protocol.version, access_type=DELEGATE, primary_smtp_address='foo@example.com',
+            subscribe_to_streaming=lambda folders, event_types, ids=iter(['sub1', 'sub2']): next(ids))
+        envelope = '''<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>
+<m:GetStreamingEventsResponse xmlns:m="%s"><m:ResponseMessages>
+<m:GetStreamingEventsResponseMessage ResponseClass="%%s">%%s</m:GetStreamingEventsResponseMessage>
+</m:ResponseMessages></m:GetStreamingEventsResponse></s:Body></s:Envelope>''' % MNS
+        body = ''.join([
+            envelope % ('Error', '<m:MessageText>Expired</m:MessageText>'
+                                 '<m:ResponseCode>ErrorSubscriptionNotFound</m:ResponseCode>'
+                                 '<m:ErrorSubscriptionIds><m:SubscriptionId>sub1</m:SubscriptionId>'
+                                 '</m:ErrorSubscriptionIds>'),
+            envelope % ('Success', '<m:ResponseCode>NoError</m:ResponseCode>'
+                                   '<m:ConnectionStatus>Closed</m:ConnectionStatus>'),
+        ]).encode('utf-8')
+        requests_sent = []
+
+        class StreamBody(io.BytesIO):
+            # Like a socket, report the stream as closed when all data has been read
+            def read(self, *args, **kwargs):
+                res = super(StreamBody, self).read(*args, **kwargs)
+                if not res:
+                    self.close()
+                return res
+
+        def response_body(request, context):
+            requests_sent.append((time.time(), request.text.count('<t:SubscriptionId>')))
+            return StreamBody(body)
+
+        class FastDispatcher(StreamingDispatcher):
+            RECONNECT_WAIT = 0.3
+
+        m.post('https://example.com/Foo.asmx', status_code=200, body=response_body)
+        queue = Queue()
+        dispatcher = FastDispatcher(queue=queue)
+        dispatcher.subscribe(account, folders=[])
+        dispatcher.subscribe(account, folders=[])
+        dispatcher.start()
+        try:
+            subscription, error = queue.get(timeout=5)
+            self.assertEqual(subscription.subscription_id, 'sub1')
+            self.assertIsInstance(error, ErrorSubscriptionNotFound)
+            time.sleep(0.5)
+        finally:
+            dispatcher.stop()
+        # We reconnected without the failed subscription, after waiting
+        self.assertGreaterEqual(len(requests_sent), 2)
+        self.assertLessEqual(len(requests_sent), 3)
+        self.assertEqual([n for _, n in requests_sent], [2] + [1] * (len(requests_sent) - 1))
+        self.assertGreaterEqual(requests_sent[1][0] - requests_sent[0][0], FastDispatcher.RECONNECT_WAIT)
+        self.assertTrue(queue.empty())
+
+    def test_events_from_xml(self):
+        notification = to_xml('''<m:Notification xmlns:m="%s" xmlns:t="%s">
+  <t:SubscriptionId>sub1</t:SubscriptionId>
+  <t:PreviousWatermark>w0</t:PreviousWatermark>
+  <t:MoreEvents>false</t:MoreEvents>
+  <t:NewMailEvent><t:Watermark>w1</t:Watermark><t:TimeStamp>2017-01-01T00:00:00Z</t:TimeStamp>
+    <t:ItemId Id="a" ChangeKey="a1"/><t:ParentFolderId Id="b" ChangeKey="b1"/></t:NewMailEvent>
+  <t:MovedEvent><t:Watermark>w2</t:Watermark><t:TimeStamp>2017-01-01T00:00:01Z</t:TimeStamp>
+    <t:FolderId Id="c" ChangeKey="c1"/><t:ParentFolderId Id="d" ChangeKey="d1"/>
+    <t:OldFolderId Id="e" ChangeKey="e1"/><t:OldParentFolderId Id="f" ChangeKey="f1"/></t:MovedEvent>
+  <t:ModifiedEvent><t:Watermark>w3</t:Watermark><t:TimeStamp>2017-01-01T00:00:02Z</t:TimeStamp>
+    <t:FolderId Id="b" ChangeKey="b2"/><t:ParentFolderId Id="g" ChangeKey="g1"/>
+    <t:UnreadCount>3</t:UnreadCount></t:ModifiedEvent>
+  <t:StatusEvent><t:Watermark>w4</t:Watermark></t:StatusEvent>
+</m:Notification>''' % (MNS, TNS))
+        events = list(events_from_xml(notification, account=None))
+        self.assertEqual([e.__class__ for e in events], [NewMailEvent, MovedEvent, ModifiedEvent, StatusEvent])
+        self.assertEqual([e.watermark for e in events], ['w1', 'w2', 'w3', 'w4'])
+        self.assertEqual(events[0].item_id.id, 'a')
+        self.assertEqual(events[0].timestamp, UTC.localize(EWSDateTime(2017, 1, 1)))
+        self.assertIsNone(events[0].folder_id)
+        self.assertEqual(events[1].old_folder_id.id, 'e')
+        self.assertEqual(events[1].old_parent_folder_id.id, 'f')
+        self.assertEqual(events[2].unread_count, 3)
+
 
 class TransportTest(unittest.TestCase):
     @requests_mock.mock()
@@ -961,6 +2482,151 @@ class UtilTest(unittest.TestCase):
             get_domain('blah')
 
 
+class FolderTreeTest(unittest.TestCase):
+    def test_folder_tree(self):
+        account = namedtuple('mock_account', ('root', 'version', 'locale'))(root=None, version=None, locale=None)
+        root = Root(folder_id='root', changekey='x')
+        tree = FolderTree(account=account, root=root)
+
+        def folder(folder_id, parent_id, name, folder_cls=Folder):
+            return folder_cls(folder_id=folder_id, changekey='x', parent_folder_id=ParentFolderId(parent_id, 'x'),
+                              name=name)
+
+        # Subfolders may arrive before their parents
+        tree._add(folder('c', 'b', 'C'))
+        tree._add(folder('b', 'a', 'B'))
+        with self.assertRaises(KeyError):
+            tree.get_folder_by_path('A/B')
+        tree._add(folder('a', 'root', 'A'))
+        tree._add(folder('d', 'a', 'C', folder_cls=Inbox))
+        self.assertEqual(len(tree), 4)
+        self.assertEqual(tree.get_folder_by_path('A/B/C').folder_id, 'c')
+        self.assertEqual(tree.get_folder_by_path(('A', 'B')).folder_id, 'b')
+        self.assertEqual(tree.get_path(tree.get('c')), 'A/B/C')
+        self.assertEqual(sorted(f.folder_id for f in tree.get_folders_by_name('C')), ['c', 'd'])
+        self.assertEqual([f.folder_id for f in tree.get_subfolders_by_name(tree.get('b'), 'C')], ['c'])
+        self.assertEqual(sorted(f.folder_id for f in tree.get_children(tree.get('a'))), ['b', 'd'])
+        self.assertEqual(sorted(f.folder_id for f in tree.walk()), ['a', 'b', 'c', 'd'])
+        # Move and rename a folder
+        tree._add(folder('b', 'd', 'X'))
+        self.assertEqual(tree.get_path(tree.get('c')), 'A/C/X/C')
+        with self.assertRaises(KeyError):
+            tree.get_folder_by_path('A/B/C')
+
+        # Folder.get_folder_by_name() only uses the tree if it has already been built
+        class MockFolder(Folder):
+            def get_folders(self, *args, **kwargs):
+                return [folder('y', 'a', 'X')]
+
+        class MockAccount(object):
+            pass
+
+        tree_account = MockAccount()
+        self.assertEqual(MockFolder(account=tree_account, folder_id='a').get_folder_by_name('X').folder_id, 'y')
+        tree_account.folder_tree = tree
+        self.assertEqual(MockFolder(account=tree_account, folder_id='a').get_folder_by_name('X').folder_id, 'b')
+        # Save and load the tree
+        tree.sync_state = 'state'
+        filename = os.path.join(tempfile.gettempdir(), 'exchangelib.test_folder_tree.json')
+        try:
+            tree.save(filename)
+            loaded_tree = FolderTree.load(account=account, filename=filename)
+        finally:
+            os.unlink(filename)
+        self.assertEqual(loaded_tree.sync_state, 'state')
+        self.assertEqual(len(loaded_tree), 4)
+        self.assertIsInstance(loaded_tree.get('d'), Inbox)
+        self.assertEqual(loaded_tree.get_path(loaded_tree.get('c')), 'A/C/X/C')
+        # Deleting a folder also deletes its subfolders
+        tree._remove('d')
+        self.assertEqual(sorted(f.folder_id for f in tree), ['a'])
+        self.assertEqual(tree.get_folders_by_name('C'), [])
+
+    def test_account_folders(self):
+        # Test that Account.folders follows changes to the folder tree
+        account = Account.__new__(Account)
+        account.root = Root(folder_id='root', changekey='x')
+        account._folders_cache = None
+        account.folder_tree = FolderTree(account=account, root=account.root)
+        account.folder_tree._add(Inbox(folder_id='a', changekey='x', parent_folder_id=ParentFolderId('root', 'x'),
+                                       name='A'))
+        self.assertEqual([f.folder_id for f in account.folders[Inbox]], ['a'])
+        self.assertIs(account.folders, account.folders)
+        account.folder_tree._add(Calendar(folder_id='b', changekey='x', parent_folder_id=ParentFolderId('root', 'x'),
+                                          name='B'))
+        self.assertEqual([f.folder_id for f in account.folders[Calendar]], ['b'])
+        # A new tree, e.g. from FolderTree.load(), replaces the old one
+        account.folder_tree = FolderTree(account=account, root=account.root)
+        self.assertEqual(dict(account.folders), {})
+
+
+class ItemMirrorTest(unittest.TestCase):
+    class MockFolder(object):
+        # Replays a list of pages of changes like Folder.sync_items() does
+        def __init__(self, folder_id, pages):
+            self.folder_id = folder_id
+            self.pages = pages
+            self.item_sync_state = None
+
+        def sync_items(self, sync_state, only_fields, max_changes_returned):
+            self.item_sync_state = sync_state
+            for next_sync_state, changes in self.pages:
+                for change in changes:
+                    yield change
+                self.item_sync_state = next_sync_state
+
+    def test_item_mirror(self):
+        mirror = ItemMirror(':memory:', fields=('subject', 'is_read', 'datetime_received'))
+        dt = UTC.localize(EWSDateTime(2017, 1, 2, 3, 4, 5))
+        folder = self.MockFolder('folder1', [
+            ('state1', [
+                (SyncFolderItems.CREATE, Message(item_id='a', changekey='a1', subject='Foo', is_read=False)),
+                (SyncFolderItems.CREATE, Message(item_id='b', changekey='b1', subject='Bar', datetime_received=dt)),
+            ]),
+        ])
+        self.assertEqual(mirror.sync(folder), {SyncFolderItems.CREATE: 2})
+        self.assertEqual(mirror.get_sync_state(folder), 'state1')
+        self.assertEqual(mirror.count(folder), 2)
+        self.assertEqual(
+            mirror.get('b'),
+            {'item_id': 'b', 'folder_id': 'folder1', 'changekey': 'b1', 'subject': 'Bar', 'is_read': None,
+             'datetime_received': '2017-01-02T03:04:05Z'}
+        )
+        folder.pages = [
+            ('state2', [
+                (SyncFolderItems.UPDATE, Message(item_id='a', changekey='a2', subject='Baz', is_read=False)),
+                (SyncFolderItems.READ_FLAG_CHANGE, (('a', None), True)),
+            ]),
+            ('state3', [
+                (SyncFolderItems.DELETE, ('b', None)),
+            ]),
+        ]
+        self.assertEqual(mirror.sync(folder), {SyncFolderItems.UPDATE: 1, SyncFolderItems.READ_FLAG_CHANGE: 1,
+                                               SyncFolderItems.DELETE: 1})
+        self.assertEqual(mirror.get_sync_state(folder), 'state3')
+        self.assertEqual(
+            list(mirror.items(folder)),
+            [{'item_id': 'a', 'folder_id': 'folder1', 'changekey': 'a2', 'subject': 'Baz', 'is_read': 1,
+              'datetime_received': None}]
+        )
+        with self.assertRaises(KeyError):
+            mirror.get('b')
+        # Test that a failed sync keeps the last fully synced page
+        folder.pages = [
+            ('state4', [(SyncFolderItems.DELETE, ('a', None))]),
+            ('state5', [('XXX', None)]),
+        ]
+        with self.assertRaises(ValueError):
+            mirror.sync(folder)
+        self.assertEqual(mirror.get_sync_state(folder), 'state4')
+        self.assertEqual(mirror.count(folder), 0)
+        mirror.reset(folder)
+        self.assertIsNone(mirror.get_sync_state(folder))
+        with self.assertRaises(ValueError):
+            ItemMirror(':memory:', fields=('subject; DROP TABLE items',))
+        mirror.close()
+
+
 class EWSTest(unittest.TestCase):
     def setUp(self):
         # There's no official Exchange server we can test against, and we can't really provide credentials for our
@@ -2000,6 +3666,24 @@ class FolderTest(EWSTest):
         for f in folders[Tasks]:
             self.assertEqual(f.folder_class, 'IPF.Task')
 
+    def test_folder_tree(self):
+        tree = FolderTree(account=self.account).refresh()
+        self.assertEqual(len(tree), len(list(self.account.root.get_folders(depth=DEEP))))
+        inbox = self.account.inbox
+        self.assertEqual(tree.get_folder_by_path(tree.get_path(inbox)).folder_id, inbox.folder_id)
+        self.assertIsNotNone(tree.sync_state)
+        # Nothing changed since the last refresh
+        self.assertEqual(len(tree.refresh()), len(tree))
+        # Test that a saved tree can be refreshed
+        filename = os.path.join(tempfile.gettempdir(), 'exchangelib.test_folder_tree.json')
+        try:
+            tree.save(filename)
+            loaded_tree = FolderTree.load(account=self.account, filename=filename)
+        finally:
+            os.unlink(filename)
+        self.assertEqual(loaded_tree.sync_state, tree.sync_state)
+        self.assertEqual(len(loaded_tree.refresh()), len(tree))
+
     def test_get_folder_by_name(self):
         folder_name = Calendar.LOCALIZED_NAMES[self.account.locale][0]
         f = self.account.root.get_folder_by_name(folder_name)
@@ -2036,6 +3720,32 @@ class FolderTest(EWSTest):
         self.assertGreaterEqual(self.account.inbox.child_folder_count, 0)
         self.bulk_delete(items)
 
+    def test_sync_items(self):
+        folder = self.account.inbox
+        # Get the current sync state
+        for _ in folder.sync_items(max_changes_returned=512):
+            pass
+        sync_state = folder.item_sync_state
+        self.assertIsNotNone(sync_state)
+        item = Message(account=self.account, folder=folder, is_read=False, subject=get_random_string(16),
+                       categories=self.categories)
+        item.save()
+        changes = list(folder.sync_items(sync_state=sync_state, only_fields=['subject']))
+        self.assertEqual([(c, i.item_id, i.subject) for c, i in changes],
+                         [(SyncFolderItems.CREATE, item.item_id, item.subject)])
+        sync_state = folder.item_sync_state
+        item.is_read = True
+        item.save(update_fields=['is_read'])
+        changes = list(folder.sync_items(sync_state=sync_state))
+        self.assertEqual([(c, i[0][0], i[1]) for c, i in changes],
+                         [(SyncFolderItems.READ_FLAG_CHANGE, item.item_id, True)])
+        sync_state = folder.item_sync_state
+        item.delete()
+        changes = list(folder.sync_items(sync_state=sync_state))
+        self.assertEqual([(c, i[0]) for c, i in changes], [(SyncFolderItems.DELETE, item.item_id)])
+        with self.assertRaises(ValueError):
+            list(folder.sync_items(only_fields=['body']))  # Complex fields are not supported
+
     def test_refresh(self):
         # Test that we can refresh folders
         folders = self.account.folders
@@ -2044,7 +3754,7 @@ class FolderTest(EWSTest):
                 old_values = {}
                 for field in folder_cls.FIELDS:
                     old_values[field.name] = getattr(f, field.name)
-                    if field.name in ('account', 'folder_id', 'changekey'):
+                    if field.name in ('account', 'folder_id', 'changekey', 'parent_folder_id'):
                         # These are needed for a successful refresh()
                         continue
                     setattr(f, field.name, self.random_val(field))